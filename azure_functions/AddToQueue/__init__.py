@@ -6,12 +6,14 @@ import os
 import json
 import random
 import time
+import uuid
 from shared_code.status_log import StatusLog, State, StatusClassification
 import azure.functions as func
 from azure.storage.blob import generate_blob_sas
 from azure.storage.queue import QueueClient, TextBase64EncodePolicy
 
 from shared_code.utilities import Utilities, MediaType
+from shared_code.polling_scheduler import estimate_page_count
 
 azure_blob_storage_account = os.environ["BLOB_STORAGE_ACCOUNT"]
 azure_blob_storage_endpoint = os.environ["BLOB_STORAGE_ACCOUNT_ENDPOINT"]
@@ -25,13 +27,20 @@ cosmosdb_url = os.environ["COSMOSDB_URL"]
 cosmosdb_key = os.environ["COSMOSDB_KEY"]
 cosmosdb_log_database_name = os.environ["COSMOSDB_LOG_DATABASE_NAME"]
 cosmosdb_log_container_name = os.environ["COSMOSDB_LOG_CONTAINER_NAME"]
+# Skip checking the Cosmos DB databases and containers exist when they were provisioned with the deployment
+cosmosdb_provisioned = os.environ.get("COSMOSDB_PROVISIONED", "false").lower() == "true"
 non_pdf_submit_queue = os.environ["NON_PDF_SUBMIT_QUEUE"]
 
 pdf_submit_queue = os.environ["PDF_SUBMIT_QUEUE"]
+pdf_polling_queue = os.environ["PDF_POLLING_QUEUE"]
+FR_API_VERSION = os.environ["FR_API_VERSION"]
+# When enabled, a PDF with the same content as one already analyzed reuses the stored Document Intelligence result
+doc_intel_result_reuse = os.environ.get("DOC_INTEL_RESULT_REUSE", "true").lower() == "true"
 # media_submit_queue = os.environ["MEDIA_SUBMIT_QUEUE"]
 # image_enrichment_queue = os.environ["IMAGE_ENRICHMENT_QUEUE"]
 max_seconds_hide_on_upload = int(os.environ["MAX_SECONDS_HIDE_ON_UPLOAD"])
 function_name = "AddToQueue"
+FR_MODEL = "prebuilt-layout"
 
 
 def main(myblob: func.InputStream):
@@ -51,7 +60,7 @@ def main(myblob: func.InputStream):
         if "prompt_id" in blob_metadata:
             prompt_id = blob_metadata["prompt_id"]
 
-        statusLog = StatusLog(cosmosdb_url, cosmosdb_key, cosmosdb_log_database_name, cosmosdb_log_container_name)
+        statusLog = StatusLog(cosmosdb_url, cosmosdb_key, cosmosdb_log_database_name, cosmosdb_log_container_name, cosmosdb_provisioned)
         statusLog.upsert_document(myblob.name, 'Pipeline triggered by Blob Upload', StatusClassification.INFO, State.PROCESSING, True) # Fresh start set to True, will delete existing log            
         statusLog.upsert_document(myblob.name, f'{function_name} - function started', StatusClassification.DEBUG)    
         
@@ -86,8 +95,24 @@ def main(myblob: func.InputStream):
             "blob_name": f"{myblob.name}",
             "blob_uri": f"{myblob.uri}",
             "submit_queued_count": 1,
-            "prompt_id": prompt_id
+            "prompt_id": prompt_id,
+            "file_size": myblob.length # Used with the page count to predict when Document Intelligence will have finished
         }        
+        if file_extension == 'pdf':
+            content = myblob.read()
+            message["page_count"] = estimate_page_count(content)
+            if doc_intel_result_reuse:
+                message["content_md5"] = utilities.get_blob_content_md5(myblob.name, myblob.uri, content)
+                doc_intel_result = utilities.find_doc_intel_result(message["content_md5"], FR_MODEL, FR_API_VERSION)
+                if doc_intel_result is not None:
+                    # Same content was already analyzed, so skip submission and go straight to chunking the stored result.
+                    # The result id is new for this run, as chunk progress is tracked per run
+                    queue_name = pdf_polling_queue
+                    message["FR_resultId"] = f"stored-{uuid.uuid4()}"
+                    message["FR_API_List_idx"] = 0
+                    message["polling_queue_count"] = 1
+                    message["doc_intel_result"] = doc_intel_result
+                    statusLog.upsert_document(myblob.name, f'{function_name} - Reusing the Document Intelligence result of a document with the same content {doc_intel_result}', StatusClassification.DEBUG)
         message_string = json.dumps(message)
         # print(f"message:{message}")
         
@@ -95,7 +120,7 @@ def main(myblob: func.InputStream):
         queue_client = QueueClient.from_connection_string(azure_blob_connection_string, queue_name, message_encode_policy=TextBase64EncodePolicy())
         backoff =  random.randint(1, max_seconds_hide_on_upload)        
         queue_client.send_message(message_string, visibility_timeout = backoff)  
-        statusLog.upsert_document(myblob.name, f'{function_name} - {file_extension} file sent to submit queue. Visible in {backoff} seconds', StatusClassification.DEBUG, State.QUEUED)          
+        statusLog.upsert_document(myblob.name, f'{function_name} - {file_extension} file sent to {queue_name} queue. Visible in {backoff} seconds', StatusClassification.DEBUG, State.QUEUED)          
         
     except Exception as err:
         statusLog.upsert_document(myblob.name, f"{function_name} - An error occurred - {str(err)}", StatusClassification.ERROR, State.ERROR)
@@ -8,8 +8,12 @@ import os
 import json
 import requests
 from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+from azure.core.exceptions import ResourceNotFoundError
 from shared_code.status_log import StatusLog, State, StatusClassification
 from shared_code.utilities import Utilities, MediaType
+from shared_code.backoff_policy import BackoffPolicy, get_retry_after
+from shared_code.polling_scheduler import PollingScheduler, get_elapsed_seconds
+from shared_code.queue_fanout import QueueFanout, get_queue_client
 import random
 from collections import namedtuple
 import time
@@ -37,6 +41,8 @@ cosmosdb_url = os.environ["COSMOSDB_URL"]
 cosmosdb_key = os.environ["COSMOSDB_KEY"]
 cosmosdb_log_database_name = os.environ["COSMOSDB_LOG_DATABASE_NAME"]
 cosmosdb_log_container_name = os.environ["COSMOSDB_LOG_CONTAINER_NAME"]
+# Skip checking the Cosmos DB databases and containers exist when they were provisioned with the deployment
+cosmosdb_provisioned = string_to_bool(os.environ.get("COSMOSDB_PROVISIONED", "false"))
 non_pdf_submit_queue = os.environ["NON_PDF_SUBMIT_QUEUE"]
 pdf_polling_queue = os.environ["PDF_POLLING_QUEUE"]
 pdf_submit_queue = os.environ["PDF_SUBMIT_QUEUE"]
@@ -48,15 +54,35 @@ max_submit_requeue_count = int(os.environ["MAX_SUBMIT_REQUEUE_COUNT"])
 max_polling_requeue_count = int(os.environ["MAX_POLLING_REQUEUE_COUNT"])
 submit_requeue_hide_seconds = int(os.environ["SUBMIT_REQUEUE_HIDE_SECONDS"])
 polling_backoff = int(os.environ["POLLING_BACKOFF"])
+# Longest wait between two polls of a document Document Intelligence is still analyzing
+max_polling_backoff_seconds = int(os.environ.get("MAX_POLLING_BACKOFF_SECONDS", "300"))
+# Longest a throttled message is requeued for when the service gives no Retry-After
+max_requeue_backoff_seconds = int(os.environ.get("MAX_REQUEUE_BACKOFF_SECONDS", "600"))
 max_read_attempts = int(os.environ["MAX_READ_ATTEMPTS"])
 enableDevCode = string_to_bool(os.environ["ENABLE_DEV_CODE"])
 
 chunks_queue = os.environ["CHUNKS_QUEUE"]
 max_seconds_hide_on_upload = int(os.environ["MAX_SECONDS_HIDE_ON_UPLOAD"])
+# When enabled, merged chunks are queued as soon as they are written rather than after the whole document is chunked
+streaming_chunk_pipeline = string_to_bool(os.environ.get("STREAMING_CHUNK_PIPELINE", "false"))
+# Size of the connection pool kept by the shared blob client
+blob_connection_pool_size = int(os.environ.get("BLOB_CONNECTION_POOL_SIZE", "32"))
+# Format chunk and output json files are written in, one of json_indent, json or json_gzip
+output_format = os.environ.get("OUTPUT_FORMAT", "json_indent")
+# Number of chunk blobs uploaded concurrently
+blob_upload_concurrency = int(os.environ.get("BLOB_UPLOAD_CONCURRENCY", "8"))
+# Number of merged chunk messages sent to the chunks queue concurrently
+chunk_queue_concurrency = int(os.environ.get("CHUNK_QUEUE_CONCURRENCY", "16"))
+# When disabled, paragraph level chunks are only merged in memory and never written to blob storage
+persist_granular_chunks = string_to_bool(os.environ.get("PERSIST_GRANULAR_CHUNKS", "true"))
 
 function_name = "PollDocumentIntelChunk"
-utilities = Utilities(azure_blob_storage_account, azure_blob_storage_endpoint, azure_blob_drop_storage_container, azure_blob_content_storage_container, azure_blob_storage_key)
+utilities = Utilities(azure_blob_storage_account, azure_blob_storage_endpoint, azure_blob_drop_storage_container, azure_blob_content_storage_container, azure_blob_storage_key, blob_connection_pool_size,
+                      output_format=output_format)
 FR_MODEL = "prebuilt-layout"
+resubmit_backoff_policy = BackoffPolicy(submit_requeue_hide_seconds, max_requeue_backoff_seconds)
+poll_backoff_policy = BackoffPolicy(polling_backoff, max_requeue_backoff_seconds)
+polling_scheduler = PollingScheduler(polling_backoff, max_polling_backoff_seconds)
 
 
 def main(msg: func.QueueMessage) -> None:
@@ -67,8 +93,9 @@ def main(msg: func.QueueMessage) -> None:
     The chunks are merged to create bigger chunks then file uris are added to chunks-queue.
     '''
     
+    response = None
     try:
-        statusLog = StatusLog(cosmosdb_url, cosmosdb_key, cosmosdb_log_database_name, cosmosdb_log_container_name)
+        statusLog = StatusLog(cosmosdb_url, cosmosdb_key, cosmosdb_log_database_name, cosmosdb_log_container_name, cosmosdb_provisioned)
         # Receive message from the queue
         message_body = msg.get_body().decode('utf-8')
         message_json = json.loads(message_body)
@@ -79,6 +106,10 @@ def main(msg: func.QueueMessage) -> None:
         queued_count = message_json['polling_queue_count']      
         submit_queued_count = message_json["submit_queued_count"]
         prompt_id = message_json["prompt_id"] # New
+        page_count = message_json.get("page_count")
+        file_size = message_json.get("file_size")
+        content_md5 = message_json.get("content_md5")
+        doc_intel_result = message_json.get("doc_intel_result") # Set when a document with the same content was already analyzed
         statusLog.upsert_document(blob_name, f'{function_name} - Message received from pdf polling queue attempt {queued_count}', StatusClassification.DEBUG, State.PROCESSING)        
         statusLog.upsert_document(blob_name, f'{function_name} - Polling Form Recognizer function started', StatusClassification.INFO)
         
@@ -95,12 +126,28 @@ def main(msg: func.QueueMessage) -> None:
         }
         url = f"{doc_intel_endpoint_list[idx_submitted]}formrecognizer/documentModels/{FR_MODEL}/analyzeResults/{FR_resultId}"
         
-        # retry logic to handle 'Connection broken: IncompleteRead' errors, up to n times
-     
-        response = durable_get(url, headers, params)   
+        if doc_intel_result is not None:
+            try:
+                response = StoredResponse(200, json.loads(utilities.read_blob_content(doc_intel_result, blob_uri)))
+            except ResourceNotFoundError:
+                # the stored result was removed since the document was queued, so analyze it after all
+                statusLog.upsert_document(blob_name, f'{function_name} - Stored Document Intelligence result {doc_intel_result} not found, document will be submitted', StatusClassification.DEBUG)
+                for key in ("doc_intel_result", "FR_resultId", "FR_API_List_idx", "polling_queue_count"):
+                    message_json.pop(key, None)
+                queue_client = QueueClient.from_connection_string(azure_blob_connection_string, pdf_submit_queue, message_encode_policy=TextBase64EncodePolicy())
+                queue_client.send_message(json.dumps(message_json))
+                statusLog.upsert_document(blob_name, f'{function_name} file sent to submit queue', StatusClassification.DEBUG, State.QUEUED)
+                statusLog.save_document(blob_name)
+                return
+        else:
+            # retry logic to handle 'Connection broken: IncompleteRead' errors, up to n times
+            response = durable_get(url, headers, params)   
         
         # Check response and process
         if response.status_code == 200:
+            # Keep the turnaround model fitted to recent documents
+            polling_scheduler.refresh(statusLog.read_doc_intel_turnaround_history)
+
             # FR processing is complete OR still running- create document map 
             response_json = response.json()
             response_status = response_json['status']
@@ -112,64 +159,95 @@ def main(msg: func.QueueMessage) -> None:
                 # New
                 utilities.write_doc_intel_output(blob_name, response_json, 'doc_intel_response')
 
-                # build the document map     
-                statusLog.upsert_document(blob_name, f'{function_name} - Starting document map build', StatusClassification.DEBUG)  
-                document_map = utilities.build_document_map_pdf(blob_name, blob_uri, response_json["analyzeResult"], azure_blob_log_storage_container, enableDevCode)  
-                
-                statusLog.upsert_document(blob_name, f'{function_name} - Document map build complete', StatusClassification.DEBUG)     
-                # create chunks
-                statusLog.upsert_document(blob_name, f'{function_name} - Starting chunking', StatusClassification.DEBUG)  
-                # chunk_count = utilities.build_chunks(document_map, blob_name, blob_uri, CHUNK_TARGET_SIZE)
-                chunk_count, chunk_outputs = utilities.build_chunks(document_map, blob_name, blob_uri, CHUNK_TARGET_SIZE) # New                
-                statusLog.upsert_document(blob_name, f'{function_name} - Chunking complete, {chunk_count} chunks created.', StatusClassification.DEBUG)
-                
-                # # submit message to the enrichment queue to continue processing                
-                # queue_client = QueueClient.from_connection_string(azure_blob_connection_string, queue_name=text_enrichment_queue, message_encode_policy=TextBase64EncodePolicy())
-                # message_json["text_enrichment_queued_count"] = 1
-                # message_string = json.dumps(message_json)
-                # queue_client.send_message(message_string)
-                # statusLog.upsert_document(blob_name, f"{function_name} - message sent to enrichment queue", StatusClassification.DEBUG, State.QUEUED)                 
+                if doc_intel_result is None:
+                    # Record how long this document took, to predict when to poll for the next ones
+                    turnaround_seconds = get_elapsed_seconds(response_json, completed=True)
+                    if turnaround_seconds is not None:
+                        statusLog.record_doc_intel_turnaround(blob_name, len(response_json["analyzeResult"].get("pages", [])), file_size, turnaround_seconds)
+                    # Keep the result by content hash, so a later upload of the same document is not analyzed again
+                    if content_md5 is not None:
+                        utilities.store_doc_intel_result(content_md5, FR_MODEL, FR_API_VERSION, response_json)
+                else:
+                    statusLog.upsert_document(blob_name, f'{function_name} - Reused the stored Document Intelligence result {doc_intel_result}', StatusClassification.DEBUG)
 
-                # New
-                # merge chunks: The paragraph level chunks may be too granular, so merge them into bigger chunks less than the value set for MERGED_CHUNK_TARGET_SIZE environment variable.
-                statusLog.upsert_document(blob_name, f'{function_name} - Starting chunk merging', StatusClassification.DEBUG)  
-                # chunk_count, chunk_outputs = utilities.build_chunks(document_map, blob_name, blob_uri, CHUNK_TARGET_SIZE) # New
-                merged_chunk_count, merged_chunk_paths = utilities.build_merged_chunks(chunk_outputs, blob_name, blob_uri, MERGED_CHUNK_TARGET_SIZE)
-                statusLog.upsert_document(blob_name, f'{function_name} - Chunk merging complete, {merged_chunk_count} merged chunks created with MERGED_CHUNK_TARGET_SIZE {MERGED_CHUNK_TARGET_SIZE}.', StatusClassification.DEBUG)                
-                
-                queue_client = QueueClient.from_connection_string(azure_blob_connection_string, queue_name=chunks_queue, message_encode_policy=TextBase64EncodePolicy())
+                # Merged chunks are queued concurrently. The chunks already queued are recorded as the fan-out goes,
+                # so when this message is processed again after a failure part way they are not queued twice
+                fanout = QueueFanout(get_queue_client(azure_blob_connection_string, chunks_queue, blob_connection_pool_size), chunk_queue_concurrency,
+                                     sent=statusLog.read_chunk_fanout_progress(blob_name, FR_resultId),
+                                     checkpoint=lambda sent: statusLog.save_chunk_fanout_progress(blob_name, FR_resultId, sent))
+
+                if streaming_chunk_pipeline:
+                    # Stream paragraphs from the analyze result through chunking and merging, so each merged chunk is
+                    # written and queued while later pages are still being chunked
+                    statusLog.upsert_document(blob_name, f'{function_name} - Starting streaming chunking and chunk merging', StatusClassification.DEBUG)
+                    paragraphs = utilities.iter_document_structure(response_json["analyzeResult"])
+                    chunk_count = 0
 
-                # Queue message with a random backoff so as not to put the next function under unnecessary load
-                for chunk_path in merged_chunk_paths:
+                    def counted_chunks(chunks):
+                        nonlocal chunk_count
+                        for chunk_output in chunks:
+                            chunk_count += 1
+                            yield chunk_output
 
-                    # print(f'chunk_path:{chunk_path}')
+                    # Granular chunks upload in the background, merged chunks are written before they are queued
+                    with fanout, utilities.create_blob_uploader(blob_upload_concurrency) as uploader:
+                        granular_chunks = counted_chunks(utilities.iter_chunks(paragraphs, blob_name, blob_uri, CHUNK_TARGET_SIZE, uploader, persist_granular_chunks))
+                        merged_chunk_count = 0
+                        for chunk_path in utilities.iter_merged_chunks(granular_chunks, blob_name, blob_uri, MERGED_CHUNK_TARGET_SIZE):
+                            send_chunk_message(fanout, chunk_path, message_json)
+                            merged_chunk_count += 1
+                    statusLog.upsert_document(blob_name, f'{function_name} - Streaming chunking complete, {chunk_count} chunks created, {merged_chunk_count} merged chunks created with MERGED_CHUNK_TARGET_SIZE {MERGED_CHUNK_TARGET_SIZE}.', StatusClassification.DEBUG)
+                else:
+                    # build the document map     
+                    statusLog.upsert_document(blob_name, f'{function_name} - Starting document map build', StatusClassification.DEBUG)  
+                    document_map = utilities.build_document_map_pdf(blob_name, blob_uri, response_json["analyzeResult"], azure_blob_log_storage_container, enableDevCode)  
                     
-                    backoff =  random.randint(1, max_seconds_hide_on_upload)     
+                    statusLog.upsert_document(blob_name, f'{function_name} - Document map build complete', StatusClassification.DEBUG)     
+                    # Chunks upload concurrently, the with block only exits once every chunk has been written
+                    with utilities.create_blob_uploader(blob_upload_concurrency) as uploader:
+                        # create chunks
+                        statusLog.upsert_document(blob_name, f'{function_name} - Starting chunking', StatusClassification.DEBUG)  
+                        # chunk_count = utilities.build_chunks(document_map, blob_name, blob_uri, CHUNK_TARGET_SIZE)
+                        chunk_count, chunk_outputs = utilities.build_chunks(document_map, blob_name, blob_uri, CHUNK_TARGET_SIZE, uploader, persist_granular_chunks) # New                
+                        statusLog.upsert_document(blob_name, f'{function_name} - Chunking complete, {chunk_count} chunks created.', StatusClassification.DEBUG)
                     
-                    # Create message
-                    message = {
-                        "blob_name": f"{blob_name}",
-                        "blob_uri": f"{blob_uri}",
-                        "submit_queued_count": f"{submit_queued_count}",                        
-                        "FR_resultId": f"{FR_resultId}",
-                        "polling_queue_count" : f"{queued_count}",
-                        "chunk_name": f"{chunk_path[0]}",
-                        "chunk_blob_uri": f"{chunk_path[1]}",
-                        "chunk_queued_count": 1,
-                        "prompt_id": prompt_id
-                    }        
-                    message_string = json.dumps(message)
+                        # # submit message to the enrichment queue to continue processing                
+                        # queue_client = QueueClient.from_connection_string(azure_blob_connection_string, queue_name=text_enrichment_queue, message_encode_policy=TextBase64EncodePolicy())
+                        # message_json["text_enrichment_queued_count"] = 1
+                        # message_string = json.dumps(message_json)
+                        # queue_client.send_message(message_string)
+                        # statusLog.upsert_document(blob_name, f"{function_name} - message sent to enrichment queue", StatusClassification.DEBUG, State.QUEUED)                 
 
-                    queue_client.send_message(message_string, visibility_timeout = backoff)  
+                        # New
+                        # merge chunks: The paragraph level chunks may be too granular, so merge them into bigger chunks less than the value set for MERGED_CHUNK_TARGET_SIZE environment variable.
+                        statusLog.upsert_document(blob_name, f'{function_name} - Starting chunk merging', StatusClassification.DEBUG)  
+                        # chunk_count, chunk_outputs = utilities.build_chunks(document_map, blob_name, blob_uri, CHUNK_TARGET_SIZE) # New
+                        merged_chunk_count, merged_chunk_paths = utilities.build_merged_chunks(chunk_outputs, blob_name, blob_uri, MERGED_CHUNK_TARGET_SIZE, uploader)
+                        statusLog.upsert_document(blob_name, f'{function_name} - Chunk merging complete, {merged_chunk_count} merged chunks created with MERGED_CHUNK_TARGET_SIZE {MERGED_CHUNK_TARGET_SIZE}.', StatusClassification.DEBUG)
+
+                    with fanout:
+                        for chunk_path in merged_chunk_paths:
+                            send_chunk_message(fanout, chunk_path, message_json)
 
+                if fanout.skipped_count:
+                    statusLog.upsert_document(blob_name, f'{function_name} - Resumed chunk fan-out, {fanout.skipped_count} merged chunks were already queued.', StatusClassification.DEBUG)
                 # Also update the chunk_count, merged_chunk_count to give visibility to subsequent steps (azure functions) on how many merged_chunks to be processed
                 statusLog.upsert_document(blob_name, f'{function_name} - {merged_chunk_count} merged chunks sent to chunks queue, prompt_id {prompt_id}.', StatusClassification.DEBUG, State.QUEUED, False, chunk_count, merged_chunk_count)
 
-            elif response_status == "running":
-                # still running so requeue with a backoff
-                if queued_count < max_read_attempts:
-                    backoff = polling_backoff * (queued_count ** 2)
-                    backoff += random.randint(0, 10)
+                # RunLLMPrompt may have completed every chunk before merged_chunk_count was recorded, in which case
+                # none of its completion checks could match, so save the count now and check once more here
+                statusLog.save_document(blob_name)
+                statusLog.mark_document_processing_complete(blob_name)
+
+            elif response_status in ("running", "notStarted"):
+                # still running so requeue until the result is predicted to be ready, never earlier than FR asked
+                if queued_count < max_polling_requeue_count:
+                    elapsed = get_elapsed_seconds(response_json)
+                    if elapsed is None:
+                        backoff = polling_backoff * (queued_count ** 2)
+                        backoff += random.randint(0, 10)
+                    else:
+                        backoff = polling_scheduler.next_poll_delay(elapsed, page_count, file_size, get_retry_after(response.headers))
                     queued_count += 1
                     message_json['polling_queue_count'] = queued_count
                     statusLog.upsert_document(blob_name, f"{function_name} - FR has not completed processing, requeuing. Polling back off of attempt {queued_count} of {max_polling_requeue_count} for {backoff} seconds", StatusClassification.DEBUG, State.QUEUED) 
@@ -183,26 +261,68 @@ def main(msg: func.QueueMessage) -> None:
                 if submit_queued_count < max_submit_requeue_count:
                     statusLog.upsert_document(blob_name, f'{function_name} - unhandled response from Form Recognizer- code: {response.status_code} status: {response_status} - text: {response.text}. Document will be resubmitted', StatusClassification.ERROR)                  
                     queue_client = QueueClient.from_connection_string(azure_blob_connection_string, pdf_submit_queue, message_encode_policy=TextBase64EncodePolicy())  
-                    submit_queued_count += 1
-                    message_json["submit_queued_count"] = submit_queued_count
+                    backoff = resubmit_backoff_policy.schedule(message_json, "submit_queued_count", response.headers)
                     message_string = json.dumps(message_json)    
-                    queue_client.send_message(message_string, visibility_timeout = submit_requeue_hide_seconds)  
-                    statusLog.upsert_document(blob_name, f'{function_name} file resent to submit queue. Visible in {submit_requeue_hide_seconds} seconds', StatusClassification.DEBUG, State.THROTTLED)      
+                    queue_client.send_message(message_string, visibility_timeout = backoff)  
+                    statusLog.upsert_document(blob_name, f'{function_name} file resent to submit queue. Visible in {backoff} seconds', StatusClassification.DEBUG, State.THROTTLED)      
                 else:
                     statusLog.upsert_document(blob_name, f'{function_name} - maximum submissions to FR reached', StatusClassification.ERROR, State.ERROR)     
                 
+        elif response.status_code == 429:
+            # polling throttled, so poll again once FR said it can take the call
+            if queued_count < max_polling_requeue_count:
+                backoff = poll_backoff_policy.schedule(message_json, "polling_queue_count", response.headers)
+                statusLog.upsert_document(blob_name, f"{function_name} - Throttled polling FR, requeuing. Polling back off of attempt {message_json['polling_queue_count']} of {max_polling_requeue_count} for {backoff} seconds", StatusClassification.DEBUG, State.QUEUED)
+                queue_client = QueueClient.from_connection_string(azure_blob_connection_string, queue_name=pdf_polling_queue, message_encode_policy=TextBase64EncodePolicy())
+                queue_client.send_message(json.dumps(message_json), visibility_timeout=backoff)
+            else:
+                statusLog.upsert_document(blob_name, f'{function_name} - maximum submissions to FR reached', StatusClassification.ERROR, State.ERROR)
+
         else:
             statusLog.upsert_document(blob_name, f'{function_name} - Error raised by FR polling', StatusClassification.ERROR, State.ERROR)    
                             
     except Exception as e:
         # a general error 
-        statusLog.upsert_document(blob_name, f"{function_name} - An error occurred - code: {response.status_code} - {str(e)}", StatusClassification.ERROR, State.ERROR)
+        status_code = response.status_code if response is not None else None
+        statusLog.upsert_document(blob_name, f"{function_name} - An error occurred - code: {status_code} - {str(e)}", StatusClassification.ERROR, State.ERROR)
         
     statusLog.save_document(blob_name)
 
 
+class StoredResponse(namedtuple("StoredResponse", ["status_code", "result"])):
+    """ Stands in for the polling response when a stored Document Intelligence result is reused """
+    headers = {}
+    text = ""
+
+    def json(self):
+        return self.result
+
+
+def send_chunk_message(fanout, chunk_path, message_json):
+    """ Queue a merged chunk for RunLLMPrompt, with a random backoff so as not to put the next function under unnecessary load """
+
+    backoff =  random.randint(1, max_seconds_hide_on_upload)     
+    
+    # Create message
+    message = {
+        "blob_name": f"{message_json['blob_name']}",
+        "blob_uri": f"{message_json['blob_uri']}",
+        "submit_queued_count": f"{message_json['submit_queued_count']}",                        
+        "FR_resultId": f"{message_json['FR_resultId']}",
+        "polling_queue_count" : f"{message_json['polling_queue_count']}",
+        "chunk_name": f"{chunk_path[0]}",
+        "chunk_blob_uri": f"{chunk_path[1]}",
+        "chunk_queued_count": 1,
+        "prompt_id": message_json["prompt_id"]
+    }        
+    message_string = json.dumps(message)
+
+    fanout.send(chunk_path[0], message_string, visibility_timeout = backoff)
+
+
 @retry(stop=stop_after_attempt(max_read_attempts), wait=wait_fixed(5))
 def durable_get(url, headers, params):
     response = requests.get(url, headers=headers, params=params)   
-    response.raise_for_status()  # Raise stored HTTPError, if one occurred.
+    if response.status_code != 429: # Throttling is requeued by the caller rather than retried here
+        response.raise_for_status()  # Raise stored HTTPError, if one occurred.
     return response
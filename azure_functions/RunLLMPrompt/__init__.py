@@ -10,7 +10,15 @@ import requests
 from azure.storage.queue import QueueClient, TextBase64EncodePolicy
 from shared_code.status_log import StatusLog, State, StatusClassification, PromptLog # New
 from shared_code.utilities import Utilities, MediaType
+from shared_code.rate_limiter import QuotaExhausted, MemoryQuotaStore, CosmosQuotaStore
+from shared_code.backoff_policy import BackoffPolicy, get_retry_after
+import math
 import random
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from azure.core.exceptions import ResourceNotFoundError
+from shared_code.queue_fanout import get_queue_client
+from shared_code.llm_cache import get_cache_key
 from collections import namedtuple
 import time
 from requests.exceptions import RequestException
@@ -39,6 +47,8 @@ cosmosdb_url = os.environ["COSMOSDB_URL"]
 cosmosdb_key = os.environ["COSMOSDB_KEY"]
 cosmosdb_log_database_name = os.environ["COSMOSDB_LOG_DATABASE_NAME"]
 cosmosdb_log_container_name = os.environ["COSMOSDB_LOG_CONTAINER_NAME"]
+# Skip checking the Cosmos DB databases and containers exist when they were provisioned with the deployment
+cosmosdb_provisioned = string_to_bool(os.environ.get("COSMOSDB_PROVISIONED", "false"))
 non_pdf_submit_queue = os.environ["NON_PDF_SUBMIT_QUEUE"]
 pdf_polling_queue = os.environ["PDF_POLLING_QUEUE"]
 pdf_submit_queue = os.environ["PDF_SUBMIT_QUEUE"]
@@ -49,6 +59,8 @@ api_version = os.environ["FR_API_VERSION"]
 max_submit_requeue_count = int(os.environ["MAX_SUBMIT_REQUEUE_COUNT"])
 max_polling_requeue_count = int(os.environ["MAX_POLLING_REQUEUE_COUNT"])
 submit_requeue_hide_seconds = int(os.environ["SUBMIT_REQUEUE_HIDE_SECONDS"])
+# Longest a throttled message is requeued for when the service gives no Retry-After
+max_requeue_backoff_seconds = int(os.environ.get("MAX_REQUEUE_BACKOFF_SECONDS", "600"))
 polling_backoff = int(os.environ["POLLING_BACKOFF"])
 max_read_attempts = int(os.environ["MAX_READ_ATTEMPTS"])
 enableDevCode = string_to_bool(os.environ["ENABLE_DEV_CODE"])
@@ -59,6 +71,7 @@ max_seconds_hide_on_upload = int(os.environ["MAX_SECONDS_HIDE_ON_UPLOAD"])
 # New
 cosmosdb_prompt_database_name = os.environ["COSMOSDB_PROMPT_DATABASE_NAME"] #Prompt config
 cosmosdb_prompt_container_name = os.environ["COSMOSDB_PROMPT_CONTAINER_NAME"] #Prompt config
+prompt_cache_ttl = int(os.environ.get("PROMPT_CACHE_TTL_SECONDS", "300")) # Seconds a prompt is cached for before checking it has not changed, 0 disables the cache
 cosmosdb_prompt_output_database_name = os.environ["COSMOSDB_PROMPT_OUTPUT_DATABASE_NAME"] #Prompt outputs
 cosmosdb_prompt_output_container_name = os.environ["COSMOSDB_PROMPT_OUTPUT_CONTAINER_NAME"] #Prompt outputs
 azure_openai_endpoint = os.environ["AZURE_OPENAI_ENDPOINT"]
@@ -69,26 +82,108 @@ azure_openai_temperature = os.environ["AZURE_OPENAI_TEMPERATURE"]
 azure_openai_top_p = os.environ["AZURE_OPENAI_TOP_P"]
 azure_openai_max_tokens = os.environ["AZURE_OPENAI_MAX_TOKENS"]
 azure_openai_system_message = os.environ["AZURE_OPENAI_SYSTEM_MESSAGE"]
+# Tokens / requests per minute budget of each endpoint, pipe separated in the same order as AZURE_OPENAI_ENDPOINT. Empty disables the quota scheduler
+azure_openai_tpm_limit = os.environ.get("AZURE_OPENAI_TPM_LIMIT", "")
+azure_openai_rpm_limit = os.environ.get("AZURE_OPENAI_RPM_LIMIT", "")
+# Where the quota budget is kept, cosmos to share it across instances (log container) or memory for a single instance
+azure_openai_quota_store = os.environ.get("AZURE_OPENAI_QUOTA_STORE", "cosmos")
+# Seconds between syncs of the quota charged by this instance with the budget in the quota store
+azure_openai_quota_sync_seconds = float(os.environ.get("AZURE_OPENAI_QUOTA_SYNC_SECONDS", "5"))
+# Size of the connection pool kept by the shared blob client
+blob_connection_pool_size = int(os.environ.get("BLOB_CONNECTION_POOL_SIZE", "32"))
+# Format chunk and output json files are written in, one of json_indent, json or json_gzip
+output_format = os.environ.get("OUTPUT_FORMAT", "json_indent")
+# Number of chunk messages processed concurrently by one invocation, the triggering message plus ones pulled from the chunks queue. 1 processes only the triggering message
+run_llm_prompt_batch_size = int(os.environ.get("RUN_LLM_PROMPT_BATCH_SIZE", "1"))
+# Seconds chunk messages pulled by an invocation stay hidden from other workers while they are processed
+run_llm_prompt_batch_visibility_timeout = int(os.environ.get("RUN_LLM_PROMPT_BATCH_VISIBILITY_TIMEOUT", "300"))
+# Deliveries after which a pulled chunk message is moved to the poison queue, as host.json maxDequeueCount does for triggering messages
+max_dequeue_count = int(os.environ.get("MAX_DEQUEUE_COUNT", "3"))
+# When enabled, completions are cached by a hash of the request and an identical request reuses the cached completion instead of calling AOAI
+llm_response_cache = string_to_bool(os.environ.get("LLM_RESPONSE_CACHE", "false"))
+# Local disk folder of the LLM response cache on each worker, defaults to the temp folder
+llm_response_cache_local_dir = os.environ.get("LLM_RESPONSE_CACHE_LOCAL_DIR", "")
+# Most megabytes the LLM response cache keeps on each worker's local disk, the least recently used completions are removed beyond it. 0 disables the local copy
+llm_response_cache_local_max_mb = float(os.environ.get("LLM_RESPONSE_CACHE_LOCAL_MAX_MB", "256"))
+# When enabled, LLM outputs leave out the merged content and keep only the essential parts of the completions response
+compact_llm_output = string_to_bool(os.environ.get("COMPACT_LLM_OUTPUT", "false"))
 
 
 function_name = "RunLLMPrompt"
-utilities = Utilities(azure_blob_storage_account, azure_blob_storage_endpoint, azure_blob_drop_storage_container, azure_blob_content_storage_container, azure_blob_storage_key)
+utilities = Utilities(azure_blob_storage_account, azure_blob_storage_endpoint, azure_blob_drop_storage_container, azure_blob_content_storage_container, azure_blob_storage_key, blob_connection_pool_size,
+                      output_format=output_format, compact_llm_output=compact_llm_output)
 FR_MODEL = "prebuilt-layout"
+chunk_backoff_policy = BackoffPolicy(submit_requeue_hide_seconds, max_requeue_backoff_seconds)
+
+if azure_openai_quota_store == "memory":
+    quota_store = MemoryQuotaStore()
+else:
+    quota_store = CosmosQuotaStore(cosmosdb_url, cosmosdb_key, cosmosdb_log_database_name, cosmosdb_log_container_name, cosmosdb_provisioned)
+quota_scheduler = utilities.create_quota_scheduler(azure_openai_endpoint, azure_openai_deployment_id, azure_openai_tpm_limit, azure_openai_rpm_limit, quota_store,
+                                                 azure_openai_quota_sync_seconds)
+
+llm_cache = utilities.create_llm_response_cache(llm_response_cache_local_dir or None, int(llm_response_cache_local_max_mb * 2**20)) if llm_response_cache else None
+
+# Session shared by every call to Azure OpenAI, keeping a connection open for each chunk processed concurrently
+aoai_session = requests.Session()
+aoai_session.mount("https://", HTTPAdapter(pool_connections=max(10, run_llm_prompt_batch_size), pool_maxsize=max(10, run_llm_prompt_batch_size)))
 
 
 def main(msg: func.QueueMessage) -> None:
     '''This function is triggerred by message in the chunks-queue.
     The queue message contains merged chunk file blob uri. This function applies the default prompt to the merged chunk text and saves the output in CosmosDB.
     The default prompt is taken from the the CosmosDB.
+    When RUN_LLM_PROMPT_BATCH_SIZE is more than 1, further chunk messages are pulled from the chunks-queue and processed concurrently with the triggering one.
     '''
+    message_body = msg.get_body().decode('utf-8')
+    if run_llm_prompt_batch_size <= 1:
+        process_chunk_message(message_body)
+        return
+
+    # Pull up to batch size - 1 more messages, hidden from other workers while this invocation processes them
+    queue_client = get_queue_client(azure_blob_connection_string, chunks_queue, blob_connection_pool_size)
+    pulled_messages = list(queue_client.receive_messages(messages_per_page=min(32, run_llm_prompt_batch_size - 1),
+                                                         max_messages=run_llm_prompt_batch_size - 1,
+                                                         visibility_timeout=run_llm_prompt_batch_visibility_timeout))
+
+    with ThreadPoolExecutor(max_workers=1 + len(pulled_messages), thread_name_prefix="run_llm_prompt") as executor:
+        futures = [executor.submit(process_chunk_message, message_body)]
+        futures += [executor.submit(process_pulled_message, queue_client, pulled_message) for pulled_message in pulled_messages]
+    # The triggering message is completed by the host, so its error (if any) is raised as if it was processed alone
+    futures[0].result()
+
+
+def process_pulled_message(queue_client, pulled_message):
+    """ Function to process a chunk message pulled from the chunks queue and delete it once processed.
+    A message whose processing fails is left on the queue, to be delivered again once its visibility timeout expires. """
+    try:
+        if pulled_message.dequeue_count > max_dequeue_count:
+            logging.error(f'{function_name} - chunk message {pulled_message.id} delivered {pulled_message.dequeue_count} times, moving it to the poison queue')
+            poison_queue_client = get_queue_client(azure_blob_connection_string, f'{chunks_queue}-poison', blob_connection_pool_size)
+            try:
+                poison_queue_client.send_message(pulled_message.content)
+            except ResourceNotFoundError:
+                poison_queue_client.create_queue()
+                poison_queue_client.send_message(pulled_message.content)
+        elif not process_chunk_message(pulled_message.content):
+            logging.error(f'{function_name} - chunk message {pulled_message.id} failed and will be delivered again')
+            return
+        queue_client.delete_message(pulled_message)
+    except Exception as e:
+        logging.error(f'{function_name} - chunk message {pulled_message.id} failed and will be delivered again - {str(e)}')
+
+
+def process_chunk_message(message_body):
+    ''' Function to apply the prompt to the merged chunk of one chunks-queue message.
+    Returns False when an error was logged for the chunk rather than it being processed, throttled or skipped '''
     
+    succeeded = True
     try:
-        statusLog = StatusLog(cosmosdb_url, cosmosdb_key, cosmosdb_log_database_name, cosmosdb_log_container_name)
-        promptLog = PromptLog(cosmosdb_url, cosmosdb_key, cosmosdb_prompt_database_name, cosmosdb_prompt_container_name)
+        statusLog = StatusLog(cosmosdb_url, cosmosdb_key, cosmosdb_log_database_name, cosmosdb_log_container_name, cosmosdb_provisioned)
+        promptLog = PromptLog(cosmosdb_url, cosmosdb_key, cosmosdb_prompt_database_name, cosmosdb_prompt_container_name, cosmosdb_provisioned, prompt_cache_ttl)
         
 
         # Receive message from the queue
-        message_body = msg.get_body().decode('utf-8')
         message_json = json.loads(message_body)
         blob_name =  message_json['blob_name']
         blob_uri =  message_json['blob_uri']        
@@ -99,7 +194,11 @@ def main(msg: func.QueueMessage) -> None:
         submit_queued_count = message_json["submit_queued_count"]
         chunk_queued_count = message_json["chunk_queued_count"]
         prompt_id = message_json["prompt_id"]
-       
+
+        # A chunk queued again when an interrupted fan-out resumed may have been processed already
+        if statusLog.is_chunk_complete(blob_name, chunk_name, FR_resultId):
+            logging.info(f'{function_name} - chunk {chunk_name} has already been processed, skipping')
+            return True
         
         # statusLog.upsert_document(blob_name, f'{function_name} - Message received from chunks-queue attempt {chunk_queued_count}', StatusClassification.DEBUG, State.PROCESSING)        
         # statusLog.upsert_document(blob_name, f'{function_name} - Call to Azure OpenAI endpoint started for chunk {chunk_name}', StatusClassification.INFO)
@@ -146,9 +245,31 @@ def main(msg: func.QueueMessage) -> None:
         input_text = blob_content_json["merged_content"]
         # print(f'input_text:{input_text}')
 
+        # Reuse the completion of an identical request made before, skipping the call to AOAI
+        if llm_cache is not None:
+            llm_cache_key = get_cache_key(azure_openai_system_message, prompt, input_text, azure_openai_deployment_id,
+                                          azure_openai_temperature, azure_openai_top_p, azure_openai_max_tokens)
+            cached_response_json = llm_cache.get(llm_cache_key)
+            if cached_response_json is not None:
+                save_llm_output(statusLog, message_json, blob_content_json, user_id, cached_response_json, cached = True)
+                statusLog.flush()
+                return True
+
         # Submit request to AOAI chat completion endpoint (REST)
-        # Retrieve a random endpoint to spread the workload across multiple deployments
-        aoai_endpoint, aoai_key, aoai_deployment_id = utilities.get_aoai_endpoint(azure_openai_endpoint, azure_openai_key, azure_openai_deployment_id)
+        # Estimated cost of the request: the prompt and system message, the merged chunk and the most the completion can use
+        estimated_tokens = utilities.num_tokens_from_string(azure_openai_system_message + prompt + "\ninput text:", "cl100k_base") + blob_content_json["token_count"] + int(azure_openai_max_tokens)
+
+        # Retrieve a random endpoint to spread the workload across multiple deployments, or the one with the most quota headroom when limits are set
+        try:
+            aoai_endpoint, aoai_key, aoai_deployment_id = utilities.get_aoai_endpoint(azure_openai_endpoint, azure_openai_key, azure_openai_deployment_id,
+                                                                                      quota_scheduler, estimated_tokens)
+        except QuotaExhausted as e:
+            # No endpoint has the budget for this chunk yet, hold it back until one will rather than calling into a 429
+            visibility_timeout = math.ceil(e.retry_after)
+            requeue_chunk(message_json, visibility_timeout)
+            statusLog.create_chunk_log_entry(blob_name,chunk_blob_uri,chunk_name,State.THROTTLED, f'{function_name} - Azure OpenAI quota exhausted, re-queued, visible in {visibility_timeout} seconds')
+            statusLog.flush()
+            return True
 
         # Expected format: https://{your-resource-name}.openai.azure.com/openai/deployments/{deployment-id}/chat/completions?api-version={api-version}
         # endpoint = f'{azure_openai_endpoint}/openai/deployments/{azure_openai_deployment_id}/chat/completions?api-version={azure_openai_api_version}'
@@ -172,7 +293,9 @@ def main(msg: func.QueueMessage) -> None:
 
         # print(f'data:{data}')
 
-        response = requests.post(endpoint, headers=headers, json=data)
+        response = aoai_session.post(endpoint, headers=headers, json=data)
+        if quota_scheduler is not None:
+            update_quota(aoai_endpoint, aoai_deployment_id, estimated_tokens, response)
         # print(f'response.status_code:{response.status_code}')
         # print(f'response:{response.content}')
         # statusLog.create_chunk_log_entry(blob_name,chunk_blob_uri,chunk_name,State.PROCESSING, f'{function_name} - request submitted to AOAI')        
@@ -185,28 +308,10 @@ def main(msg: func.QueueMessage) -> None:
             # statusLog.create_chunk_log_entry(blob_name,chunk_blob_uri,chunk_name,State.PROCESSING, f'{function_name} - status_code 200. response_json:{response_json}')
 
             if response_json["choices"][0]["finish_reason"] == 'stop':
-                llm_output = response_json["choices"][0]["message"]["content"]
-                llm_completion_tokens = response_json["usage"]["completion_tokens"]
-                llm_prompt_tokens = response_json["usage"]["prompt_tokens"]
-                llm_total_tokens = response_json["usage"]["total_tokens"]
-                # print(f'llm_output:{llm_output}, llm_completion_tokens:{llm_completion_tokens}, llm_prompt_tokens:{llm_prompt_tokens}, llm_total_tokens:{llm_total_tokens}')
-                
-                # Save outputs to storage account
-                llm_output_name, llm_output_blob_uri = utilities.write_llm_output(blob_name, blob_uri, blob_content_json["token_count"], blob_content_json["merged_content"], blob_content_json["pages"],
-                                            blob_content_json["merged_file_names"], blob_content_json["merged_file_uris"], blob_content_json["file_class"], 
-                                            chunk_name, chunk_blob_uri, prompt_id, response_json, output_content_dir = "llm")
-                
-                # print(f'llm_output_name:{llm_output_name}, llm_output_blob_uri:{llm_output_blob_uri}')
-
-                # Save outputs to CosmosDB
-                statusLog.create_llm_output_entry(blob_name, chunk_blob_uri, chunk_name, llm_output, llm_output_name, user_id, prompt_id, llm_completion_tokens, llm_prompt_tokens, llm_total_tokens)
-                
-                # statusLog.upsert_document(blob_name, f'{function_name} - Call to Azure OpenAI endpoint completed for chunk {chunk_name}, outputs saved. llm_completion_tokens: {llm_completion_tokens}, llm_prompt_tokens: {llm_prompt_tokens}, llm_total_tokens: {llm_total_tokens}', StatusClassification.INFO)
-                statusLog.create_chunk_log_entry(blob_name,chunk_blob_uri,chunk_name,State.COMPLETE, f'{function_name} - llm_completion_tokens: {llm_completion_tokens}, llm_prompt_tokens: {llm_prompt_tokens}, llm_total_tokens: {llm_total_tokens}')
-                
-                # If all chunks are processed, mark document processing complete
-                statusLog.mark_document_processing_complete(blob_name)
-                
+                # Cache the completion so an identical request made later reuses it
+                if llm_cache is not None:
+                    llm_cache.put(llm_cache_key, response_json)
+                save_llm_output(statusLog, message_json, blob_content_json, user_id, response_json)
 
             elif response_json["choices"][0]["finish_reason"] == 'content_filter':
                 # statusLog.upsert_document(blob_name, f"{function_name} - An error occurred, AOAI returned status code {response.status_code} with finish_reason = content_filter, input_text: {input_text}, response: {str(response.content)}", StatusClassification.DEBUG, State.PROCESSING)
@@ -217,16 +322,14 @@ def main(msg: func.QueueMessage) -> None:
 
         # Re-queue
         elif response.status_code == 429:
-            # unexpected status returned by FR, such as internal capacity overload, so requeue
+            # throttled by the AOAI endpoint, so requeue for as long as it asked, or with a jittered backoff when it gave no Retry-After
             if chunk_queued_count < max_submit_requeue_count:
                 # statusLog.upsert_document(blob_name, f'{function_name} - 429 response from Azure OpenAI endpoint - code: {response.status_code}, response.content: {response.content}. Request will be resubmitted', StatusClassification.ERROR)                  
-                queue_client = QueueClient.from_connection_string(azure_blob_connection_string, chunks_queue, message_encode_policy=TextBase64EncodePolicy())  
-                chunk_queued_count += 1
-                message_json["chunk_queued_count"] = chunk_queued_count
-                message_string = json.dumps(message_json)    
-                queue_client.send_message(message_string, visibility_timeout = submit_requeue_hide_seconds)  
+                backoff = chunk_backoff_policy.schedule(message_json, "chunk_queued_count", response.headers)
+                chunk_queued_count = message_json["chunk_queued_count"]
+                requeue_chunk(message_json, backoff)
                 # statusLog.upsert_document(blob_name, f'{function_name} chunk {chunk_name} resent to chunks queue. Visible in {submit_requeue_hide_seconds} seconds', StatusClassification.DEBUG, State.THROTTLED)      
-                statusLog.create_chunk_log_entry(blob_name,chunk_blob_uri,chunk_name,State.THROTTLED, f'{function_name} - Re-queued, chunk_queued_count {chunk_queued_count},visible in {submit_requeue_hide_seconds} seconds')
+                statusLog.create_chunk_log_entry(blob_name,chunk_blob_uri,chunk_name,State.THROTTLED, f'{function_name} - Re-queued, chunk_queued_count {chunk_queued_count},visible in {backoff} seconds')
             else:
                 # statusLog.upsert_document(blob_name, f'{function_name} - maximum submissions to Azure OpenAI endpoint reached', StatusClassification.ERROR, State.ERROR)
                 statusLog.create_chunk_log_entry(blob_name,chunk_blob_uri,chunk_name,State.ERROR, f'{function_name} - maximum submissions to Azure OpenAI endpoint reached')
@@ -241,9 +344,64 @@ def main(msg: func.QueueMessage) -> None:
         # a general error 
         # statusLog.upsert_document(blob_name, f"{function_name} - An error occurred - {str(e)}", StatusClassification.ERROR, State.ERROR)
         statusLog.create_chunk_log_entry(blob_name,chunk_blob_uri,chunk_name,State.ERROR, f'{function_name} - An error occurred in python code, str(e) - {str(e)}, message_json:{json.dumps(message_json)}')
-        
+        succeeded = False
         
     # statusLog.save_document(blob_name)
+    # Write the chunk log and llm output entries buffered during this invocation
+    statusLog.flush()
+    return succeeded
+
+
+def save_llm_output(statusLog, message_json, blob_content_json, user_id, response_json, cached = False):
+    """ Function to save a completion of a chunk to storage and CosmosDB and count the chunk as processed """
+    blob_name = message_json['blob_name']
+    blob_uri = message_json['blob_uri']
+    chunk_name = message_json["chunk_name"]
+    chunk_blob_uri = message_json['chunk_blob_uri']
+    FR_resultId = message_json['FR_resultId']
+    prompt_id = message_json["prompt_id"]
+
+    llm_output = response_json["choices"][0]["message"]["content"]
+    llm_completion_tokens = response_json["usage"]["completion_tokens"]
+    llm_prompt_tokens = response_json["usage"]["prompt_tokens"]
+    llm_total_tokens = response_json["usage"]["total_tokens"]
+    # print(f'llm_output:{llm_output}, llm_completion_tokens:{llm_completion_tokens}, llm_prompt_tokens:{llm_prompt_tokens}, llm_total_tokens:{llm_total_tokens}')
+    
+    # Save outputs to storage account
+    llm_output_name, llm_output_blob_uri = utilities.write_llm_output(blob_name, blob_uri, blob_content_json["token_count"], blob_content_json["merged_content"], blob_content_json["pages"],
+                                blob_content_json.get("merged_file_names", []), blob_content_json.get("merged_file_uris", []), blob_content_json["file_class"], 
+                                chunk_name, chunk_blob_uri, prompt_id, response_json, output_content_dir = "llm", cached = cached)
+    
+    # print(f'llm_output_name:{llm_output_name}, llm_output_blob_uri:{llm_output_blob_uri}')
+
+    # Save outputs to CosmosDB
+    statusLog.create_llm_output_entry(blob_name, chunk_blob_uri, chunk_name, llm_output, llm_output_name, user_id, prompt_id, llm_completion_tokens, llm_prompt_tokens, llm_total_tokens, cached)
+    
+    # statusLog.upsert_document(blob_name, f'{function_name} - Call to Azure OpenAI endpoint completed for chunk {chunk_name}, outputs saved. llm_completion_tokens: {llm_completion_tokens}, llm_prompt_tokens: {llm_prompt_tokens}, llm_total_tokens: {llm_total_tokens}', StatusClassification.INFO)
+    statusLog.create_chunk_log_entry(blob_name,chunk_blob_uri,chunk_name,State.COMPLETE, f'{function_name} - {"cached, " if cached else ""}llm_completion_tokens: {llm_completion_tokens}, llm_prompt_tokens: {llm_prompt_tokens}, llm_total_tokens: {llm_total_tokens}')
+    
+    # Count the chunk as processed, marking document processing complete once all chunks are
+    statusLog.record_chunk_complete(blob_name, chunk_name, FR_resultId)
+
+
+def requeue_chunk(message_json, visibility_timeout):
+    """ Function to send the chunk message back to the chunks queue, visible after visibility_timeout seconds """
+    queue_client = QueueClient.from_connection_string(azure_blob_connection_string, chunks_queue, message_encode_policy=TextBase64EncodePolicy())
+    queue_client.send_message(json.dumps(message_json), visibility_timeout = visibility_timeout)
+
+
+def update_quota(aoai_endpoint, aoai_deployment_id, estimated_tokens, response):
+    """ Function to correct the quota charged for a request once its response is known """
+    endpoint_name = utilities.get_aoai_endpoint_name(aoai_endpoint, aoai_deployment_id)
+    if response.status_code == 429:
+        # Hold the endpoint back for as long as it asked, so other endpoints take the traffic meanwhile
+        retry_after = get_retry_after(response.headers)
+        quota_scheduler.penalize(endpoint_name, submit_requeue_hide_seconds if retry_after is None else retry_after)
+    elif response.status_code == 200:
+        quota_scheduler.settle(endpoint_name, estimated_tokens, response.json().get("usage", {}).get("total_tokens", estimated_tokens))
+    else:
+        # Failed requests do not use tokens
+        quota_scheduler.settle(endpoint_name, estimated_tokens, 0)
 
 
 @retry(stop=stop_after_attempt(max_read_attempts), wait=wait_fixed(5))
@@ -4,12 +4,15 @@
 import json
 import logging
 import os
-import random
+import time
 import azure.functions as func
 import requests
 from azure.storage.queue import QueueClient, TextBase64EncodePolicy
 from shared_code.status_log import State, StatusClassification, StatusLog
 from shared_code.utilities import Utilities
+from shared_code.endpoint_router import get_endpoint_router
+from shared_code.backoff_policy import BackoffPolicy, get_backoff_key, get_retry_after
+from shared_code.polling_scheduler import PollingScheduler
 
 azure_blob_storage_account = os.environ["BLOB_STORAGE_ACCOUNT"]
 azure_blob_storage_endpoint = os.environ["BLOB_STORAGE_ACCOUNT_ENDPOINT"]
@@ -25,6 +28,8 @@ cosmosdb_url = os.environ["COSMOSDB_URL"]
 cosmosdb_key = os.environ["COSMOSDB_KEY"]
 cosmosdb_log_database_name = os.environ["COSMOSDB_LOG_DATABASE_NAME"]
 cosmosdb_log_container_name = os.environ["COSMOSDB_LOG_CONTAINER_NAME"]
+# Skip checking the Cosmos DB databases and containers exist when they were provisioned with the deployment
+cosmosdb_provisioned = os.environ.get("COSMOSDB_PROVISIONED", "false").lower() == "true"
 pdf_polling_queue = os.environ["PDF_POLLING_QUEUE"]
 pdf_submit_queue = os.environ["PDF_SUBMIT_QUEUE"]
 endpoint = os.environ["AZURE_FORM_RECOGNIZER_ENDPOINT"]
@@ -33,6 +38,13 @@ api_version = os.environ["FR_API_VERSION"]
 max_submit_requeue_count = int(os.environ["MAX_SUBMIT_REQUEUE_COUNT"])
 poll_queue_submit_backoff = int(os.environ["POLL_QUEUE_SUBMIT_BACKOFF"])
 pdf_submit_queue_backoff = int(os.environ["PDF_SUBMIT_QUEUE_BACKOFF"])
+# Longest wait before the first poll of a large document
+max_polling_backoff_seconds = int(os.environ.get("MAX_POLLING_BACKOFF_SECONDS", "300"))
+# Longest a throttled message is requeued for when the service gives no Retry-After
+max_requeue_backoff_seconds = int(os.environ.get("MAX_REQUEUE_BACKOFF_SECONDS", "600"))
+# Consecutive 429 / 5xx responses after which a Document Intelligence endpoint is rested, and for how many seconds at first
+doc_intel_circuit_failure_threshold = int(os.environ.get("DOC_INTEL_CIRCUIT_FAILURE_THRESHOLD", "3"))
+doc_intel_circuit_cooldown_seconds = int(os.environ.get("DOC_INTEL_CIRCUIT_COOLDOWN_SECONDS", "30"))
 
 
 utilities = Utilities(
@@ -44,6 +56,13 @@ utilities = Utilities(
 )
 FUNCTION_NAME = "SubmitToDocumentIntel"
 FR_MODEL = "prebuilt-layout"
+submit_backoff_policy = BackoffPolicy(pdf_submit_queue_backoff, max_requeue_backoff_seconds)
+polling_scheduler = PollingScheduler(poll_queue_submit_backoff, max_polling_backoff_seconds)
+doc_intel_router = get_endpoint_router(
+    endpoint,
+    failure_threshold=doc_intel_circuit_failure_threshold,
+    cooldown_seconds=doc_intel_circuit_cooldown_seconds,
+)
 
 
 def main(msg: func.QueueMessage) -> None:
@@ -56,7 +75,7 @@ def main(msg: func.QueueMessage) -> None:
     blob_path = message_json["blob_name"]
     try:
         statusLog = StatusLog(
-            cosmosdb_url, cosmosdb_key, cosmosdb_log_database_name, cosmosdb_log_container_name
+            cosmosdb_url, cosmosdb_key, cosmosdb_log_database_name, cosmosdb_log_container_name, cosmosdb_provisioned
         )
 
         # Receive message from the queue
@@ -83,8 +102,8 @@ def main(msg: func.QueueMessage) -> None:
         )
         logging.info("Generated BLOB SAS")
 
-        # Retrieve a random endpoint to spread the workload across multiple deployments
-        idx, doc_intel_endpoint_list, doc_intel_key_list = utilities.get_document_intel_endpoint(endpoint, FR_key)
+        # Retrieve an endpoint to spread the workload across multiple deployments, favouring healthy and fast ones
+        idx, doc_intel_endpoint_list, doc_intel_key_list = utilities.get_document_intel_endpoint(endpoint, FR_key, doc_intel_router)
 
         # Construct and submmit the message to FR
         headers = {
@@ -106,7 +125,18 @@ def main(msg: func.QueueMessage) -> None:
         logging.info(f"Submitting to FR with url: {url}, headers: {headers}, params: {params}, body: {body}")
 
         # Send the HTTP POST request with headers, query parameters, and request body
-        response = requests.post(url, headers=headers, params=params, json=body)
+        start_time = time.monotonic()
+        try:
+            response = requests.post(url, headers=headers, params=params, json=body)
+        except requests.exceptions.RequestException:
+            doc_intel_router.record(idx, None)
+            raise
+        doc_intel_router.record(
+            idx,
+            response.status_code,
+            time.monotonic() - start_time,
+            get_retry_after(response.headers),
+        )
 
         # Check if the request was successful (status code 200)
         if response.status_code == 202:
@@ -120,6 +150,14 @@ def main(msg: func.QueueMessage) -> None:
             message_json["FR_resultId"] = result_id
             message_json["FR_API_List_idx"] = idx # New. To ensure same API gets used while polling in next function
             message_json["polling_queue_count"] = 1
+            # Submission is done and polling starts afresh, so neither builds on an earlier backoff
+            message_json.pop(get_backoff_key("submit_queued_count"), None)
+            message_json.pop(get_backoff_key("polling_queue_count"), None)
+            # First poll when the result is predicted to be ready, from the document size and recent turnaround
+            polling_scheduler.refresh(statusLog.read_doc_intel_turnaround_history)
+            poll_backoff = polling_scheduler.first_poll_delay(
+                message_json.get("page_count"), message_json.get("file_size")
+            )
             queue_client = QueueClient.from_connection_string(
                 azure_blob_connection_string,
                 queue_name=pdf_polling_queue,
@@ -127,25 +165,22 @@ def main(msg: func.QueueMessage) -> None:
             )
             message_json_str = json.dumps(message_json)
             queue_client.send_message(
-                message_json_str, visibility_timeout=poll_queue_submit_backoff
+                message_json_str, visibility_timeout=poll_backoff
             )
             statusLog.upsert_document(
                 blob_path,
-                f"{FUNCTION_NAME} - message sent to pdf-polling-queue. Visible in {poll_queue_submit_backoff} seconds. FR Result ID is {result_id}",
+                f"{FUNCTION_NAME} - message sent to pdf-polling-queue. Visible in {poll_backoff} seconds. FR Result ID is {result_id}",
                 StatusClassification.DEBUG,
                 State.QUEUED,
             )
 
         elif response.status_code == 429:
-            # throttled, so requeue with random backoff seconds to mitigate throttling,
-            # unless it has hit the max tries
+            # throttled, so requeue for as long as FR asked, or with a jittered backoff
+            # when it gave no Retry-After, unless it has hit the max tries
             if queued_count < max_submit_requeue_count:
-                max_seconds = pdf_submit_queue_backoff * (queued_count**2)
-                backoff = random.randint(
-                    pdf_submit_queue_backoff * queued_count, max_seconds
+                backoff = submit_backoff_policy.schedule(
+                    message_json, "submit_queued_count", response.headers
                 )
-                queued_count += 1
-                message_json["queued_count"] = queued_count
                 statusLog.upsert_document(
                     blob_path,
                     f"{FUNCTION_NAME} - Throttled on PDF submission to FR, requeuing. Back off of {backoff} seconds",
@@ -0,0 +1,50 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Downloads the nltk punkt sentence tokenizer and the tiktoken cl100k_base BPE files to the models folder, so they are
+deployed with the function app and loaded from disk rather than downloaded on each cold start.
+
+Run from the azure_functions directory before publishing, e.g.
+
+    python scripts/download_models.py
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared_code.utilities import MODELS_DIR
+
+ENCODING_NAMES = ["cl100k_base"]
+
+
+def download_punkt(nltk_data_dir):
+    import nltk
+    if not nltk.download('punkt', download_dir=nltk_data_dir, raise_on_error=True):
+        raise Exception("Failed to download 'punkt' package")
+
+
+def download_encodings(tiktoken_cache_dir, encoding_names):
+    # tiktoken saves the files it downloads to TIKTOKEN_CACHE_DIR, named as it looks them up again
+    os.environ["TIKTOKEN_CACHE_DIR"] = tiktoken_cache_dir
+    import tiktoken
+    for encoding_name in encoding_names:
+        tiktoken.get_encoding(encoding_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download the nltk and tiktoken models to deploy with the function app")
+    parser.add_argument("--models-dir", default=MODELS_DIR, help="Folder to download to, shared_code loads them from the default")
+    parser.add_argument("--encoding", action="append", dest="encoding_names", help="tiktoken encodings to download, cl100k_base when omitted")
+    args = parser.parse_args()
+
+    nltk_data_dir = os.path.join(args.models_dir, "nltk_data")
+    tiktoken_cache_dir = os.path.join(args.models_dir, "tiktoken_cache")
+    download_punkt(nltk_data_dir)
+    download_encodings(tiktoken_cache_dir, args.encoding_names or ENCODING_NAMES)
+    print(f"punkt saved to {nltk_data_dir}, {', '.join(args.encoding_names or ENCODING_NAMES)} saved to {tiktoken_cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
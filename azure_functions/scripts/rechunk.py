@@ -0,0 +1,184 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Re-chunks documents from their stored Document Intelligence output, without submitting them to Document Intelligence again.
+
+Run from the azure_functions directory, e.g.
+
+    python scripts/rechunk.py --prefix user1/202403111240/ --merged-chunk-target-size 3000 --enqueue
+
+Settings are read from local.settings.json, environment variables take precedence.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared_code.utilities import Utilities
+from shared_code.status_log import StatusLog, State, StatusClassification
+from shared_code.queue_fanout import QueueFanout, get_queue_client
+
+DOC_INTEL_OUTPUT_DIR = "/doc_intel_response/"
+
+utilities = None
+settings = None
+
+
+def load_settings(settings_path):
+    """ Function to return the function app settings, from local.settings.json overridden by environment variables """
+    values = {}
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            values = json.load(f).get("Values", {})
+    values = {key: str(value) for key, value in values.items()}
+    values.update(os.environ)
+    return values
+
+
+def create_utilities(values):
+    return Utilities(values["BLOB_STORAGE_ACCOUNT"], values["BLOB_STORAGE_ACCOUNT_ENDPOINT"],
+                     values["BLOB_STORAGE_ACCOUNT_UPLOAD_CONTAINER_NAME"], values["BLOB_STORAGE_ACCOUNT_OUTPUT_CONTAINER_NAME"],
+                     values["AZURE_BLOB_STORAGE_KEY"], int(values.get("BLOB_CONNECTION_POOL_SIZE", "32")),
+                     output_format=values.get("OUTPUT_FORMAT", "json_indent"))
+
+
+def init_worker(values):
+    """ Creates the clients once per worker process """
+    global utilities, settings
+    settings = values
+    utilities = create_utilities(values)
+
+
+def list_doc_intel_outputs(utilities, prefix):
+    """ Generator of the stored Document Intelligence output paths under a prefix of the output container """
+    container_client = utilities.get_blob_service_client().get_container_client(utilities.azure_blob_content_storage_container)
+    for blob in container_client.list_blobs(name_starts_with=prefix):
+        if DOC_INTEL_OUTPUT_DIR in blob.name and blob.name.endswith("_doc_intel.json"):
+            yield blob.name
+
+
+def delete_chunks(utilities, source_path):
+    """ Deletes the chunks and merged chunks written by an earlier run, as a smaller run would leave some of them behind """
+    file_name = os.path.splitext(os.path.basename(source_path))[0]
+    chunk_pattern = re.compile(rf'{re.escape(source_path)}/(merged/)?{re.escape(file_name)}-\d+\.json')
+    container_client = utilities.get_blob_service_client().get_container_client(utilities.azure_blob_content_storage_container)
+    stale_chunks = [blob.name for blob in container_client.list_blobs(name_starts_with=source_path + "/")
+                    if chunk_pattern.fullmatch(blob.name)]
+    for blob_name in stale_chunks:
+        container_client.delete_blob(blob_name)
+    return len(stale_chunks)
+
+
+def rechunk(doc_intel_output_path):
+    """ Re-chunks one document in a worker process, returns its chunk counts and merged chunk paths or the error raised """
+    source_path = doc_intel_output_path.split(DOC_INTEL_OUTPUT_DIR)[0]
+    blob_name = f"{utilities.azure_blob_drop_storage_container}/{source_path}"
+    blob_uri = f"{utilities.azure_blob_storage_endpoint}{utilities.azure_blob_drop_storage_container}/{source_path}"
+    try:
+        response_json = json.loads(utilities.read_blob_content(f"{utilities.azure_blob_content_storage_container}/{doc_intel_output_path}", blob_uri))
+        delete_chunks(utilities, source_path)
+
+        document_map = utilities.build_document_map_pdf(blob_name, blob_uri, response_json["analyzeResult"],
+                                                         settings["BLOB_STORAGE_ACCOUNT_LOG_CONTAINER_NAME"],
+                                                         settings.get("ENABLE_DEV_CODE", "false").lower() == "true")
+        with utilities.create_blob_uploader(int(settings.get("BLOB_UPLOAD_CONCURRENCY", "8"))) as uploader:
+            chunk_count, chunk_outputs = utilities.build_chunks(document_map, blob_name, blob_uri, int(settings["CHUNK_TARGET_SIZE"]), uploader,
+                                                                settings.get("PERSIST_GRANULAR_CHUNKS", "true").lower() == "true")
+            merged_chunk_count, merged_chunk_paths = utilities.build_merged_chunks(chunk_outputs, blob_name, blob_uri,
+                                                                                   int(settings["MERGED_CHUNK_TARGET_SIZE"]), uploader)
+    except Exception as err:
+        return blob_name, blob_uri, None, None, None, str(err)
+    return blob_name, blob_uri, chunk_count, merged_chunk_count, merged_chunk_paths, None
+
+
+def enqueue_chunks(values, statusLog, fanout, blob_name, blob_uri, chunk_count, merged_chunk_count, merged_chunk_paths, prompt_id):
+    """ Queues the merged chunks of a document for RunLLMPrompt as a new run, the same way PollDocumentIntelChunk does """
+    # A new run id, so chunks completed in an earlier run are processed again
+    run_id = f"rechunk-{uuid.uuid4()}"
+    max_seconds_hide_on_upload = int(values["MAX_SECONDS_HIDE_ON_UPLOAD"])
+
+    statusLog.upsert_document(blob_name, 'Pipeline triggered by re-chunking', StatusClassification.INFO, State.PROCESSING, True)
+    for chunk_path in merged_chunk_paths:
+        message = {
+            "blob_name": blob_name,
+            "blob_uri": blob_uri,
+            "submit_queued_count": "1",
+            "FR_resultId": run_id,
+            "polling_queue_count": "1",
+            "chunk_name": f"{chunk_path[0]}",
+            "chunk_blob_uri": f"{chunk_path[1]}",
+            "chunk_queued_count": 1,
+            "prompt_id": prompt_id
+        }
+        fanout.send(chunk_path[0], json.dumps(message), visibility_timeout=random.randint(1, max_seconds_hide_on_upload))
+    fanout.wait()
+    statusLog.upsert_document(blob_name, f'rechunk - {merged_chunk_count} merged chunks sent to chunks queue, prompt_id {prompt_id}.', StatusClassification.DEBUG, State.QUEUED, False, chunk_count, merged_chunk_count)
+    statusLog.save_document(blob_name)
+    statusLog.mark_document_processing_complete(blob_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-chunk documents from their stored Document Intelligence output")
+    parser.add_argument("--prefix", default="", help="Path prefix in the output container of the documents to re-chunk, all documents when omitted")
+    parser.add_argument("--chunk-target-size", type=int, help="Overrides CHUNK_TARGET_SIZE")
+    parser.add_argument("--merged-chunk-target-size", type=int, help="Overrides MERGED_CHUNK_TARGET_SIZE")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--enqueue", action="store_true", help="Queue the merged chunks for RunLLMPrompt")
+    parser.add_argument("--prompt-id", help="prompt_id of the queued chunks, the prompt_id set on each uploaded document when omitted")
+    parser.add_argument("--settings", default="local.settings.json", help="Settings file to read")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    values = load_settings(args.settings)
+    if args.chunk_target_size is not None:
+        values["CHUNK_TARGET_SIZE"] = str(args.chunk_target_size)
+    if args.merged_chunk_target_size is not None:
+        values["MERGED_CHUNK_TARGET_SIZE"] = str(args.merged_chunk_target_size)
+
+    main_utilities = create_utilities(values)
+    doc_intel_output_paths = list(list_doc_intel_outputs(main_utilities, args.prefix))
+    print(f"{len(doc_intel_output_paths)} documents to re-chunk with CHUNK_TARGET_SIZE {values['CHUNK_TARGET_SIZE']}, MERGED_CHUNK_TARGET_SIZE {values['MERGED_CHUNK_TARGET_SIZE']}")
+
+    statusLog = fanout = None
+    if args.enqueue:
+        statusLog = StatusLog(values["COSMOSDB_URL"], values["COSMOSDB_KEY"], values["COSMOSDB_LOG_DATABASE_NAME"], values["COSMOSDB_LOG_CONTAINER_NAME"],
+                              values.get("COSMOSDB_PROVISIONED", "false").lower() == "true")
+        fanout = QueueFanout(get_queue_client(values["BLOB_CONNECTION_STRING"], values["CHUNKS_QUEUE"]), int(values.get("CHUNK_QUEUE_CONCURRENCY", "16")))
+
+    start = time.time()
+    document_count = chunk_count_total = merged_chunk_count_total = 0
+    failed = []
+    # Workers are spawned rather than forked, so they do not share the connections of this process
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(values,)) as executor:
+        for blob_name, blob_uri, chunk_count, merged_chunk_count, merged_chunk_paths, error in executor.map(rechunk, doc_intel_output_paths, chunksize=4):
+            if error is not None:
+                logging.error(f"{blob_name} - {error}")
+                failed.append(blob_name)
+                continue
+            if fanout is not None:
+                prompt_id = args.prompt_id or main_utilities.get_blob_metadata(blob_name, blob_uri).get("prompt_id", "default")
+                enqueue_chunks(values, statusLog, fanout, blob_name, blob_uri, chunk_count, merged_chunk_count, merged_chunk_paths, prompt_id)
+            document_count += 1
+            chunk_count_total += chunk_count
+            merged_chunk_count_total += merged_chunk_count
+    if fanout is not None:
+        fanout.close()
+
+    print(f"Re-chunked {document_count} documents into {chunk_count_total} chunks and {merged_chunk_count_total} merged chunks in {time.time() - start:.1f} seconds"
+          + (", merged chunks queued" if args.enqueue else ""))
+    if failed:
+        print(f"{len(failed)} documents failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
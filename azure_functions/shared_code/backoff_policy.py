@@ -0,0 +1,77 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Backoff policy shared by the queue triggered functions when they requeue a throttled message """
+import math
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+# Longest a queue message can be hidden for (7 days)
+MAX_VISIBILITY_TIMEOUT = 7 * 24 * 60 * 60
+# Suffix of the key holding the delay of the previous requeue in the queue message, which the next delay builds on.
+# Each attempt counter gets its own, as one message is requeued to several queues with different policies
+BACKOFF_KEY = "backoff_seconds"
+
+def get_backoff_key(count_key):
+    """ Function to return the key of the message holding the previous delay of the attempts counted in count_key """
+    return f"{count_key}_{BACKOFF_KEY}"
+
+def get_retry_after(headers):
+    """ Function to return the seconds a service asked the caller to wait in its response headers, None when it gave no hint.
+    Understands retry-after-ms / x-ms-retry-after-ms and Retry-After given in seconds or as an HTTP date. """
+    if not headers:
+        return None
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            try:
+                return max(0.0, float(value) / 1000)
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class BackoffPolicy:
+    """ Works out how long a requeued message stays hidden.
+
+    When the service said when to come back, the message is hidden for exactly that long plus up to
+    hint_jitter of it, so retries spread out without any landing before capacity returns. Otherwise the delay
+    uses decorrelated jitter: a random delay between base_seconds and three times the previous delay, capped
+    at max_seconds.
+    """
+
+    def __init__(self, base_seconds, max_seconds=600, hint_jitter=0.1):
+        self.base_seconds = max(1, base_seconds)
+        self.max_seconds = max(self.base_seconds, max_seconds)
+        self.hint_jitter = hint_jitter
+
+    def next_delay(self, previous_delay=None, headers=None):
+        """ Function to return the whole seconds to hide the message for """
+        retry_after = get_retry_after(headers)
+        if retry_after is not None:
+            delay = math.ceil(retry_after) + random.randint(0, int(retry_after * self.hint_jitter))
+            return min(MAX_VISIBILITY_TIMEOUT, max(1, delay))
+
+        previous_delay = max(self.base_seconds, previous_delay or self.base_seconds)
+        delay = min(self.max_seconds, random.uniform(self.base_seconds, previous_delay * 3))
+        return max(1, math.ceil(delay))
+
+    def schedule(self, message_json, count_key, headers=None):
+        """ Function to count another attempt in message_json[count_key] and return the delay to requeue message_json with.
+        The delay is kept in the message next to count_key so the next requeue counted in it builds on it. """
+        backoff_key = get_backoff_key(count_key)
+        delay = self.next_delay(message_json.get(backoff_key), headers)
+        message_json[count_key] = int(message_json.get(count_key, 1)) + 1
+        message_json[backoff_key] = delay
+        return delay
@@ -0,0 +1,78 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Library of code for uploading many blobs concurrently """
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tenacity import Retrying, stop_after_attempt, wait_exponential
+
+class BlobUploader:
+    """ Uploads blobs to a container on a bounded thread pool.
+
+    Each blob is retried on its own, so a transient failure only repeats that one upload.
+    submit() blocks once max_pending uploads are in flight, which keeps the payloads held
+    in memory bounded when a large document is chunked.
+    """
+
+    def __init__(self, blob_service_client, container, max_concurrency=8, max_attempts=5, max_pending=None):
+        self.blob_service_client = blob_service_client
+        self.container = container
+        self.max_attempts = max_attempts
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="blob_upload")
+        self._pending = threading.BoundedSemaphore(max_pending or max_concurrency * 4)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(wait=exc_type is None)
+
+    def submit(self, blob_path, payload, **kwargs):
+        """ Queues payload to be uploaded to blob_path, returns the future of the upload """
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(self._upload, blob_path, payload, **kwargs)
+        except Exception:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        self._futures.append(future)
+        return future
+
+    def upload_all(self, items, **kwargs):
+        """ Uploads an iterable of (blob_path, payload) pairs, waits for them to complete and returns the blob paths """
+        blob_paths = []
+        for blob_path, payload in items:
+            self.submit(blob_path, payload, **kwargs)
+            blob_paths.append(blob_path)
+        self.wait()
+        return blob_paths
+
+    def wait(self):
+        """ Waits for every submitted upload, raising the first error once all have finished """
+        futures, self._futures = self._futures, []
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            logging.error(f"{len(errors)} of {len(futures)} blob uploads failed")
+            raise errors[0]
+        return len(futures)
+
+    def close(self, wait=True):
+        """ Waits for outstanding uploads if asked to, then stops the worker threads """
+        try:
+            if wait:
+                self.wait()
+        finally:
+            self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def _upload(self, blob_path, payload, **kwargs):
+        block_blob_client = self.blob_service_client.get_blob_client(container=self.container, blob=blob_path)
+        for attempt in Retrying(stop=stop_after_attempt(self.max_attempts),
+                                wait=wait_exponential(multiplier=0.5, max=10),
+                                reraise=True):
+            with attempt:
+                block_blob_client.upload_blob(payload, overwrite=True, **kwargs)
+        return blob_path
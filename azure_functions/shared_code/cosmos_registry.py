@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Process wide registry of Cosmos DB clients and container handles, shared by the status, prompt and tag logs """
+import logging
+import threading
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
+
+_cosmos_clients = {}
+_containers = {}
+_lock = threading.Lock()
+
+def get_cosmos_client(url, key):
+    """ Function to return the CosmosClient for an account, created once per process """
+    client = _cosmos_clients.get((url, key))
+    if client is None:
+        with _lock:
+            client = _cosmos_clients.get((url, key))
+            if client is None:
+                client = CosmosClient(url=url, credential=key)
+                _cosmos_clients[(url, key)] = client
+    return client
+
+def get_container(url, key, database_name, container_name, partition_key_path, on_create=None, provisioned=False):
+    """ Function to return a container handle, created once per process.
+    The database and container are created if they do not exist, which is checked once per process
+    unless provisioned is True. on_create is called with the container when this process created it. """
+    container = _containers.get((url, key, database_name, container_name))
+    if container is None:
+        with _lock:
+            container = _containers.get((url, key, database_name, container_name))
+            if container is None:
+                client = get_cosmos_client(url, key)
+                database = client.get_database_client(database_name)
+                container = database.get_container_client(container_name)
+                if not provisioned:
+                    container = _create_if_not_exists(client, database_name, container, container_name, partition_key_path, on_create)
+                _containers[(url, key, database_name, container_name)] = container
+    return container
+
+def _create_if_not_exists(client, database_name, container, container_name, partition_key_path, on_create):
+    try:
+        container.read()
+        return container
+    except exceptions.CosmosResourceNotFoundError:
+        pass
+
+    logging.info(f"Creating Cosmos DB container {database_name}/{container_name}")
+    database = client.create_database_if_not_exists(database_name)
+    try:
+        container = database.create_container(id=container_name, partition_key=PartitionKey(path=partition_key_path))
+    except exceptions.CosmosResourceExistsError:
+        # created by another worker in the meantime
+        return database.get_container_client(container_name)
+    if on_create is not None:
+        on_create(container)
+    return container
@@ -0,0 +1,96 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Health and latency aware selection between a list of service endpoints """
+import random
+import threading
+import time
+
+class EndpointHealth:
+    """ Outcomes and latency observed for one endpoint, with its circuit breaker state """
+
+    def __init__(self):
+        self.latency = None
+        self.success_rate = 1.0
+        self.consecutive_failures = 0
+        self.open_until = 0
+
+
+class EndpointRouter:
+    """ Picks endpoints by index, weighted toward the ones that are healthy and fast.
+
+    Each endpoint keeps an exponentially weighted moving average (EWMA) of its latency and success rate.
+    A 429 or 5xx opens the endpoint's circuit once failure_threshold failures happen in a row, or straight away
+    when the response gives a Retry-After. An open endpoint is skipped until its cool-down ends, which doubles with
+    each further failure up to max_cooldown_seconds. After the cool-down a single probe request is let through and
+    its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, endpoint_count, alpha=0.2, failure_threshold=3, cooldown_seconds=30, max_cooldown_seconds=300):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.health = [EndpointHealth() for _ in range(endpoint_count)]
+        self._lock = threading.Lock()
+
+    def select(self):
+        """ Function to return the index of the endpoint to send the next request to """
+        with self._lock:
+            now = time.time()
+            available = [idx for idx, health in enumerate(self.health) if health.open_until <= now]
+            if not available:
+                # Every circuit is open, use the endpoint that recovers first
+                return min(range(len(self.health)), key=lambda i: self.health[i].open_until)
+
+            latencies = [self.health[idx].latency for idx in available if self.health[idx].latency is not None]
+            default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+            weights = [max(self.health[idx].success_rate, 0.01) / (self.health[idx].latency or default_latency)
+                       for idx in available]
+            idx = random.choices(available, weights=weights)[0]
+
+            health = self.health[idx]
+            if health.consecutive_failures >= self.failure_threshold:
+                # Half open: let this request probe the endpoint and keep others away until it reports back
+                health.open_until = now + self.cooldown_seconds
+            return idx
+
+    def record(self, idx, status_code, latency=None, retry_after=None):
+        """ Function to record the outcome of a request sent to endpoint idx.
+        status_code is None when the request failed without a response. """
+        with self._lock:
+            health = self.health[idx]
+            failed = status_code is None or status_code == 429 or status_code >= 500
+            health.success_rate += self.alpha * ((0.0 if failed else 1.0) - health.success_rate)
+            if latency is not None and not failed:
+                health.latency = latency if health.latency is None else health.latency + self.alpha * (latency - health.latency)
+
+            if not failed:
+                health.consecutive_failures = 0
+                health.open_until = 0
+                return
+
+            health.consecutive_failures += 1
+            cooldown = 0
+            if health.consecutive_failures >= self.failure_threshold:
+                cooldown = min(self.max_cooldown_seconds,
+                               self.cooldown_seconds * 2 ** (health.consecutive_failures - self.failure_threshold))
+            if retry_after is not None:
+                cooldown = max(cooldown, retry_after)
+            health.open_until = max(health.open_until, time.time() + cooldown) if cooldown else health.open_until
+
+
+_routers = {}
+_lock = threading.Lock()
+
+def get_endpoint_router(endpoints, **kwargs):
+    """ Function to return the EndpointRouter for a pipe separated list of endpoints, created once per process
+    so the health observed by one invocation is used by the next """
+    router = _routers.get(endpoints)
+    if router is None:
+        with _lock:
+            router = _routers.get(endpoints)
+            if router is None:
+                router = EndpointRouter(len([e for e in endpoints.split('|') if e != '']), **kwargs)
+                _routers[endpoints] = router
+    return router
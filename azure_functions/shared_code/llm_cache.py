@@ -0,0 +1,133 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Content addressed cache of Azure OpenAI completions, in blob storage with a local disk tier """
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from azure.core.exceptions import ResourceNotFoundError
+
+# Most the local disk tier holds on each worker, the least recently used completions are removed beyond it
+DEFAULT_LOCAL_MAX_BYTES = 256 * 2**20
+# Fraction of the local limit the local disk tier is brought down to when it is over it
+LOCAL_EVICT_FRACTION = 0.8
+
+def get_cache_key(system_message, prompt, merged_content, deployment_id, temperature, top_p, max_tokens):
+    """ Function to return the hash of everything that determines a completion """
+    request = [system_message, prompt, merged_content, deployment_id, float(temperature), float(top_p), int(max_tokens)]
+    return hashlib.sha256(json.dumps(request, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    """ Completions responses stored under their cache key.
+
+    Responses are written to blob storage under prefix, shared by every worker, and to local_dir on the worker.
+    Lookups try the local disk first. The local disk tier keeps up to local_max_bytes, removing the least recently
+    used responses beyond it, and is not used when local_max_bytes is 0. The cache is best effort, errors reading
+    or writing it are logged and treated as a miss.
+    """
+
+    def __init__(self, blob_service_client, container, local_dir=None, prefix="llm_cache", local_max_bytes=DEFAULT_LOCAL_MAX_BYTES):
+        self.blob_service_client = blob_service_client
+        self.container = container
+        self.local_dir = local_dir or os.path.join(tempfile.gettempdir(), prefix)
+        self.prefix = prefix
+        self.local_max_bytes = local_max_bytes
+        # Bytes held in local_dir, counted on the first local write and kept up to date by this process
+        self._local_bytes = None
+        self._local_lock = threading.Lock()
+
+    def _blob_path(self, key):
+        return f"{self.prefix}/{key[:2]}/{key}.json"
+
+    def _local_path(self, key):
+        return os.path.join(self.local_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """ Function to return the cached response for key, None when there is none """
+        if self.local_max_bytes:
+            local_path = self._local_path(key)
+            try:
+                with open(local_path, 'rb') as f:
+                    response_json = json.loads(f.read())
+                # Marks the response as recently used, so it is among the last removed
+                os.utime(local_path)
+                return response_json
+            except (OSError, ValueError):
+                pass
+
+        try:
+            blob_client = self.blob_service_client.get_blob_client(container=self.container, blob=self._blob_path(key))
+            payload = blob_client.download_blob().readall()
+            response_json = json.loads(payload)
+        except ResourceNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Unable to read cached completion {key}: {str(e)}")
+            return None
+        self._write_local(key, payload)
+        return response_json
+
+    def put(self, key, response_json):
+        """ Function to cache a response under key """
+        payload = json.dumps(response_json).encode('utf-8')
+        self._write_local(key, payload)
+        try:
+            blob_client = self.blob_service_client.get_blob_client(container=self.container, blob=self._blob_path(key))
+            blob_client.upload_blob(payload, overwrite=True)
+        except Exception as e:
+            logging.warning(f"Unable to cache completion {key}: {str(e)}")
+
+    def _write_local(self, key, payload):
+        if not self.local_max_bytes:
+            return
+        local_path = self._local_path(key)
+        try:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            # Written under a temporary name first so concurrent readers never see a partial file
+            temp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_path, local_path)
+        except OSError as e:
+            logging.warning(f"Unable to cache completion {key} on local disk: {str(e)}")
+            return
+
+        with self._local_lock:
+            if self._local_bytes is None:
+                self._local_bytes = sum(size for _, _, size in self._list_local())
+            else:
+                self._local_bytes += len(payload)
+            if self._local_bytes > self.local_max_bytes:
+                self._evict_local()
+
+    def _list_local(self):
+        """ Function to return the modification time, path and size of each response on local disk """
+        local_files = []
+        for directory, _, file_names in os.walk(self.local_dir):
+            for file_name in file_names:
+                if not file_name.endswith('.json'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(directory, file_name))
+                except OSError:
+                    continue
+                local_files.append((stat.st_mtime, os.path.join(directory, file_name), stat.st_size))
+        return local_files
+
+    def _evict_local(self):
+        """ Function to remove the least recently used responses on local disk until it holds LOCAL_EVICT_FRACTION of its limit.
+        Other processes on the worker share local_dir, so its content is listed again rather than tracked """
+        local_files = sorted(self._list_local())
+        self._local_bytes = sum(size for _, _, size in local_files)
+        for _, path, size in local_files:
+            if self._local_bytes <= self.local_max_bytes * LOCAL_EVICT_FRACTION:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._local_bytes -= size
@@ -0,0 +1,116 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Schedule for polling Document Intelligence, predicted from the size of the document and past turnaround """
+import logging
+import math
+import re
+import statistics
+import threading
+import time
+from datetime import datetime, timezone
+
+# Model used until enough turnaround history has been recorded
+DEFAULT_BASE_SECONDS = 5.0
+DEFAULT_SECONDS_PER_PAGE = 1.0
+DEFAULT_BYTES_PER_PAGE = 100000
+# Fewest recorded documents the model is fitted from
+MIN_HISTORY_SAMPLES = 5
+
+_page_pattern = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+_count_pattern = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b")
+
+def estimate_page_count(content):
+    """ Function to estimate the number of pages of a PDF from its bytes, without parsing it.
+    Returns None when the page objects are compressed and cannot be counted this way. """
+    counts = [int(a or b) for a, b in _count_pattern.findall(content)]
+    page_count = max(counts) if counts else len(_page_pattern.findall(content))
+    return page_count or None
+
+def get_elapsed_seconds(response_json, completed=False):
+    """ Function to return the seconds since an analyze operation was created, up to its last update when completed.
+    Returns None when the response does not carry the timestamps. """
+    try:
+        created = datetime.fromisoformat(response_json["createdDateTime"].replace("Z", "+00:00"))
+        if completed:
+            until = datetime.fromisoformat(response_json["lastUpdatedDateTime"].replace("Z", "+00:00"))
+        else:
+            until = datetime.now(timezone.utc)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return max(0.0, (until - created).total_seconds())
+
+
+class PollingScheduler:
+    """ Works out when to poll Document Intelligence for an analyze result.
+
+    Turnaround is predicted as base_seconds + seconds_per_page * pages, fitted by least squares to the
+    turnaround of recent documents (see refresh).
+    When the page count is not known it is estimated from the file size. The first poll is made when the
+    result is predicted to be ready. A document that overruns its prediction is polled again after a
+    quarter of the time it has already taken, so long documents are not polled more often than they need.
+    """
+
+    def __init__(self, min_seconds, max_seconds, history_ttl=600):
+        self.min_seconds = max(1, min_seconds)
+        self.max_seconds = max(self.min_seconds, max_seconds)
+        self.history_ttl = history_ttl
+        self.base_seconds = DEFAULT_BASE_SECONDS
+        self.seconds_per_page = DEFAULT_SECONDS_PER_PAGE
+        self.bytes_per_page = DEFAULT_BYTES_PER_PAGE
+        self._history_loaded = None
+        self._lock = threading.Lock()
+
+    def refresh(self, history_loader):
+        """ Function to refit the model from the history returned by history_loader, at most once every history_ttl seconds """
+        with self._lock:
+            if self._history_loaded is not None and time.time() - self._history_loaded < self.history_ttl:
+                return
+            self._history_loaded = time.time()
+            try:
+                self.fit(history_loader())
+            except Exception as e:
+                logging.warning(f"Unable to load Document Intelligence turnaround history, keeping the current model: {str(e)}")
+
+    def fit(self, history):
+        """ Function to fit the model to a list of dicts with page_count, file_size and turnaround_seconds """
+        samples = [h for h in history if h.get("page_count") and h.get("turnaround_seconds") is not None]
+        if len(samples) < MIN_HISTORY_SAMPLES:
+            return
+        pages = [h["page_count"] for h in samples]
+        seconds = [h["turnaround_seconds"] for h in samples]
+        mean_pages = statistics.fmean(pages)
+        mean_seconds = statistics.fmean(seconds)
+        variance = sum((p - mean_pages) ** 2 for p in pages)
+        if variance > 0:
+            slope = sum((p - mean_pages) * (s - mean_seconds) for p, s in zip(pages, seconds)) / variance
+            self.seconds_per_page = max(0.0, slope)
+        else:
+            self.seconds_per_page = max(0.0, mean_seconds / mean_pages)
+        self.base_seconds = max(0.0, mean_seconds - self.seconds_per_page * mean_pages)
+        sizes = [h["file_size"] / h["page_count"] for h in samples if h.get("file_size")]
+        if sizes:
+            self.bytes_per_page = max(1, statistics.median(sizes))
+
+    def predict_turnaround(self, page_count=None, file_size=None):
+        """ Function to return the seconds Document Intelligence is expected to take for a document """
+        if not page_count:
+            page_count = max(1, file_size / self.bytes_per_page) if file_size else 1
+        return self.base_seconds + self.seconds_per_page * page_count
+
+    def first_poll_delay(self, page_count=None, file_size=None):
+        """ Function to return the seconds to wait after submission before the first poll """
+        return self._clamp(self.predict_turnaround(page_count, file_size))
+
+    def next_poll_delay(self, elapsed, page_count=None, file_size=None, retry_after=None):
+        """ Function to return the seconds to wait before polling a result that is still running, elapsed seconds
+        after submission. A Retry-After given by the service is never undercut. """
+        remaining = self.predict_turnaround(page_count, file_size) - elapsed
+        delay = remaining if remaining > 0 else elapsed / 4
+        delay = self._clamp(delay)
+        if retry_after is not None:
+            delay = max(delay, math.ceil(retry_after))
+        return delay
+
+    def _clamp(self, delay):
+        return int(min(self.max_seconds, max(self.min_seconds, math.ceil(delay))))
@@ -0,0 +1,128 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Library of code for sending many queue messages concurrently, resumable after a failure part way """
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy, TextBase64DecodePolicy
+from tenacity import Retrying, stop_after_attempt, wait_exponential
+
+DEFAULT_QUEUE_CONNECTION_POOL_SIZE = 32
+_queue_clients = {}
+_lock = threading.Lock()
+
+def get_queue_client(connection_string, queue_name, connection_pool_size=DEFAULT_QUEUE_CONNECTION_POOL_SIZE):
+    """ Function to return the QueueClient for a queue, created on first use and reused for the life of the process """
+    client = _queue_clients.get((connection_string, queue_name))
+    if client is None:
+        with _lock:
+            client = _queue_clients.get((connection_string, queue_name))
+            if client is None:
+                # requests keeps up to pool_maxsize connections per host, size it for concurrent sends
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=connection_pool_size, pool_maxsize=connection_pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                client = QueueClient.from_connection_string(connection_string, queue_name,
+                                                            message_encode_policy=TextBase64EncodePolicy(),
+                                                            message_decode_policy=TextBase64DecodePolicy(),
+                                                            transport=RequestsTransport(session=session, session_owner=False))
+                _queue_clients[(connection_string, queue_name)] = client
+    return client
+
+
+class QueueFanout:
+    """ Sends messages to a queue on a bounded thread pool.
+
+    Each message is sent under a key (such as the chunk name) and retried on its own. Keys in sent are
+    skipped, and checkpoint is called with the keys sent so far every checkpoint_every messages and when
+    the fan-out is closed, even after a failure. Passing the last checkpoint back in as sent resumes an
+    interrupted fan-out without sending its messages again; only the messages sent after the last checkpoint
+    (at most checkpoint_every plus the ones in flight) can be sent twice.
+    """
+
+    def __init__(self, queue_client, max_concurrency=16, max_attempts=5, sent=None, checkpoint=None, checkpoint_every=50):
+        self.queue_client = queue_client
+        self.max_attempts = max_attempts
+        self.sent = set(sent or [])
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.skipped_count = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="queue_fanout")
+        self._pending = threading.BoundedSemaphore(max_concurrency * 4)
+        self._futures = []
+        self._sent_lock = threading.Lock()
+        self._checkpointed_count = len(self.sent)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(wait=exc_type is None)
+
+    def send(self, key, message, visibility_timeout=None):
+        """ Queues message to be sent under key, returns False when key was already sent """
+        with self._sent_lock:
+            if key in self.sent:
+                self.skipped_count += 1
+                return False
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(self._send, key, message, visibility_timeout)
+        except Exception:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        self._futures.append(future)
+        if len(self.sent) - self._checkpointed_count >= self.checkpoint_every:
+            self._checkpoint()
+        return True
+
+    def wait(self):
+        """ Waits for every message queued so far, raising the first error once all have finished """
+        futures, self._futures = self._futures, []
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        self._checkpoint()
+        if errors:
+            logging.error(f"{len(errors)} of {len(futures)} queue messages failed to send")
+            raise errors[0]
+        return len(futures)
+
+    def close(self, wait=True):
+        """ Waits for outstanding messages if asked to, records the progress, then stops the worker threads """
+        try:
+            if wait:
+                self.wait()
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=not wait)
+            if not wait:
+                self._checkpoint()
+
+    def _checkpoint(self):
+        if self.checkpoint is None:
+            return
+        with self._sent_lock:
+            sent = sorted(self.sent)
+        if len(sent) == self._checkpointed_count:
+            return
+        try:
+            self.checkpoint(sent)
+            self._checkpointed_count = len(sent)
+        except Exception as e:
+            # A missed checkpoint only means more messages may be sent again on resume
+            logging.warning(f"Unable to record queue fan-out progress: {str(e)}")
+
+    def _send(self, key, message, visibility_timeout):
+        for attempt in Retrying(stop=stop_after_attempt(self.max_attempts),
+                                wait=wait_exponential(multiplier=0.5, max=10),
+                                reraise=True):
+            with attempt:
+                self.queue_client.send_message(message, visibility_timeout=visibility_timeout)
+        with self._sent_lock:
+            self.sent.add(key)
+        return key
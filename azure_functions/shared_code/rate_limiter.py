@@ -0,0 +1,329 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Token bucket quota scheduler spreading Azure OpenAI calls across endpoints within their TPM / RPM budgets """
+import copy
+import logging
+import threading
+import time
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+from shared_code.cosmos_registry import get_container
+
+QUOTA_DOCUMENT_ID = "aoai_quota"
+# Seconds between syncs of the charges made in a process with the shared budget
+DEFAULT_QUOTA_SYNC_SECONDS = 5.0
+# Fraction of an endpoint's budget charged in a process that triggers a sync before the interval is up
+DEFAULT_QUOTA_SYNC_FRACTION = 0.1
+
+class QuotaExhausted(Exception):
+    """ Raised when no endpoint has the budget to admit a request, retry_after is the seconds until one will """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Azure OpenAI quota exhausted on all endpoints, retry after {retry_after:.1f} seconds")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """ Bucket holding up to capacity units, refilled continuously at capacity per period seconds.
+    A capacity of 0 means the budget is not limited. """
+
+    def __init__(self, capacity, period=60.0, level=None, updated=None):
+        self.capacity = capacity
+        self.period = period
+        self.level = capacity if level is None else min(level, capacity)
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self, now):
+        """ Function to add the units earned since the bucket was last updated """
+        if self.capacity and now > self.updated:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / self.period)
+        self.updated = max(self.updated, now)
+
+    def wait_time(self, amount):
+        """ Function to return the seconds until amount units are available, requests larger than the bucket wait for a full bucket """
+        if not self.capacity:
+            return 0
+        shortfall = min(amount, self.capacity) - self.level
+        return max(0, shortfall * self.period / self.capacity)
+
+    def take(self, amount):
+        """ Function to remove amount units, the level can go negative when the actual usage exceeded the estimate """
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+    def headroom(self):
+        """ Function to return the fraction of the bucket available """
+        return self.level / self.capacity if self.capacity else 1.0
+
+
+class MemoryQuotaStore:
+    """ Keeps the budget state in the process, for a single instance or local runs """
+
+    def __init__(self):
+        self._state = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def read(self):
+        """ Function to return the budget state and its version """
+        with self._lock:
+            return copy.deepcopy(self._state), self._version
+
+    def write(self, state, version):
+        """ Function to save the budget state if it is unchanged since version was read, returns False otherwise """
+        with self._lock:
+            if version != self._version:
+                return False
+            self._state = copy.deepcopy(state)
+            self._version += 1
+            return True
+
+
+class CosmosQuotaStore:
+    """ Keeps the budget state in one Cosmos DB document shared by every worker instance.
+    Writes are guarded by the document etag, so concurrent updates are retried rather than lost. """
+
+    def __init__(self, url, key, database_name, container_name, provisioned=False, document_id=QUOTA_DOCUMENT_ID):
+        self._url = url
+        self._key = key
+        self._database_name = database_name
+        self._container_name = container_name
+        self._provisioned = provisioned
+        self.document_id = document_id
+        self._container = None
+
+    @property
+    def container(self):
+        # Resolved on first use so building the store does not call Cosmos DB
+        if self._container is None:
+            self._container = get_container(self._url, self._key, self._database_name, self._container_name,
+                                            "/file_name", provisioned=self._provisioned)
+        return self._container
+
+    def read(self):
+        """ Function to return the budget state and its etag, None when the document does not exist yet """
+        try:
+            json_document = self.container.read_item(item=self.document_id, partition_key=self.document_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return {}, None
+        return json_document.get("endpoints", {}), json_document["_etag"]
+
+    def write(self, state, version):
+        """ Function to save the budget state if it is unchanged since version was read, returns False otherwise """
+        json_document = {
+            "id": self.document_id,
+            "file_name": self.document_id,
+            "doc_type": QUOTA_DOCUMENT_ID,
+            "endpoints": state
+        }
+        try:
+            if version is None:
+                self.container.create_item(body=json_document)
+            else:
+                self.container.replace_item(item=self.document_id, body=json_document,
+                                            etag=version, match_condition=MatchConditions.IfNotModified)
+        except (exceptions.CosmosResourceExistsError, exceptions.CosmosAccessConditionFailedError):
+            return False
+        return True
+
+
+class QuotaScheduler:
+    """ Admits Azure OpenAI requests against a tokens per minute and a requests per minute bucket for each endpoint.
+
+    A request is charged its estimated token cost up front and routed to the endpoint with the most headroom
+    left afterwards. settle() corrects the charge once the actual usage is known and penalize() empties an
+    endpoint that returned 429 so traffic moves to the others. The bucket levels live in the store, so every
+    worker instance sharing the store draws from the same budget.
+
+    Charges are made against a copy of the stored budget kept in the process and synced with the store in batches:
+    every sync_interval seconds, once an endpoint has been charged sync_fraction of its budget since the last sync,
+    or right away after a 429. Each instance can so admit up to about that much more than the shared budget between
+    syncs, in exchange for one store round trip per batch rather than several per request.
+    """
+
+    def __init__(self, endpoint_names, tpm_limits, rpm_limits, store, max_attempts=10,
+                 sync_interval=DEFAULT_QUOTA_SYNC_SECONDS, sync_fraction=DEFAULT_QUOTA_SYNC_FRACTION):
+        assert len(endpoint_names) == len(tpm_limits) and len(tpm_limits) == len(rpm_limits)
+        self.endpoint_names = endpoint_names
+        self.limits = {name: (tpm, rpm) for name, tpm, rpm in zip(endpoint_names, tpm_limits, rpm_limits)}
+        self.store = store
+        self.max_attempts = max_attempts
+        self.sync_interval = sync_interval
+        self.sync_fraction = sync_fraction
+        # Budget state as last read from or written to the store, None until the first sync
+        self._state = None
+        self._synced = 0.0
+        # Charges made in this process since the last sync, per endpoint
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def _buckets(self, state, name, now):
+        tpm, rpm = self.limits[name]
+        endpoint_state = state.get(name, {})
+        tokens = TokenBucket(tpm, level=endpoint_state.get("tokens"), updated=endpoint_state.get("updated", now))
+        requests = TokenBucket(rpm, level=endpoint_state.get("requests"), updated=endpoint_state.get("updated", now))
+        tokens.refill(now)
+        requests.refill(now)
+        return tokens, requests, endpoint_state.get("blocked_until", 0)
+
+    def _save_buckets(self, state, name, tokens, requests, blocked_until):
+        state[name] = {"tokens": tokens.level, "requests": requests.level, "updated": tokens.updated,
+                       "blocked_until": blocked_until}
+
+    def _apply_pending(self, tokens, requests, blocked_until, pending):
+        """ Function to apply the charges pending for an endpoint to its buckets, returns blocked_until """
+        if pending is None:
+            return blocked_until
+        tokens.level = min(tokens.capacity, tokens.level - pending.tokens)
+        requests.level = min(requests.capacity, requests.level - pending.requests)
+        if pending.drained:
+            tokens.level = min(tokens.level, 0)
+        return max(blocked_until, pending.blocked_until)
+
+    def _local_buckets(self, name, now):
+        """ Function to return the buckets of an endpoint as this process sees them: the stored budget less the pending charges """
+        tokens, requests, blocked_until = self._buckets(self._state or {}, name, now)
+        blocked_until = self._apply_pending(tokens, requests, blocked_until, self._pending.get(name))
+        return tokens, requests, blocked_until
+
+    def _pending_charge(self, name):
+        pending = self._pending.get(name)
+        if pending is None:
+            pending = self._pending[name] = PendingCharge()
+        return pending
+
+    def _sync_needed(self):
+        """ Function to return True when requests must wait for a sync: before the first one, after a 429 or once an
+        endpoint has been charged sync_fraction of its budget since the last one """
+        if self._state is None:
+            return True
+        for name, pending in self._pending.items():
+            tpm, rpm = self.limits[name]
+            if pending.drained or (tpm and pending.tokens >= tpm * self.sync_fraction) or (rpm and pending.requests >= rpm * self.sync_fraction):
+                return True
+        return False
+
+    def sync(self):
+        """ Function to add the charges made in this process to the stored budget and read the charges made by other instances.
+        Returns False when the store kept changing under it, the charges are then kept for the next sync. """
+        for _ in range(self.max_attempts):
+            state, version = self.store.read()
+            now = time.time()
+            with self._lock:
+                synced_pending = {name: copy.copy(pending) for name, pending in self._pending.items()}
+            for name, pending in synced_pending.items():
+                tokens, requests, blocked_until = self._buckets(state, name, now)
+                blocked_until = self._apply_pending(tokens, requests, blocked_until, pending)
+                self._save_buckets(state, name, tokens, requests, blocked_until)
+            if synced_pending and not self.store.write(state, version):
+                # another worker updated the budget since it was read
+                continue
+            with self._lock:
+                for name, pending in synced_pending.items():
+                    self._pending[name].remove(pending)
+                self._state = state
+                self._synced = now
+            return True
+
+        with self._lock:
+            self._synced = time.time()
+        logging.warning(f"Unable to sync the Azure OpenAI quota after {self.max_attempts} conflicting updates, "
+                        f"keeping the charges of this instance for the next sync")
+        return False
+
+    def _sync_if_due(self):
+        with self._lock:
+            needed = self._sync_needed()
+            due = needed or time.time() - self._synced >= self.sync_interval
+        if not due:
+            return
+        # One thread syncs at a time. When the interval is up the others carry on with the budget as last synced,
+        # when a sync is needed they wait for it and sync again if what they charged meanwhile needs one too
+        if not self._sync_lock.acquire(blocking=needed):
+            return
+        try:
+            with self._lock:
+                due = self._sync_needed() or time.time() - self._synced >= self.sync_interval
+            if due:
+                self.sync()
+        finally:
+            self._sync_lock.release()
+
+    def acquire(self, estimated_tokens):
+        """ Function to charge a request of estimated_tokens to the endpoint with the most headroom and return its name.
+        Raises QuotaExhausted when no endpoint can admit the request yet. """
+        self._sync_if_due()
+        with self._lock:
+            now = time.time()
+            best_name, best_headroom, retry_after = None, None, None
+            for name in self.endpoint_names:
+                tokens, requests, blocked_until = self._local_buckets(name, now)
+                wait = max(tokens.wait_time(estimated_tokens), requests.wait_time(1), blocked_until - now)
+                if wait > 0:
+                    retry_after = wait if retry_after is None else min(retry_after, wait)
+                    continue
+                tokens.take(estimated_tokens)
+                requests.take(1)
+                headroom = min(tokens.headroom(), requests.headroom())
+                if best_headroom is None or headroom > best_headroom:
+                    best_name, best_headroom = name, headroom
+
+            if best_name is None:
+                raise QuotaExhausted(retry_after)
+
+            tpm, rpm = self.limits[best_name]
+            pending = self._pending_charge(best_name)
+            pending.tokens += min(estimated_tokens, tpm)
+            pending.requests += 1 if rpm else 0
+            return best_name
+
+    def settle(self, name, estimated_tokens, used_tokens):
+        """ Function to correct the charge of a request to its actual token usage, synced with the next batch """
+        tpm = self.limits[name][0]
+        if not tpm or used_tokens == estimated_tokens:
+            return True
+        with self._lock:
+            self._pending_charge(name).tokens -= min(estimated_tokens, tpm) - used_tokens
+        return True
+
+    def penalize(self, name, retry_after):
+        """ Function to hold back an endpoint that returned 429 for retry_after seconds, synced right away so other instances back off too """
+        with self._lock:
+            pending = self._pending_charge(name)
+            pending.drained = True
+            pending.blocked_until = max(pending.blocked_until, time.time() + retry_after)
+        self._sync_if_due()
+        return True
+
+
+class PendingCharge:
+    """ Charges made to an endpoint in this process and not yet synced with the store """
+
+    def __init__(self):
+        self.tokens = 0
+        self.requests = 0
+        self.blocked_until = 0
+        self.drained = False
+
+    def remove(self, synced):
+        """ Function to remove the charges of synced, a copy of this taken for a sync, keeping the ones made since """
+        self.tokens -= synced.tokens
+        self.requests -= synced.requests
+        if self.blocked_until == synced.blocked_until:
+            self.blocked_until = 0
+        if synced.drained:
+            self.drained = False
+
+
+def parse_limits(limits, count):
+    """ Function to convert a pipe separated list of limits into one integer per endpoint.
+    A single value applies to every endpoint, an empty value or 0 leaves the endpoint unlimited. """
+    limit_list = [l for l in limits.split('|') if l != '']
+    if len(limit_list) == 0:
+        limit_list = ["0"]
+    if len(limit_list) == 1:
+        limit_list = limit_list * count
+    assert len(limit_list) == count
+    return [int(l) for l in limit_list]
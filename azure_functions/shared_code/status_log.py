@@ -7,8 +7,22 @@ from datetime import datetime, timedelta
 import base64
 from enum import Enum
 import logging
-from azure.cosmos import CosmosClient, PartitionKey, exceptions
+import threading
+import time
+from collections import OrderedDict
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
 import traceback, sys
+from shared_code.cosmos_registry import get_cosmos_client, get_container
+
+# Cosmos DB accepts at most this many operations in a single patch request
+MAX_PATCH_OPERATIONS = 10
+
+# Prompts cached per process by PromptLog.get_prompt, least recently used evicted first
+PROMPT_CACHE_TTL_SECONDS = 300
+PROMPT_CACHE_MAX_ENTRIES = 1024
+_prompt_cache = OrderedDict()
+_prompt_cache_lock = threading.Lock()
 
 class State(Enum):
     """ Enum for state of a process """
@@ -37,26 +51,22 @@ class StatusQueryLevel(Enum):
 class StatusLog:
     """ Class for logging status of various processes to Cosmos DB"""
 
-    def __init__(self, url, key, database_name, container_name):
+    def __init__(self, url, key, database_name, container_name, provisioned=False):
         """ Constructor function """
         self._url = url
         self._key = key
         self._database_name = database_name
         self._container_name = container_name
-        self.cosmos_client = CosmosClient(url=self._url, credential=self._key)
+        self.cosmos_client = get_cosmos_client(self._url, self._key)
         self._log_document = {}
+        # Write-behind buffers: status updates to patch onto stored file logs, and chunk / llm output items to upsert
+        self._log_patch = {}
+        self._pending_items = {}
 
-        # Select a database (will create it if it doesn't exist)
+        # Select a database and container, created if they don't exist (checked once per process unless provisioned)
         self.database = self.cosmos_client.get_database_client(self._database_name)
-        if self._database_name not in [db['id'] for db in self.cosmos_client.list_databases()]:
-            self.database = self.cosmos_client.create_database(self._database_name)
-
-        # Select a container (will create it if it doesn't exist)
-        self.container = self.database.get_container_client(self._container_name)
-        if self._container_name not in [container['id'] for container
-                                        in self.database.list_containers()]:
-            self.container = self.database.create_container(id=self._container_name,
-                partition_key=PartitionKey(path="/file_name"))
+        self.container = get_container(self._url, self._key, self._database_name, self._container_name,
+                                       "/file_name", provisioned=provisioned)
 
     def encode_document_id(self, document_id):
         """ encode a path/file name to remove unsafe chars for a cosmos db id """
@@ -144,6 +154,12 @@ class StatusLog:
             except exceptions.CosmosResourceNotFoundError:
                 pass
 
+        # if the document is not buffered in full, collect the update to patch onto the stored document
+        # when it is saved, rather than reading the whole document now and writing it back
+        if not fresh_start and self._log_document.get(document_id, "") == "":
+            self._buffer_status_patch(document_path, status, status_classification, state, chunk_count, merged_chunk_count)
+            return
+
         json_document = ""
         try:
             # if the document exists and if this is the first call to the function from the parent,
@@ -187,6 +203,7 @@ class StatusLog:
                 "state": str(state.value),
                 "chunk_count": -1, # Will be updated by chunking step
                 "merged_chunk_count": -1, # Will be updated by chunking step
+                "completed_chunk_count": 0, # Incremented as each merged chunk is processed
                 "start_timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
                 "state_description": "",
                 "state_timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
@@ -208,6 +225,7 @@ class StatusLog:
                 "state": str(state.value),
                 "chunk_count": -1, # Will be updated by chunking step
                 "merged_chunk_count": -1,# Will be updated by chunking step
+                "completed_chunk_count": 0, # Incremented as each merged chunk is processed
                 "start_timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
                 "state_description": "",
                 "state_timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
@@ -224,6 +242,89 @@ class StatusLog:
         #self.container.upsert_item(body=json_document)
         self._log_document[document_id] = json_document
 
+    def _buffer_status_patch(self, document_path, status, status_classification, state, chunk_count, merged_chunk_count):
+        """ Buffers a status update for a stored document, to be written as a patch by save_document """
+        document_id = self.encode_document_id(document_path)
+        log_patch = self._log_patch.setdefault(document_id, {
+            "document_path": document_path,
+            "state": None,
+            "state_timestamp": None,
+            "state_changed_only": True,
+            "chunk_count": None,
+            "merged_chunk_count": None,
+            "status_updates": []
+        })
+
+        # The stored state is not read, so the state is patched only where it differs, see _save_status_patch
+        if log_patch["state"] != state.value:
+            log_patch["state"] = state.value
+            log_patch["state_timestamp"] = str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        if chunk_count:
+            log_patch["chunk_count"] = chunk_count
+        if merged_chunk_count:
+            log_patch["merged_chunk_count"] = merged_chunk_count
+
+        new_item = {
+            "status": status,
+            "status_timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+            "status_classification": str(status_classification.value)
+        }
+        if status_classification == StatusClassification.ERROR:
+            new_item["stack_trace"] = self.get_stack_trace()
+        log_patch["status_updates"].append(new_item)
+
+    def _save_status_patch(self, document_path):
+        """ Writes the buffered status updates of a document as patch operations, creating the document if it does not exist """
+        base_name = os.path.basename(document_path)
+        document_id = self.encode_document_id(document_path)
+        log_patch = self._log_patch.pop(document_id)
+
+        state_operations = []
+        if log_patch["state"] is not None:
+            state_operations = [{"op": "set", "path": "/state", "value": log_patch["state"]},
+                                {"op": "set", "path": "/state_timestamp", "value": log_patch["state_timestamp"]}]
+        patch_operations = []
+        for field in ("chunk_count", "merged_chunk_count"):
+            if log_patch[field] is not None:
+                patch_operations.append({"op": "set", "path": f"/{field}", "value": log_patch[field]})
+        for new_item in log_patch["status_updates"]:
+            patch_operations.append({"op": "add", "path": "/status_updates/-", "value": new_item})
+
+        try:
+            if state_operations and log_patch["state_changed_only"]:
+                # The state timestamp only moves when the state changes. The patch setting the state is filtered on
+                # the stored state differing, when it does not the other operations are sent without the state
+                first_operations = patch_operations[:MAX_PATCH_OPERATIONS - len(state_operations)]
+                try:
+                    self.container.patch_item(item=document_id, partition_key=base_name,
+                                              patch_operations=state_operations + first_operations,
+                                              filter_predicate=f"FROM c WHERE c.state != '{log_patch['state']}'")
+                    patch_operations = patch_operations[len(first_operations):]
+                except exceptions.CosmosAccessConditionFailedError:
+                    pass
+            else:
+                patch_operations = state_operations + patch_operations
+            for i in range(0, len(patch_operations), MAX_PATCH_OPERATIONS):
+                self.container.patch_item(item=document_id, partition_key=base_name,
+                                          patch_operations=patch_operations[i:i + MAX_PATCH_OPERATIONS])
+        except exceptions.CosmosResourceNotFoundError:
+            # this is a new document
+            json_document = {
+                "id": document_id,
+                "doc_type": "file_log",
+                "file_path": document_path,
+                "file_name": base_name,
+                "state": log_patch["state"],
+                "chunk_count": log_patch["chunk_count"] or -1, # Will be updated by chunking step
+                "merged_chunk_count": log_patch["merged_chunk_count"] or -1, # Will be updated by chunking step
+                "completed_chunk_count": 0, # Incremented as each merged chunk is processed
+                "start_timestamp": log_patch["status_updates"][0]["status_timestamp"],
+                "state_description": "",
+                "state_timestamp": log_patch["state_timestamp"],
+                "status_updates": log_patch["status_updates"]
+            }
+            self.container.upsert_item(body=json_document)
+
     # Updated, bug fixed
     def update_document_state(self, document_path, state_str):
         """Updates the state of the document in the storage"""
@@ -231,11 +332,21 @@ class StatusLog:
             base_name = os.path.basename(document_path)            
             document_id = self.encode_document_id(document_path)
 
-            # if the document exists and if this is the first call to the function from the parent,
-            # then retrieve the stored document from cosmos, otherwise, use the log stored in self
+            # if the document is not buffered in full, patch the state of the stored document,
+            # together with any status updates still buffered for it
             if self._log_document.get(document_id, "") == "":
-                json_document = self.container.read_item(item=document_id, partition_key=base_name)
-                self._log_document[document_id] = json_document            
+                logging.info(f"{state_str} DocumentID - {document_id}")
+                if document_id in self._log_patch:
+                    self._log_patch[document_id]["state"] = state_str
+                    self._log_patch[document_id]["state_timestamp"] = str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                    self._log_patch[document_id]["state_changed_only"] = False
+                    self._save_status_patch(document_path)
+                else:
+                    self.container.patch_item(item=document_id, partition_key=base_name, patch_operations=[
+                        {"op": "set", "path": "/state", "value": state_str},
+                        {"op": "set", "path": "/state_timestamp", "value": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))}
+                    ])
+                return
 
             logging.info(f"{state_str} DocumentID - {document_id}")
             # document_id = self.encode_document_id(document_path)
@@ -253,9 +364,26 @@ class StatusLog:
     def save_document(self, document_path):
         """Saves the document in the storage"""
         document_id = self.encode_document_id(document_path)
+        if document_id in self._log_patch:
+            self._save_status_patch(document_path)
+            return
+        if not self._log_document.get(document_id):
+            # Already saved and nothing buffered since
+            return
         self.container.upsert_item(body=self._log_document[document_id])
         self._log_document[document_id] = ""
 
+    def flush(self):
+        """ Writes every buffered chunk log, llm output and status update to the storage """
+        pending_items, self._pending_items = self._pending_items, {}
+        for json_data in pending_items.values():
+            self.container.upsert_item(body=json_data)
+        for log_patch in list(self._log_patch.values()):
+            self._save_status_patch(log_patch["document_path"])
+        for document_id, json_document in list(self._log_document.items()):
+            if json_document:
+                self.save_document(json_document["file_path"])
+
     def get_stack_trace(self):
         """ Returns the stack trace of the current exception"""
         exc = sys.exc_info()[0]
@@ -289,11 +417,11 @@ class StatusLog:
 
             # print(f'json_data:{json_data}')
 
-            """Saves the document in the storage"""        
-            self.container.upsert_item(body=json_data)
+            # Buffered until flush(), a later entry for the same chunk replaces this one
+            self._pending_items[document_id] = json_data
 
     # New
-    def create_llm_output_entry(self, file_path, chunk_blob_uri, chunk_name, llm_output, llm_output_file, user_id, prompt_id, llm_completion_tokens, llm_prompt_tokens, llm_total_tokens):
+    def create_llm_output_entry(self, file_path, chunk_blob_uri, chunk_name, llm_output, llm_output_file, user_id, prompt_id, llm_completion_tokens, llm_prompt_tokens, llm_total_tokens, cached = False):
 
             base_name = os.path.basename(file_path)
             document_id = self.encode_document_id(llm_output_file)
@@ -313,127 +441,280 @@ class StatusLog:
                 "llm_completion_tokens": llm_completion_tokens,
                 "llm_prompt_tokens": llm_prompt_tokens,
                 "llm_total_tokens": llm_total_tokens,
+                "cached": cached, # True when the completion was reused from the LLM response cache, no tokens were spent
                 "state_timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))                
             }
 
             # print(f'json_data:{json_data}')
 
-            """Saves the document in the storage"""        
-            self.container.upsert_item(body=json_data)
+            # Buffered until flush(), a later entry for the same chunk replaces this one
+            self._pending_items[document_id] = json_data
 
     # New
+    def record_chunk_complete(self, file_path, chunk_name, run_id = ""):
+        """
+        Function counts a processed chunk against its document and marks the document processing complete once
+        all chunks have been counted. Each chunk is counted once per run (the Document Intelligence result id),
+        however many times its message is delivered, and the cost is the same for every chunk.
+        Returns True if this call marked the document complete.
+        """
+        base_name = os.path.basename(file_path)
+
+        # The marker can only be created once, so a chunk processed again is not counted twice
+        marker_id = self.encode_document_id(f'chunk_complete|{run_id}|{chunk_name}')
+        try:
+            self.container.create_item(body={
+                "id": marker_id,
+                "doc_type": "chunk_complete",
+                "file_path": file_path,
+                "file_name": base_name,
+                "chunk_name": chunk_name,
+                "run_id": run_id,
+                "state_timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            })
+        except exceptions.CosmosResourceExistsError:
+            return False
+
+        try:
+            json_document = self.container.patch_item(item=self.encode_document_id(file_path), partition_key=base_name,
+                                                      patch_operations=[{"op": "incr", "path": "/completed_chunk_count", "value": 1}])
+        except Exception:
+            # Leave the chunk to be counted when it is retried
+            try:
+                self.container.delete_item(item=marker_id, partition_key=base_name)
+            except exceptions.CosmosHttpResponseError:
+                logging.error(f"Could not remove the completion marker of chunk {chunk_name}, it will not be counted again")
+            raise
+
+        return self._complete_if_all_chunks_processed(file_path, json_document)
+
+    def is_chunk_complete(self, file_path, chunk_name, run_id = ""):
+        """ Function to check whether a chunk has already been counted as processed for a run """
+        marker_id = self.encode_document_id(f'chunk_complete|{run_id}|{chunk_name}')
+        try:
+            self.container.read_item(item=marker_id, partition_key=os.path.basename(file_path))
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+        return True
+
+    def read_chunk_fanout_progress(self, file_path, run_id = ""):
+        """ Function to return the names of the chunks already queued for a run, empty when none were recorded """
+        try:
+            json_document = self.container.read_item(item=self.encode_document_id(f'chunk_fanout|{run_id}|{file_path}'),
+                                                     partition_key=os.path.basename(file_path))
+        except exceptions.CosmosResourceNotFoundError:
+            return []
+        return json_document["sent_chunk_names"]
+
+    def save_chunk_fanout_progress(self, file_path, run_id, sent_chunk_names):
+        """ Function to record the names of the chunks queued so far for a run, so an interrupted fan-out can resume """
+        self.container.upsert_item(body={
+            "id": self.encode_document_id(f'chunk_fanout|{run_id}|{file_path}'),
+            "doc_type": "chunk_fanout",
+            "file_path": file_path,
+            "file_name": os.path.basename(file_path),
+            "run_id": run_id,
+            "sent_chunk_names": sent_chunk_names,
+            "state_timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        })
+
+    # Updated
     def mark_document_processing_complete(self,
                        file_path: str ):
         """
         Function checks and then marks document processing complete once all chunks have been processed for the document.
+        Used once the chunk counts are saved, in case every chunk was processed before they were.
         """
 
-        # print(f'In update_document_processing_state(), file_path:{file_path}')        
-        
-        #-------------------------------------------------------------------#
-        # Chunks to be processed (merged_chunk_count)
-        query_string_total_chunk_count = f"SELECT VALUE a.merged_chunk_count FROM a WHERE a.doc_type = 'file_log' and a.file_path = '{file_path}'"        
-        # print(f'query_string_total_chunk_count:{query_string_total_chunk_count}')
-        items = list(self.container.query_items(query=query_string_total_chunk_count,
-                        enable_cross_partition_query=True))
-        # print(f'mark_document_processing_complete() -> items:{items}, type(items):{type(items)}')
-        
-        total_chunk_count = 0
-        if items and len(items) > 0:
-            total_chunk_count = int(items[0])
-
-        #-------------------------------------------------------------------#
-        # Chunks processed so far        
-        query_string_processed_chunk_count = f"SELECT  VALUE COUNT(1) FROM c WHERE c.doc_type = 'chunk_log' AND c.file_path = '{file_path}' AND c.chunk_state  = 'Complete'"
-        # print(f'query_string_processed_chunk_count:{query_string_processed_chunk_count}')
-        processed_items = list(self.container.query_items(query=query_string_processed_chunk_count,
-                        enable_cross_partition_query=True))
-        # print(f'mark_document_processing_complete() -> processed_items:{processed_items}, type(processed_items):{type(processed_items)}')
-        
-        processed_chunk_count = 0
-        if processed_items and len(processed_items) > 0:
-            processed_chunk_count = int(processed_items[0])
-        
-        if total_chunk_count==processed_chunk_count:
-            self.update_document_state(file_path, State.COMPLETE.value) #Mark as processing completed for the parent document
+        # Make sure anything buffered by this invocation, such as the chunk counts, is stored first
+        self.flush()
+
+        try:
+            json_document = self.container.read_item(item=self.encode_document_id(file_path), partition_key=os.path.basename(file_path))
+        except exceptions.CosmosResourceNotFoundError:
+            logging.warning(f"Status document for {file_path} not found.")
+            return False
+
+        return self._complete_if_all_chunks_processed(file_path, json_document)
+
+    def _complete_if_all_chunks_processed(self, file_path, json_document):
+        """ Marks the document complete when its completed chunk count has reached its merged chunk count """
+        total_chunk_count = int(json_document.get("merged_chunk_count", -1))
+        processed_chunk_count = int(json_document.get("completed_chunk_count", 0))
+        if total_chunk_count <= 0 or processed_chunk_count < total_chunk_count or json_document.get("state") == State.COMPLETE.value:
+            return False
+
+        # Only the first worker to get here changes the state, the filter fails for any other
+        try:
+            self.container.patch_item(item=self.encode_document_id(file_path), partition_key=os.path.basename(file_path),
+                                      patch_operations=[
+                                          {"op": "set", "path": "/state", "value": State.COMPLETE.value},
+                                          {"op": "set", "path": "/state_timestamp", "value": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))}
+                                      ],
+                                      filter_predicate=f"FROM c WHERE c.state != '{State.COMPLETE.value}'")
+        except exceptions.CosmosAccessConditionFailedError:
+            return False
+        logging.info(f"{State.COMPLETE.value} DocumentID - {self.encode_document_id(file_path)}")
+        return True
+
+    def record_doc_intel_turnaround(self, file_path, page_count, file_size, turnaround_seconds):
+        """ Function to record how long Document Intelligence took to analyze a document, used to predict when to poll for later documents """
+        try:
+            self.container.patch_item(item=self.encode_document_id(file_path), partition_key=os.path.basename(file_path),
+                                      patch_operations=[{"op": "set", "path": "/doc_intel", "value": {
+                                          "page_count": page_count,
+                                          "file_size": file_size,
+                                          "turnaround_seconds": turnaround_seconds,
+                                          "completed_timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                                      }}])
+        except exceptions.CosmosResourceNotFoundError:
+            logging.warning(f"Status document for {file_path} not found.")
+
+    def read_doc_intel_turnaround_history(self, limit = 200):
+        """ Function to return the Document Intelligence turnaround recorded for the most recently analyzed documents """
+        items = self.container.query_items(
+            query="SELECT TOP @limit VALUE c.doc_intel FROM c WHERE c.doc_type = 'file_log' AND IS_DEFINED(c.doc_intel) ORDER BY c.doc_intel.completed_timestamp DESC",
+            parameters=[{"name": "@limit", "value": limit}],
+            enable_cross_partition_query=True
+        )
+        return list(items)
     
 
 # New
 class PromptLog:
     """ Class for fetching prompt metadata and logging prompt outputs to Cosmos DB"""
 
-    def __init__(self, url, key, database_name, container_name):
+    def __init__(self, url, key, database_name, container_name, provisioned=False, prompt_cache_ttl=PROMPT_CACHE_TTL_SECONDS):
         """ Constructor function """
         self._url = url
         self._key = key
         self._database_name = database_name
         self._container_name = container_name
-        self.cosmos_client = CosmosClient(url=self._url, credential=self._key)
+        self.cosmos_client = get_cosmos_client(self._url, self._key)
         self._log_document = {}
+        self.prompt_cache_ttl = prompt_cache_ttl
 
-        # Select a database (will create it if it doesn't exist)
+        # Select a database and container, created with the default prompt if they don't exist
+        # (checked once per process unless provisioned)
         self.database = self.cosmos_client.get_database_client(self._database_name)
-        if self._database_name not in [db['id'] for db in self.cosmos_client.list_databases()]:
-            self.database = self.cosmos_client.create_database(self._database_name)
-
-        # Select a container (will create it if it doesn't exist)
-        self.container = self.database.get_container_client(self._container_name)
-        if self._container_name not in [container['id'] for container
-                                        in self.database.list_containers()]:
-            self.container = self.database.create_container(id=self._container_name,
-                partition_key=PartitionKey(path="/userid"))
-            
-            #Insert default prompt
-            document_id = base64.urlsafe_b64encode('default'.encode()).decode()
-            json_data = {
-                "id": document_id,
-                "userid": "default", 
-                 "prompts": [
-                                {
-                                    "prompt_id": "default",
-                                    "prompt": "Summarise the provided text below:"
-                                }
-                            ],            
-                "timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))                
-            }
-
-            # print(f'json_data:{json_data}')
-
-            """Saves the document in the cosmosdb"""        
-            self.container.upsert_item(body=json_data)
+        self.container = get_container(self._url, self._key, self._database_name, self._container_name,
+                                       "/userid", on_create=self.insert_default_prompt, provisioned=provisioned)
+
+    def insert_default_prompt(self, container):
+        """ Function to insert the default prompt into a newly created prompt container """
+        document_id = base64.urlsafe_b64encode('default'.encode()).decode()
+        json_data = {
+            "id": document_id,
+            "userid": "default", 
+             "prompts": [
+                            {
+                                "prompt_id": "default",
+                                "prompt": "Summarise the provided text below:"
+                            }
+                        ],            
+            "timestamp": str(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))                
+        }
+
+        # print(f'json_data:{json_data}')
+
+        """Saves the document in the cosmosdb"""        
+        container.upsert_item(body=json_data)
 
     def get_prompt(self,
                        user_id: str,
                        prompt_id: str
                        ):
         """
-        Function to get prompt value (including default prompt) based on userid and prompt_id
+        Function to get prompt value (including default prompt) based on userid and prompt_id.
+        Prompts are cached for prompt_cache_ttl seconds, after which the cached prompt is kept if its document's _etag is unchanged.
         """
 
         # print(f'In get_prompt(), userid:{user_id}, prompt_id:{prompt_id}')
-        
-        query_string = f'SELECT c.prompts FROM c WHERE c.userid = "{user_id}" AND ARRAY_CONTAINS(c.prompts, {{ "prompt_id": "{prompt_id}"  }}, true)'
-        # print(f'query_string:{query_string}')
 
-        items = list(self.container.query_items(
-            query=query_string,
-            enable_cross_partition_query=True
-        ))
-
-        # print(f'get_prompt() -> items:{items}, type(items):{type(items)}')
+        cache_key = (self._url, self._database_name, self._container_name, user_id, prompt_id)
+        with _prompt_cache_lock:
+            cached = _prompt_cache.get(cache_key)
+            if cached is not None:
+                _prompt_cache.move_to_end(cache_key)
+        if cached is not None and cached["expires"] > time.monotonic():
+            return cached["prompt"]
+        prompt_document = None
+        if cached is not None and cached["etag"]:
+            # Expired, a conditional read only returns the document if it has changed since it was cached
+            # (a 304 Not Modified response has no body)
+            try:
+                changed_document = self.container.read_item(item=cached["id"], partition_key=user_id,
+                                                            etag=cached["etag"], match_condition=MatchConditions.IfModified)
+            except exceptions.CosmosResourceNotFoundError:
+                changed_document = True
+            if not changed_document:
+                self._cache_prompt(cache_key, cached["prompt"], cached["id"], cached["etag"])
+                return cached["prompt"]
+            if isinstance(changed_document, dict) and any(prompt["prompt_id"] == prompt_id for prompt in changed_document.get("prompts", [])):
+                prompt_document = changed_document
 
         prompt_out = ""
-
-        if items and len(items) > 0:
-
-            # items = [{'prompts': [{'prompt_id': '1', 'prompt': 'Summarise the provided text below:'}, {'prompt_id': '2', 'prompt': 'Summarise the provided text below as bullet points:'}]}]
+        if prompt_document is None:
+            prompt_document = self._read_prompt_document(user_id, prompt_id)
+        if prompt_document is not None:
             # Get the prompt matching supplied prompt_id
-            for prompt in items[0]["prompts"]:            
+            for prompt in prompt_document["prompts"]:            
                 if prompt["prompt_id"] == prompt_id:
                     prompt_out = prompt["prompt"]
                     break
+            if prompt_out:
+                self._cache_prompt(cache_key, prompt_out, prompt_document["id"], prompt_document.get("_etag"))
 
         return prompt_out
+
+    def _read_prompt_document(self, user_id, prompt_id):
+        """ Returns the prompt document of user_id holding prompt_id, or None """
+        # Prompt documents are keyed by the encoded userid, so try a point read in the userid partition first
+        document_id = base64.urlsafe_b64encode(user_id.encode()).decode()
+        try:
+            item = self.container.read_item(item=document_id, partition_key=user_id)
+            if any(prompt["prompt_id"] == prompt_id for prompt in item.get("prompts", [])):
+                return item
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+        query_string = 'SELECT * FROM c WHERE ARRAY_CONTAINS(c.prompts, { "prompt_id": @prompt_id }, true)'
+        # print(f'query_string:{query_string}')
+
+        items = list(self.container.query_items(
+            query=query_string,
+            parameters=[{"name": "@prompt_id", "value": prompt_id}],
+            partition_key=user_id
+        ))
+
+        # print(f'_read_prompt_document() -> items:{items}, type(items):{type(items)}')
+
+        if items and len(items) > 0:
+            return items[0]
+        return None
+
+    def _cache_prompt(self, cache_key, prompt, document_id, etag):
+        if self.prompt_cache_ttl <= 0:
+            return
+        with _prompt_cache_lock:
+            _prompt_cache[cache_key] = {
+                "prompt": prompt,
+                "id": document_id,
+                "etag": etag,
+                "expires": time.monotonic() + self.prompt_cache_ttl
+            }
+            _prompt_cache.move_to_end(cache_key)
+            while len(_prompt_cache) > PROMPT_CACHE_MAX_ENTRIES:
+                _prompt_cache.popitem(last=False)
+
+    def invalidate_prompt_cache(self, user_id=None, prompt_id=None):
+        """ Function to drop cached prompts, all of them or those of a user_id and optionally a prompt_id """
+        with _prompt_cache_lock:
+            for cache_key in list(_prompt_cache):
+                if cache_key[:3] != (self._url, self._database_name, self._container_name):
+                    continue
+                if (user_id is None or cache_key[3] == user_id) and (prompt_id is None or cache_key[4] == prompt_id):
+                    del _prompt_cache[cache_key]
     
     
     
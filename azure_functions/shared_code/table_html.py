@@ -0,0 +1,134 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Library of code for rendering Document Intelligence tables to HTML, keeping their rows so tables can be chunked
+without parsing the HTML again """
+import html
+from functools import cached_property
+
+# Characters BeautifulSoup counts as whitespace, it collapses a text made only of them to a single newline or space
+ASCII_SPACES = str.maketrans("", "", "\x20\x0a\x09\x0c\x0d")
+
+
+class TableHtml(str):
+    """ HTML of a table, or of a chunk of one, together with the inner HTML of its thead and the HTML of its other rows.
+    Rows are in the form BeautifulSoup serializes them, lowercase quoted attributes and text escaped without quotes,
+    which is how they have always appeared in table chunks. head is None when the HTML has no thead """
+
+    def __new__(cls, table_html, head=None, body_rows=()):
+        table = super().__new__(cls, table_html)
+        table.head = head
+        table.body_rows = body_rows
+        return table
+
+    @property
+    def thead(self):
+        return None if self.head is None else f"<thead>{self.head}</thead>"
+
+
+class RenderedTableHtml(TableHtml):
+    """ HTML of a table rendered by table_to_html, serializing its rows from the cells only when they are first used """
+
+    def __new__(cls, table_html, head_rows, body_rows):
+        table = str.__new__(cls, table_html)
+        table._head_rows = head_rows
+        table._body_rows = body_rows
+        return table
+
+    @cached_property
+    def head(self):
+        return "".join(serialize_row(row_cells) for row_cells in self._head_rows) if self._head_rows else None
+
+    @cached_property
+    def body_rows(self):
+        return [serialize_row(row_cells) for row_cells in self._body_rows]
+
+
+def serialize_cell_text(content):
+    """ Function to return cell text the way BeautifulSoup serializes it """
+    if content and content.translate(ASCII_SPACES) == "":
+        return "\n" if "\n" in content else " "
+    return html.escape(content, quote=False)
+
+
+def get_cell_tag(cell):
+    if cell.get("kind") in ("columnHeader", "rowHeader"):
+        return "th"
+    return "td"
+
+
+def serialize_row(row_cells):
+    """ Function to return the HTML of a row the way BeautifulSoup serializes it """
+    row_html = ["<tr>"]
+    for cell in row_cells:
+        tag = get_cell_tag(cell)
+        cell_spans = ""
+        if cell.get("columnSpan", 1) > 1:
+            cell_spans += f' colspan="{cell["columnSpan"]}"'
+        if cell.get("rowSpan", 1) > 1:
+            cell_spans += f' rowspan="{cell["rowSpan"]}"'
+        row_html.append(f"<{tag}{cell_spans}>{serialize_cell_text(cell['content'])}</{tag}>")
+    row_html.append("</tr>")
+    return "".join(row_html)
+
+
+def table_to_html(table):
+    """ Function to take an output FR table json structure and convert to HTML """
+    # Group the cells by row in one pass, cells outside rowCount are left out
+    row_count = table["rowCount"]
+    rows = [[] for _ in range(row_count)]
+    for cell in table["cells"]:
+        if 0 <= cell["rowIndex"] < row_count:
+            rows[cell["rowIndex"]].append(cell)
+
+    table_html = ["<table>"]
+    head_rows = []
+    body_rows = []
+    thead_open_added = False
+    thead_closed_added = False
+
+    for i, row_cells in enumerate(rows):
+        row_cells.sort(key=lambda cell: cell["columnIndex"])
+        is_row_a_header = False
+        row_html = ["<tr>"]
+        for cell in row_cells:
+            tag = get_cell_tag(cell)
+            if cell.get("kind") == "columnHeader":
+                is_row_a_header = True
+            cell_spans = ""
+            if cell.get("columnSpan", 1) > 1:
+                cell_spans += f" colSpan={cell['columnSpan']}"
+            if cell.get("rowSpan", 1) > 1:
+                cell_spans += f" rowSpan={cell['rowSpan']}"
+            row_html.append(f"<{tag}{cell_spans}>{html.escape(cell['content'])}</{tag}>")
+        row_html.append("</tr>")
+
+        # add the opening thead if this is the first row and the first header row encountered
+        if is_row_a_header and i == 0 and not thead_open_added:
+            table_html.append("<thead>")
+            thead_open_added = True
+
+        # add the closing thead if we have added an opening thead and if this is not a header row
+        if not is_row_a_header and thead_open_added and not thead_closed_added:
+            table_html.append("</thead>")
+            thead_closed_added = True
+
+        table_html.extend(row_html)
+        # a thead left open runs to the end of the table
+        if thead_open_added and not thead_closed_added:
+            head_rows.append(row_cells)
+        else:
+            body_rows.append(row_cells)
+    table_html.append("</table>")
+    return RenderedTableHtml("".join(table_html), head_rows, body_rows)
+
+
+def parse_table_html(table_html):
+    """ Function to return the thead and rows of table HTML not rendered by table_to_html, parsed with BeautifulSoup """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(table_html, 'html.parser')
+    thead = soup.find('thead')
+    head = None if thead is None else str(thead).replace("<thead>", "").replace("</thead>", "")
+    # Filter out rows that are part of thead block
+    body_rows = [str(row) for row in soup.find_all('tr') if row.parent.name != "thead"]
+    return TableHtml(table_html, head, body_rows)
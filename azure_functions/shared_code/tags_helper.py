@@ -1,32 +1,25 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from azure.cosmos import CosmosClient, PartitionKey
 import traceback, sys
 import base64
+from shared_code.cosmos_registry import get_cosmos_client, get_container
 
 class TagsHelper:
     """ Helper class for tag functions"""
 
-    def __init__(self, url, key, database_name, container_name):
+    def __init__(self, url, key, database_name, container_name, provisioned=False):
         """ Constructor function """
         self._url = url
         self._key = key
         self._database_name = database_name
         self._container_name = container_name
-        self.cosmos_client = CosmosClient(url=self._url, credential=self._key)
+        self.cosmos_client = get_cosmos_client(self._url, self._key)
 
-        # Select a database (will create it if it doesn't exist)
+        # Select a database and container, created if they don't exist (checked once per process unless provisioned)
         self.database = self.cosmos_client.get_database_client(self._database_name)
-        if self._database_name not in [db['id'] for db in self.cosmos_client.list_databases()]:
-            self.database = self.cosmos_client.create_database(self._database_name)
-
-        # Select a container (will create it if it doesn't exist)
-        self.container = self.database.get_container_client(self._container_name)
-        if self._container_name not in [container['id'] for container
-                                        in self.database.list_containers()]:
-            self.container = self.database.create_container(id=self._container_name,
-                partition_key=PartitionKey(path="/file_path"))
+        self.container = get_container(self._url, self._key, self._database_name, self._container_name,
+                                       "/file_path", provisioned=provisioned)
 
     def get_all_tags(self):
         """ Returns all tags in the database """
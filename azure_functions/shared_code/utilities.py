@@ -4,35 +4,34 @@
 import logging
 import json
 import html
+import gzip
+import hashlib
+from array import array
 from datetime import datetime
 from enum import Enum
 import zipfile
 import os
-from azure.storage.blob import BlobServiceClient
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from shared_code.utilities_helper import UtilitiesHelper
-from nltk.tokenize import sent_tokenize
-import tiktoken
-import nltk
+from shared_code.blob_uploader import BlobUploader
+from shared_code.llm_cache import LLMResponseCache, DEFAULT_LOCAL_MAX_BYTES
+from shared_code.rate_limiter import QuotaScheduler, parse_limits, DEFAULT_QUOTA_SYNC_SECONDS
+from shared_code.table_html import TableHtml, table_to_html, parse_table_html
 
 import time
 import random
 
-# Try to download using nltk.download
-nltk.download('punkt')
-from bs4 import BeautifulSoup
+# tiktoken and nltk are imported on first use, as AddToQueue and SubmitToDocumentIntel never chunk or count tokens
 
-punkt_dir = os.path.join(nltk.data.path[0], 'tokenizers/punkt')
-
-# Check if the 'punkt' directory exists
-if not os.path.exists(punkt_dir):
-    punkt_zip_path = os.path.join(nltk.data.path[0], 'tokenizers/punkt.zip')
-
-    # If the 'punkt.zip' file exists, unzip it
-    if os.path.exists(punkt_zip_path):
-        with zipfile.ZipFile(punkt_zip_path, 'r') as zip_ref:
-            zip_ref.extractall(os.path.join(nltk.data.path[0], 'tokenizers/'))
-    else:
-        raise Exception("Failed to download 'punkt' package")
+# Folder scripts/download_models.py saves the nltk punkt tokenizer and the tiktoken BPE files to, deployed with the app.
+# Models found there are loaded from disk, otherwise they are downloaded on first use
+MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+NLTK_DATA_DIR = os.path.join(MODELS_DIR, "nltk_data")
+TIKTOKEN_CACHE_DIR = os.path.join(MODELS_DIR, "tiktoken_cache")
 
 class ParagraphRoles(Enum):
     """ Enum to define the priority of paragraph roles """
@@ -66,6 +65,152 @@ class MediaType:
     IMAGE = "image"
     MEDIA = "media"    
 
+class OutputFormat:
+    """ Helper class for the formats json outputs are written to blob storage in """
+    PRETTY_JSON = "json_indent" # indented json, as the outputs have always been written
+    JSON = "json"               # compact json without whitespace
+    GZIP_JSON = "json_gzip"     # compact json, gzip compressed and stored with Content-Encoding: gzip
+
+# First bytes of gzip compressed data
+GZIP_MAGIC = b'\x1f\x8b'
+
+# tiktoken encodings and their pre-tokenizer patterns, loaded once per process
+_encodings = {}
+_encoding_patterns = {}
+
+def get_encoding(encoding_name):
+    """ Function to return the tiktoken encoding for a name, cached for the life of the process """
+    encoding = _encodings.get(encoding_name)
+    if encoding is None:
+        import tiktoken
+        import regex
+        # tiktoken only looks for its BPE files in TIKTOKEN_CACHE_DIR, a folder set for the app takes precedence
+        if os.path.isdir(TIKTOKEN_CACHE_DIR):
+            os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+        encoding = tiktoken.get_encoding(encoding_name)
+        # regex is installed with tiktoken and understands the \p{L} / \p{N} classes its patterns use
+        _encoding_patterns[encoding_name] = regex.compile(encoding._pat_str)
+        _encodings[encoding_name] = encoding
+    return encoding
+
+# nltk sentence tokenizer, loaded once per process
+_sent_tokenize = None
+_sent_tokenize_lock = threading.Lock()
+
+def load_punkt():
+    """ Function to make the nltk punkt tokenizer available, from MODELS_DIR when deployed with the app, downloading it otherwise """
+    import nltk
+    if os.path.isdir(NLTK_DATA_DIR) and NLTK_DATA_DIR not in nltk.data.path:
+        nltk.data.path.insert(0, NLTK_DATA_DIR)
+    try:
+        nltk.data.find('tokenizers/punkt')
+        return
+    except LookupError:
+        logging.warning(f"nltk punkt tokenizer not found in {NLTK_DATA_DIR}, downloading it")
+
+    # Try to download using nltk.download
+    nltk.download('punkt')
+
+    punkt_dir = os.path.join(nltk.data.path[0], 'tokenizers/punkt')
+
+    # Check if the 'punkt' directory exists
+    if not os.path.exists(punkt_dir):
+        punkt_zip_path = os.path.join(nltk.data.path[0], 'tokenizers/punkt.zip')
+
+        # If the 'punkt.zip' file exists, unzip it
+        if os.path.exists(punkt_zip_path):
+            with zipfile.ZipFile(punkt_zip_path, 'r') as zip_ref:
+                zip_ref.extractall(os.path.join(nltk.data.path[0], 'tokenizers/'))
+        else:
+            raise Exception("Failed to download 'punkt' package")
+
+def sent_tokenize(text):
+    """ Function to split text into sentences with the nltk punkt tokenizer """
+    global _sent_tokenize
+    if _sent_tokenize is None:
+        with _sent_tokenize_lock:
+            if _sent_tokenize is None:
+                load_punkt()
+                from nltk.tokenize import sent_tokenize as nltk_sent_tokenize
+                _sent_tokenize = nltk_sent_tokenize
+    return _sent_tokenize(text)
+
+class TokenCounter:
+    """ Keeps the token count of a growing text up to date as text is appended to it.
+
+    Token counts only add up across a point the encoding's pre-tokenizer can never merge over.
+    While the text does not end in whitespace, the start of its last pre-tokenized piece is such a
+    point, so counting the text plus a suffix only needs that last piece and the suffix encoded.
+    Counts are always identical to encoding the whole text.
+    """
+
+    def __init__(self, text="", encoding_name="cl100k_base"):
+        self._encoding = get_encoding(encoding_name)
+        self._pattern = _encoding_patterns[encoding_name]
+        self.text = ""
+        self.count = 0
+        # length and token count of the text before its last pre-tokenized piece
+        self._stable_length = 0
+        self._stable_count = 0
+        if text:
+            self.append(text)
+
+    def _num_tokens(self, text):
+        return len(self._encoding.encode(text))
+
+    def _has_stable_point(self):
+        return self.text != "" and not self.text[-1].isspace()
+
+    def count_appended(self, suffix):
+        """ Returns the token count the text would have with suffix appended, without appending it """
+        if not self._has_stable_point():
+            return self._num_tokens(self.text + suffix)
+        return self._stable_count + self._num_tokens(self.text[self._stable_length:] + suffix)
+
+    def append(self, suffix):
+        """ Appends suffix to the text and updates the token count """
+        if self._has_stable_point():
+            stable_length, stable_count = self._stable_length, self._stable_count
+        else:
+            stable_length, stable_count = 0, 0
+        self.text += suffix
+        tail = self.text[stable_length:]
+        tail_count = self._num_tokens(tail)
+        last_piece_start = 0
+        for piece in self._pattern.finditer(tail):
+            last_piece_start = piece.start()
+        self.count = stable_count + tail_count
+        self._stable_length = stable_length + last_piece_start
+        self._stable_count = self.count - self._num_tokens(tail[last_piece_start:])
+
+# Merged chunks are planned over a window of granular chunks worth about this many merged chunks,
+# so they are still written and queued while later pages are being chunked
+MERGED_CHUNK_PLAN_WINDOW = 8
+# Cost of starting a merged chunk part way through a section, weighed against the squared fill of the merged chunks
+MID_SECTION_SPLIT_COST = 0.1
+
+# Blob service clients shared by every Utilities instance in the process, keyed by endpoint and credential.
+# Reusing one client keeps its HTTP connections (and their TLS sessions) alive across blob calls and invocations.
+DEFAULT_BLOB_CONNECTION_POOL_SIZE = 32
+_blob_service_clients = {}
+_blob_service_clients_lock = threading.Lock()
+
+def get_blob_service_client(endpoint, credential, connection_pool_size=DEFAULT_BLOB_CONNECTION_POOL_SIZE):
+    """ Function to return the BlobServiceClient for an endpoint, created on first use and reused for the life of the process """
+    client = _blob_service_clients.get((endpoint, credential))
+    if client is None:
+        with _blob_service_clients_lock:
+            client = _blob_service_clients.get((endpoint, credential))
+            if client is None:
+                # requests keeps up to pool_maxsize connections per host, size it for concurrent chunk writes
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=connection_pool_size, pool_maxsize=connection_pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                client = BlobServiceClient(endpoint, credential, transport=RequestsTransport(session=session, session_owner=False))
+                _blob_service_clients[(endpoint, credential)] = client
+    return client
+
 class Utilities:
        
     """ Class to hold utility functions """
@@ -74,24 +219,66 @@ class Utilities:
                  azure_blob_storage_endpoint,
                  azure_blob_drop_storage_container,
                  azure_blob_content_storage_container,
-                 azure_blob_storage_key
+                 azure_blob_storage_key,
+                 blob_connection_pool_size = DEFAULT_BLOB_CONNECTION_POOL_SIZE,
+                 output_format = OutputFormat.PRETTY_JSON,
+                 compact_llm_output = False
                  ):
         self.azure_blob_storage_account = azure_blob_storage_account
         self.azure_blob_storage_endpoint = azure_blob_storage_endpoint
         self.azure_blob_drop_storage_container = azure_blob_drop_storage_container
         self.azure_blob_content_storage_container = azure_blob_content_storage_container
         self.azure_blob_storage_key = azure_blob_storage_key
+        self.blob_connection_pool_size = blob_connection_pool_size
+        self.output_format = output_format
+        self.compact_llm_output = compact_llm_output
         self.utilities_helper = UtilitiesHelper(azure_blob_storage_account,
                                                 azure_blob_storage_endpoint,
                                                 azure_blob_storage_key)
 
+    def get_blob_service_client(self):
+        """ Function to return the process wide BlobServiceClient for this storage account """
+        return get_blob_service_client(self.azure_blob_storage_endpoint,
+                                       self.azure_blob_storage_key,
+                                       self.blob_connection_pool_size)
+
+    def encode_output(self, output):
+        """ Function to serialise a json output in the configured output format, returns the payload and its content settings """
+        if self.output_format == OutputFormat.PRETTY_JSON:
+            return json.dumps(output, indent=2, ensure_ascii=False), None
+        json_str = json.dumps(output, ensure_ascii=False, separators=(',', ':'))
+        if self.output_format == OutputFormat.JSON:
+            return json_str, ContentSettings(content_type='application/json')
+        if self.output_format == OutputFormat.GZIP_JSON:
+            return gzip.compress(json_str.encode('utf-8'), compresslevel=6), ContentSettings(content_type='application/json', content_encoding='gzip')
+        raise ValueError(f"Unknown output format {self.output_format}")
+
+    def decode_output(self, payload):
+        """ Function to return the json bytes of a payload written by encode_output in any output format.
+        download_blob already decompresses blobs stored with Content-Encoding: gzip, so only a payload still starting
+        with the gzip magic bytes, which json never does, is decompressed here """
+        if payload[:2] == GZIP_MAGIC:
+            return gzip.decompress(payload)
+        return payload
+
+    def create_blob_uploader(self, max_concurrency=8):
+        """ Function to return a BlobUploader writing concurrently to the content container """
+        return BlobUploader(self.get_blob_service_client(),
+                            self.azure_blob_content_storage_container,
+                            max_concurrency)
+
+    def create_llm_response_cache(self, local_dir=None, local_max_bytes=DEFAULT_LOCAL_MAX_BYTES):
+        """ Function to return an LLMResponseCache kept in the content container, with up to local_max_bytes on local disk """
+        return LLMResponseCache(self.get_blob_service_client(),
+                                self.azure_blob_content_storage_container,
+                                local_dir,
+                                local_max_bytes=local_max_bytes)
+
     def write_blob(self, output_container, content, output_filename, folder_set=""):
         """ Function to write a generic blob """
         # folder_set should be in the format of "<my_folder_name>/"
         # Get path and file name minus the root container
-        blob_service_client = BlobServiceClient(
-            self.azure_blob_storage_endpoint,
-            self.azure_blob_storage_key)
+        blob_service_client = self.get_blob_service_client()
         block_blob_client = blob_service_client.get_blob_client(
             container=output_container, blob=f'{folder_set}{output_filename}')
         block_blob_client.upload_blob(content, overwrite=True)
@@ -157,50 +344,7 @@ class Utilities:
 
     def table_to_html(self, table):
         """ Function to take an output FR table json structure and convert to HTML """
-        table_html = "<table>"
-        rows = [sorted([cell for cell in table["cells"] if cell["rowIndex"] == i],
-                       key=lambda cell: cell["columnIndex"]) for i in range(table["rowCount"])]
-        thead_open_added = False
-        thead_closed_added = False 
-
-        for i, row_cells in enumerate(rows):
-            is_row_a_header = False
-            row_html = "<tr>"
-            for cell in row_cells:
-                tag = "td"
-                if 'kind' in cell:                      
-                    if (cell["kind"] == "columnHeader" or cell["kind"] == "rowHeader"):
-                        tag = "th"
-                    if (cell["kind"] == "columnHeader"):
-                        is_row_a_header = True
-                cell_spans = ""
-                if 'columnSpan' in cell:
-                    if cell["columnSpan"] > 1:
-                        cell_spans += f" colSpan={cell['columnSpan']}"
-                if 'rowSpan' in cell:
-                    if cell["rowSpan"] > 1:
-                        cell_spans += f" rowSpan={cell['rowSpan']}"
-                row_html += f"<{tag}{cell_spans}>{html.escape(cell['content'])}</{tag}>"
-            row_html += "</tr>"
-            
-            # add the opening thead if this is the first row and the first header row encountered
-            if is_row_a_header and i == 0 and not thead_open_added:
-                row_html = "<thead>" + row_html 
-                thead_open_added = True 
-                            
-            # add the closing thead if we have added an opening thead and if this is not a header row
-            if not is_row_a_header and thead_open_added and not thead_closed_added:
-                row_html = "</thead>" + row_html                 
-                thead_closed_added = True
-                
-            table_html += row_html
-        table_html += "</table>"
-        return table_html
-
-
-
-
-
+        return table_to_html(table)
 
     def build_document_map_pdf(self, myblob_name, myblob_uri, result, azure_blob_log_storage_container, enable_dev_code):
         """ Function to build a json structure representing the paragraphs in a document, 
@@ -212,12 +356,46 @@ class Utilities:
             'file_name': myblob_name,
             'file_uri': myblob_uri,
             'content': result["content"],
-            "structure": [],
-            "content_type": [],
-            "table_index": []
+            "structure": list(self.iter_document_structure(result))
         }
-        document_map['content_type'].extend([ContentType.NOT_PROCESSED] * len(result['content']))
-        document_map['table_index'].extend([-1] * len(result["content"]))
+
+        if enable_dev_code:
+            # Output document map to log container
+            json_str = json.dumps(document_map, indent=2)
+            file_name, file_extension, file_directory  = self.get_filename_and_extension(myblob_name)
+            output_filename =  file_name + "_Document_Map" + file_extension + ".json"
+            self.write_blob(azure_blob_log_storage_container, json_str, output_filename, file_directory)
+
+            # Output FR result to log container
+            json_str = json.dumps(result, indent=2)
+            output_filename =  file_name + '_FR_Result' + file_extension + ".json"
+            self.write_blob(azure_blob_log_storage_container, json_str, output_filename, file_directory)
+
+        return document_map
+
+    def iter_document_structure(self, result):
+        """ Generator yielding the paragraphs of the document map structure in content order.
+        Tables are only rendered to HTML as they are reached, so paragraphs can be consumed
+        as they are produced rather than holding the whole structure in memory"""
+
+        content = result["content"]
+        content_length = len(content)
+
+        # label every content char with its ContentType value, held in a compact signed byte array
+        # (zero filled, i.e. NOT_PROCESSED) so that whole spans can be labelled with a slice assignment
+        content_type = array('b', bytes(content_length))
+        table_index = {}
+        # positions holding a START or END label, these are the only positions the structure is built from
+        marker_positions = set()
+
+        def label_span(start_char, end_char, start_type, char_type, end_type):
+            """ Label a span as start char, inner chars and end char, in the same order as a char by char pass """
+            content_type[start_char] = start_type.value
+            if end_char > start_char + 1:
+                content_type[start_char + 1:end_char] = array('b', [char_type.value]) * (end_char - start_char - 1)
+            content_type[end_char] = end_type.value
+            marker_positions.add(start_char)
+            marker_positions.add(end_char % content_length)
 
         # update content_type array where spans are tables
         for index, table in enumerate(result["tables"]):
@@ -234,12 +412,9 @@ class Utilities:
                 end_char += span["length"] -1
             
             # update the content_type array
-            document_map['content_type'][start_char] = ContentType.TABLE_START
-            for i in range(start_char + 1, end_char):
-                document_map['content_type'][i] = ContentType.TABLE_CHAR
-            document_map['content_type'][end_char] = ContentType.TABLE_END
+            label_span(start_char, end_char, ContentType.TABLE_START, ContentType.TABLE_CHAR, ContentType.TABLE_END)
             # tag the end point in content of a table with the index of which table this is
-            document_map['table_index'][end_char] = index
+            table_index[end_char % content_length] = index
 
 
         # update content_type array where spans are titles, section headings or regular content,
@@ -250,26 +425,16 @@ class Utilities:
 
             # if this span has already been identified as a non textual paragraph
             # such as a table, then skip over it
-            if document_map['content_type'][start_char] == ContentType.NOT_PROCESSED:
-                #if not hasattr(paragraph, 'role'):
+            if content_type[start_char] == ContentType.NOT_PROCESSED.value:
                 if 'role' not in paragraph:
                     # no assigned role
-                    document_map['content_type'][start_char] = ContentType.TEXT_START
-                    for i in range(start_char+1, end_char):
-                        document_map['content_type'][i] = ContentType.TEXT_CHAR
-                    document_map['content_type'][end_char] = ContentType.TEXT_END
+                    label_span(start_char, end_char, ContentType.TEXT_START, ContentType.TEXT_CHAR, ContentType.TEXT_END)
 
                 elif paragraph['role'] == 'title':
-                    document_map['content_type'][start_char] = ContentType.TITLE_START
-                    for i in range(start_char+1, end_char):
-                        document_map['content_type'][i] = ContentType.TITLE_CHAR
-                    document_map['content_type'][end_char] = ContentType.TITLE_END
+                    label_span(start_char, end_char, ContentType.TITLE_START, ContentType.TITLE_CHAR, ContentType.TITLE_END)
 
                 elif paragraph['role'] == 'sectionHeading':
-                    document_map['content_type'][start_char] = ContentType.SECTIONHEADING_START
-                    for i in range(start_char+1, end_char):
-                        document_map['content_type'][i] = ContentType.SECTIONHEADING_CHAR
-                    document_map['content_type'][end_char] = ContentType.SECTIONHEADING_END
+                    label_span(start_char, end_char, ContentType.SECTIONHEADING_START, ContentType.SECTIONHEADING_CHAR, ContentType.SECTIONHEADING_END)
 
         # store page number metadata by paragraph object
         page_number_by_paragraph = {}
@@ -277,44 +442,47 @@ class Utilities:
             start_char = paragraph["spans"][0]["offset"]
             page_number_by_paragraph[start_char] = paragraph["boundingRegions"][0]["pageNumber"]
 
-        # iterate through the content_type and build the document paragraph catalog of content
-        # tagging paragraphs with title and section
+        # walk the labelled positions in content order and build the document paragraph catalog of content
+        # tagging paragraphs with title and section. Inner chars of a span carry no information so they are
+        # never visited, which keeps this proportional to the number of spans rather than the content length
         main_title = ''
         current_title = ''
         current_section = ''
         start_position = 0
         page_number = 0
-        for index, item in enumerate(document_map['content_type']):
+        positions = marker_positions.union(position for position in page_number_by_paragraph
+                                           if position < content_length)
+        for index in sorted(positions):
 
             # collect page number metadata
             page_number = page_number_by_paragraph.get(index, page_number)
+            item = ContentType(content_type[index])
 
             match item:
                 case ContentType.TITLE_START | ContentType.SECTIONHEADING_START | ContentType.TEXT_START | ContentType.TABLE_START:
                     start_position = index
                 case ContentType.TITLE_END:
-                    current_title =  document_map['content'][start_position:index+1]
+                    current_title =  content[start_position:index+1]
                     # set the main title from any title elemnts on the first page concatenated
                     if main_title == '':
                         main_title = current_title
                     elif page_number == 1:
                         main_title = main_title + "; " + current_title
                 case ContentType.SECTIONHEADING_END:
-                    current_section = document_map['content'][start_position:index+1]
+                    current_section = content[start_position:index+1]
                 case ContentType.TEXT_END | ContentType.TABLE_END:
                     if item == ContentType.TEXT_END:
                         property_type = 'text'
-                        output_text = document_map['content'][start_position:index+1]
+                        output_text = content[start_position:index+1]
                     elif item == ContentType.TABLE_END:
                         # now we have reached the end of the table in the content dictionary,
                         # write out the table text to the output json document map
                         property_type = 'table'
-                        table_index = document_map['table_index'][index]
-                        table_json = result["tables"][table_index]
+                        table_json = result["tables"][table_index[index]]
                         output_text = self.table_to_html(table_json)
                     else:
                         property_type = 'unknown'
-                    document_map["structure"].append({
+                    yield {
                         'offset': start_position,
                         'text': output_text,
                         'type': property_type,
@@ -322,28 +490,11 @@ class Utilities:
                         'subtitle': current_title,
                         'section': current_section,
                         'page_number': page_number
-                    })
-
-        del document_map['content_type']
-        del document_map['table_index']
-
-        if enable_dev_code:
-            # Output document map to log container
-            json_str = json.dumps(document_map, indent=2)
-            file_name, file_extension, file_directory  = self.get_filename_and_extension(myblob_name)
-            output_filename =  file_name + "_Document_Map" + file_extension + ".json"
-            self.write_blob(azure_blob_log_storage_container, json_str, output_filename, file_directory)
-
-            # Output FR result to log container
-            json_str = json.dumps(result, indent=2)
-            output_filename =  file_name + '_FR_Result' + file_extension + ".json"
-            self.write_blob(azure_blob_log_storage_container, json_str, output_filename, file_directory)
-
-        return document_map
+                    }
 
     def num_tokens_from_string(self, string: str, encoding_name: str) -> int:
         """ Function to return the number of tokens in a text string"""
-        encoding = tiktoken.get_encoding(encoding_name)
+        encoding = get_encoding(encoding_name)
         num_tokens = len(encoding.encode(string))
         return num_tokens
 
@@ -356,8 +507,9 @@ class Utilities:
         return token_count
 
     def write_chunk(self, myblob_name, myblob_uri, file_number, chunk_size, chunk_text, page_list, 
-                    section_name, title_name, subtitle_name, file_class):
-        """ Function to write a json chunk to blob"""
+                    section_name, title_name, subtitle_name, file_class, uploader = None, offset = None, persist = True):
+        """ Function to write a json chunk to blob, in the background when a BlobUploader is given.
+        When persist is False the chunk is only built in memory and no file name or uri is returned for it """
         chunk_output = {
             'file_name': myblob_name,
             'file_uri': myblob_uri,
@@ -366,23 +518,28 @@ class Utilities:
             'title': title_name,
             'subtitle': subtitle_name,
             'section': section_name,
-            'pages': page_list,
+            'pages': list(page_list), # copied, the caller keeps adding the pages of the paragraphs that follow a split paragraph
+            'offset': offset,
             'token_count': chunk_size,
             'content': chunk_text                       
         }
+        if not persist:
+            return [chunk_output, None, None]
+
         # Get path and file name minus the root container
         file_name, file_extension, file_directory = self.get_filename_and_extension(myblob_name)
-        blob_service_client = BlobServiceClient(
-            self.azure_blob_storage_endpoint,
-            self.azure_blob_storage_key)
-        json_str = json.dumps(chunk_output, indent=2, ensure_ascii=False)
+        blob_service_client = self.get_blob_service_client()
+        json_str, content_settings = self.encode_output(chunk_output)
         blob_child_path=self.build_chunk_filepath(file_directory, file_name, file_extension, file_number) # New
-        block_blob_client = blob_service_client.get_blob_client(
-            container=self.azure_blob_content_storage_container,
-            # blob=self.build_chunk_filepath(file_directory, file_name, file_extension, file_number)
-            blob = blob_child_path
-            )
-        block_blob_client.upload_blob(json_str, overwrite=True)
+        if uploader is not None:
+            uploader.submit(blob_child_path, json_str, content_settings=content_settings)
+        else:
+            block_blob_client = blob_service_client.get_blob_client(
+                container=self.azure_blob_content_storage_container,
+                # blob=self.build_chunk_filepath(file_directory, file_name, file_extension, file_number)
+                blob = blob_child_path
+                )
+            block_blob_client.upload_blob(json_str, overwrite=True, content_settings=content_settings)
 
         # New
         return [chunk_output, blob_child_path, f'{self.azure_blob_storage_endpoint}{self.azure_blob_content_storage_container}/{blob_child_path}']
@@ -397,76 +554,95 @@ class Utilities:
     previous_table_header = ""
     
     def chunk_table_with_headers(self, prefix_text, table_html, standard_chunk_target_size, 
-                                 previous_paragraph_element_is_a_table):
-        soup = BeautifulSoup(table_html, 'html.parser')
-        thead = str(soup.find('thead'))
-          
+                                 previous_paragraph_element_is_a_table, prefix_head = None):
+        """ Function to split a table into chunks of rows below the target size, each chunk after the first starting with the header rows.
+        The rows of tables rendered by table_to_html are used as they are, other HTML is parsed.
+        prefix_head is the inner HTML of the first thead in prefix_text, if any """
+        if not isinstance(table_html, TableHtml):
+            table_html = parse_table_html(table_html)
+        head = table_html.head
+
         # check if this table is a continuation of a table on a previous page. 
         # If yes then apply the header row from the previous table
-        if previous_paragraph_element_is_a_table:
-            if thead != "":
-                # update thead to include the main table header
-                thead = thead.replace("<thead>", "<thead>"+self.previous_table_header)
-            
-            else:
-                # just use the previoud thead
-                thead = "<thead>"+self.previous_table_header+"</thead>"    
+        if previous_paragraph_element_is_a_table and head is not None:
+            # update thead to include the main table header
+            head = self.previous_table_header + head
+        # A table without a thead has always started its later chunks with "None", the str() of the thead BeautifulSoup did not find
+        thead = "None" if head is None else f"<thead>{head}</thead>"
 
-        def add_current_table_chunk(chunk):
+        def add_current_table_chunk(chunk, chunk_head):
             # Close the table tag for the current chunk and add it to the chunks list
             if chunk.strip() and not chunk.endswith("<table>"):
-                chunk = '<table>' + chunk + '</table>'
-                chunks.append(chunk)
-                # Start a new chunk with header if it exists                
+                chunks.append(TableHtml('<table>' + chunk + '</table>', chunk_head))
         
         # Initialize chunks list
         chunks = []
-        current_chunk = prefix_text
+        current_chunk = TokenCounter(prefix_text)
+        current_chunk_head = prefix_head
         # set the target size of the first chunk 
-        chunk_target_size = standard_chunk_target_size - self.token_count(prefix_text)
-        rows = soup.find_all('tr')
-        # Filter out rows that are part of thead block
-        filtered_rows = [row for row in rows if row.parent.name != "thead"] 
+        chunk_target_size = standard_chunk_target_size - current_chunk.count
                
-        for i, row in enumerate(filtered_rows):
-            row_html = str(row)
-
+        for row_html in table_html.body_rows:
             # If adding this row to the current chunk exceeds the target size, start a new chunk
-            if self.token_count(current_chunk + row_html) > chunk_target_size:
-                add_current_table_chunk(current_chunk)    
-                current_chunk = thead
+            if current_chunk.count_appended(row_html) > chunk_target_size:
+                add_current_table_chunk(current_chunk.text, current_chunk_head)
+                # Start a new chunk with header if it exists
+                current_chunk = TokenCounter(thead)
+                current_chunk_head = head
                 chunk_target_size = standard_chunk_target_size                
 
             # Add the current row to the chunk
-            current_chunk += row_html
+            current_chunk.append(row_html)
 
         # Add the final chunk if there's any content left
-        add_current_table_chunk(current_chunk)      
+        add_current_table_chunk(current_chunk.text, current_chunk_head)
 
         return chunks
     
-    def build_chunks(self, document_map, myblob_name, myblob_uri, chunk_target_size):
+    def get_table_head(self, table_html):
+        """ Function to return the inner HTML of the thead of table HTML, None when it has none """
+        if not isinstance(table_html, TableHtml):
+            table_html = parse_table_html(table_html)
+        return table_html.head
+
+    def build_chunks(self, document_map, myblob_name, myblob_uri, chunk_target_size, uploader = None, persist_chunks = True):
         """ Function to build chunk outputs based on the document map """
 
+        # New
+        # chunk_paths = [] # Array of arrays holding blob uri paths to the chunk files required by the chunks queue
+        chunk_outputs = list(self.iter_chunks(document_map['structure'], myblob_name, myblob_uri, chunk_target_size, uploader, persist_chunks)) # Array of chunk_output dictionaries which may be too granual, these chunks will be merged to form bigger chunks that can be sent to LLM prompt.
+
+        logging.info("Chunking is complete \n")
+        return len(chunk_outputs), chunk_outputs
+
+    def iter_chunks(self, paragraphs, myblob_name, myblob_uri, chunk_target_size, uploader = None, persist_chunks = True):
+        """ Generator to write chunks from an iterable of document map paragraphs, yielding each
+        chunk output as soon as the chunk is closed. Chunks are only kept in memory when persist_chunks is False """
+
+        paragraphs = iter(paragraphs)
+        paragraph_element = next(paragraphs, None)
+        if paragraph_element is None:
+            raise ValueError("Document map has no paragraphs to chunk")
+
         chunk_text = ''
+        chunk_head = None # inner HTML of the first thead in chunk_text
         chunk_size = 0
+        chunk_offset = paragraph_element["offset"] # offset in the analyzed content of the first paragraph in the chunk
         file_number = 0
         page_number = 0
-        previous_section_name = document_map['structure'][0]['section']
-        previous_title_name = document_map['structure'][0]["title"]
-        previous_subtitle_name = document_map['structure'][0]["subtitle"]
+        previous_section_name = paragraph_element['section']
+        previous_title_name = paragraph_element["title"]
+        previous_subtitle_name = paragraph_element["subtitle"]
+        previous_paragraph_element_is_a_table = False
         page_list = []
-        chunk_count = 0
-
-        # New
-        # chunk_paths = [] # Array of arrays holding blob uri paths to the chunk files required by the chunks queue
-        chunk_outputs = [] # Array of chunk_output dictionaries which may be too granual, these chunks will be merged to form bigger chunks that can be sent to LLM prompt.
 
         # iterate over the paragraphs and build a chuck based on a section
-        # and/or title of the document
-        for index, paragraph_element in enumerate(document_map['structure']):
+        # and/or title of the document, looking one paragraph ahead to spot the last one
+        while paragraph_element is not None:
+            next_paragraph_element = next(paragraphs, None)
             paragraph_size = self.token_count(paragraph_element["text"])
             paragraph_text = paragraph_element["text"]
+            paragraph_head = self.get_table_head(paragraph_text) if paragraph_element["type"] == "table" else None
             section_name = paragraph_element["section"]
             title_name = paragraph_element["title"]
             subtitle_name = paragraph_element["subtitle"]
@@ -488,7 +664,8 @@ class Utilities:
                         table_chunks = self.chunk_table_with_headers(chunk_text, 
                                                                      paragraph_text, 
                                                                      chunk_target_size,
-                                                                     previous_paragraph_element_is_a_table)
+                                                                     previous_paragraph_element_is_a_table,
+                                                                     chunk_head)
                         
                         for i, table_chunk in enumerate(table_chunks):
                                                    
@@ -501,16 +678,18 @@ class Utilities:
                                                 self.token_count(table_chunk),
                                                 table_chunk, page_list,
                                                 previous_section_name, previous_title_name, previous_subtitle_name, 
-                                                MediaType.TEXT)
-                                chunk_outputs.append(chunk_output)
-                                chunk_count += 1      
+                                                MediaType.TEXT, uploader,
+                                                chunk_offset if i == 0 and chunk_text else paragraph_element["offset"], persist_chunks)
+                                yield chunk_output
                             else:
                                 # Reset the paragraph token count to just the tokens left in the last
                                 # chunk and leave the remaining text from the large paragraph to be
                                 # combined with the next in the outer loop
                                 paragraph_size = self.token_count(table_chunk)
                                 paragraph_text = table_chunk
+                                paragraph_head = table_chunk.head
                                 chunk_text = ''
+                                chunk_head = None
                                 file_number += 1                                
                                         
                     else:
@@ -520,38 +699,40 @@ class Utilities:
                         # sub-chunks that are below the CHUNK_TARGET_SIZE
                         sentences = sent_tokenize(chunk_text + paragraph_text)
                         chunks = []
-                        chunk = ""
+                        chunk = TokenCounter()
                         for sentence in sentences:
-                            temp_chunk = chunk + " " + sentence if chunk else sentence
-                            if self.token_count(temp_chunk) <= chunk_target_size:
-                                chunk = temp_chunk
+                            sentence_text = " " + sentence if chunk.text else sentence
+                            if chunk.count_appended(sentence_text) <= chunk_target_size:
+                                chunk.append(sentence_text)
                             else:
                                 chunks.append(chunk)
-                                chunk = sentence
-                        if chunk:
+                                chunk = TokenCounter(sentence)
+                        if chunk.text:
                             chunks.append(chunk)
 
                         # Now write out each chunk, apart from the last, as this will be less than or
                         # equal to CHUNK_TARGET_SIZE the last chunk will be processed like
                         # a regular paragraph
-                        for i, chunk_text_p in enumerate(chunks):
+                        for i, chunk_p in enumerate(chunks):
                             if i < len(chunks) - 1:
                                 # Process all but the last chunk in this large para
                                 chunk_output=self.write_chunk(myblob_name, myblob_uri,
                                                 f"{file_number}.{i}",
-                                                self.token_count(chunk_text_p),
-                                                chunk_text_p, page_list,
+                                                chunk_p.count,
+                                                chunk_p.text, page_list,
                                                 previous_section_name, previous_title_name, previous_subtitle_name, 
-                                                MediaType.TEXT)
-                                chunk_outputs.append(chunk_output)
-                                chunk_count += 1
+                                                MediaType.TEXT, uploader,
+                                                chunk_offset if i == 0 and chunk_text else paragraph_element["offset"], persist_chunks)
+                                yield chunk_output
                             else:
                                 # Reset the paragraph token count to just the tokens left in the last
                                 # chunk and leave the remaining text from the large paragraph to be
                                 # combined with the next in the outer loop
-                                paragraph_size = self.token_count(chunk_text_p)
-                                paragraph_text = chunk_text_p
+                                paragraph_size = chunk_p.count
+                                paragraph_text = chunk_p.text
+                                paragraph_head = None
                                 chunk_text = ''
+                                chunk_head = None
                                 file_number += 1
                 else:
                     # if this para is not large by itself but will put us over the max token count
@@ -559,14 +740,14 @@ class Utilities:
                     chunk_output=self.write_chunk(myblob_name, myblob_uri, file_number,
                                      chunk_size, chunk_text, page_list,
                                      previous_section_name, previous_title_name, previous_subtitle_name,
-                                     MediaType.TEXT)
-                    chunk_outputs.append(chunk_output)
-                    chunk_count += 1
+                                     MediaType.TEXT, uploader, chunk_offset, persist_chunks)
+                    yield chunk_output
 
                     # reset chunk specific variables
                     file_number += 1
                     page_list = []
                     chunk_text = ''
+                    chunk_head = None
                     chunk_size = 0
                     page_number = 0
 
@@ -576,8 +757,12 @@ class Utilities:
                 page_number = paragraph_element["page_number"]
 
             # add paragraph to the chunk
+            if chunk_text == '':
+                chunk_offset = paragraph_element["offset"]
             chunk_size = chunk_size + paragraph_size
             chunk_text = chunk_text + "\n" + paragraph_text
+            if chunk_head is None:
+                chunk_head = paragraph_head
             
             # store the type of paragraph and content, to be used if a table crosses page boundaries and
             # we need to apply the column headings to subsequent pages
@@ -587,141 +772,179 @@ class Utilities:
                 if self.previous_table_header == "":
                     # Stash the current tables heading to apply to subsequent page tables if they are missing column headings,
                     # but only for the first page of the multi-page table
-                    soup = BeautifulSoup(paragraph_text, 'html.parser')
-                    # Extract the thead and strip the thead wrapper to just leave the header cells
-                    self.previous_table_header = str(soup.find('thead'))
-                    self.previous_table_header = self.previous_table_header.replace("<thead>", "").replace("</thead>", "")
+                    # Keep just the header cells of the thead, "None" when there is none
+                    self.previous_table_header = "None" if paragraph_head is None else paragraph_head
             else:
                 previous_paragraph_element_is_a_table = False
                 self.previous_table_header = ""
             
             # If this is the last paragraph then write the chunk
-            if index == len(document_map['structure'])-1:
+            if next_paragraph_element is None:
                 chunk_output = self.write_chunk(myblob_name, myblob_uri, file_number, chunk_size,
                                  chunk_text, page_list, section_name, title_name, previous_subtitle_name,
-                                 MediaType.TEXT)
-                chunk_outputs.append(chunk_output)
-                chunk_count += 1
+                                 MediaType.TEXT, uploader, chunk_offset, persist_chunks)
+                yield chunk_output
 
             previous_section_name = section_name
             previous_title_name = title_name
             previous_subtitle_name = subtitle_name
-
-        logging.info("Chunking is complete \n")
-        return chunk_count, chunk_outputs
+            paragraph_element = next_paragraph_element
 
 
     # New
-    def build_merged_chunks(self, granular_chunk_outputs, myblob_name, myblob_uri, merged_chunk_target_size):
+    def build_merged_chunks(self, granular_chunk_outputs, myblob_name, myblob_uri, merged_chunk_target_size, uploader = None):
         """Function combines the chunks to create bigger chunks that can be passed to the LLM prompt."""
 
+        merged_chunk_paths = list(self.iter_merged_chunks(granular_chunk_outputs, myblob_name, myblob_uri, merged_chunk_target_size, uploader))
+
+        logging.info("Chunk merging is complete \n")
+        return len(merged_chunk_paths), merged_chunk_paths
+
+    def iter_merged_chunks(self, granular_chunk_outputs, myblob_name, myblob_uri, merged_chunk_target_size, uploader = None):
+        """Generator combining an iterable of chunks into bigger chunks, yielding the path of each merged
+        chunk as soon as it is written so it can be queued while later chunks are still being built.
+        Chunks are grouped by plan_merged_chunks over a window of chunks at a time."""
+
         # Save merged chunks under a separate sub-directory
         merge_content_dir = "merged"
 
         # These do not reset
         file_number = 0        
-        merged_chunk_count = 0
-        merged_chunk_paths = []
-        loop_counter = 0
-
-        # These reset within loop
-        merged_chunk_size = 0
-        merged_content = ""
-        merged_page_list = []
-        merged_file_names = []
-        merged_file_uris = []
-
-        previous_title = ""
-        previous_subtitle = ""
-        previous_section = ""
-
-        for chunk_data in granular_chunk_outputs:
-        # for granular_chunk_output in granular_chunk_outputs:                    
-            
-            granular_chunk_output = chunk_data[0]
-
-            # May execute more than once
-            if (merged_chunk_size + granular_chunk_output["token_count"] > merged_chunk_target_size):               
 
+        def write_merged_chunks(chunk_window, groups):
+            nonlocal file_number
+            for start, end, merged_content, merged_chunk_size in groups:
+                merged_chunks = chunk_window[start:end]
+                # Chunks that were not persisted have no file name or uri, only their offset is kept
+                merged_file_names = [chunk_data[1] for chunk_data in merged_chunks if chunk_data[1] is not None] # Chunked file names that are merged together
+                merged_file_uris = [chunk_data[2] for chunk_data in merged_chunks if chunk_data[1] is not None]  # Chunked file blob uri that are merged together
+                merged_offsets = [chunk_data[0].get("offset") for chunk_data in merged_chunks]
                 # De-diplicate and sort
-                merged_page_list = sorted(list(set(merged_page_list)))
-                
-                # Write to blob
-                merged_chunk_path = self.write_merged_chunk(myblob_name, myblob_uri, file_number, merged_chunk_size, merged_content, merged_page_list, 
-                                                            merged_file_names, merged_file_uris, MediaType.TEXT, merge_content_dir)
-                merged_chunk_paths.append(merged_chunk_path)
-
-                # Reset
-                merged_chunk_size = 0
-                merged_content = ""
-                merged_page_list = []
-                merged_file_names = []
-                merged_file_uris = []
+                merged_page_list = sorted(set(page for chunk_data in merged_chunks for page in chunk_data[0]["pages"]))
 
-                previous_title = ""
-                previous_subtitle = ""
-                previous_section = ""
-
-                file_number += 1
-                merged_chunk_count += 1
-
-            # Merge chunks core part start ---------------------------------------------------------------------------
-
-            # Optimise title / subtitle duplication, don't add if it is unchanged        
-            if previous_title == "" or previous_title != granular_chunk_output["title"]:
-                 merged_content = merged_content + " " + "TITLE: " + granular_chunk_output["title"]
-            if previous_subtitle == "" or previous_subtitle != granular_chunk_output["subtitle"]:
-                 merged_content = merged_content + " " + "SUBTITLE: " + granular_chunk_output["subtitle"]
-            if previous_section == "" or previous_section != granular_chunk_output["section"]:
-                 merged_content = merged_content + " " + "SECTION: " + granular_chunk_output["section"]
-            
-            merged_content = merged_content + " " + "CONTENT: " + granular_chunk_output["content"]
-
-            merged_file_names.append(chunk_data[1]) # Chunked file names that are merged together 
-            merged_file_uris.append(chunk_data[2])  # Chunked file blob uri that are merged together 
-
-            merged_page_list.extend(granular_chunk_output["pages"])
-            merged_chunk_size += granular_chunk_output["token_count"]
-
-            # Merge chunks core part end ---------------------------------------------------------------------------
-
-            # If this is the last cycle of the loop will execute only once max.
-            if (loop_counter + 1 == len(granular_chunk_outputs)):                
-                
-                # De-diplicate and sort
-                merged_page_list = sorted(list(set(merged_page_list)))
-                
                 # Write to blob
-                merged_chunk_path = self.write_merged_chunk(myblob_name, myblob_uri, file_number, merged_chunk_size, merged_content, merged_page_list, 
-                                                            merged_file_names, merged_file_uris, MediaType.TEXT, merge_content_dir)
-                merged_chunk_paths.append(merged_chunk_path)
-
-                # Reset
-                merged_chunk_size = 0
-                merged_content = ""
-                merged_page_list = []
-                merged_file_names = []
-                merged_file_uris = []
-
-                previous_title = ""
-                previous_subtitle = ""
-                previous_section = ""
-
+                yield self.write_merged_chunk(myblob_name, myblob_uri, file_number, merged_chunk_size, merged_content, merged_page_list, 
+                                              merged_file_names, merged_file_uris, MediaType.TEXT, merge_content_dir, uploader, merged_offsets)
                 file_number += 1
-                merged_chunk_count += 1
-
-            previous_title = granular_chunk_output["title"]
-            previous_subtitle = granular_chunk_output["subtitle"]
-            previous_section = granular_chunk_output["section"]
 
-            loop_counter += 1
-
-        logging.info("Chunk merging is complete \n")
-        return merged_chunk_count, merged_chunk_paths        
+        chunk_window = []
+        # Token counts of the chunks' content, kept for the chunks planned again in the next window
+        content_counts = []
+        window_size = 0
+        for chunk_data in granular_chunk_outputs:
+            chunk_window.append(chunk_data)
+            content_counts.append(self.token_count(self.get_merged_chunk_content(chunk_data[0])))
+            window_size += content_counts[-1]
+            if window_size >= MERGED_CHUNK_PLAN_WINDOW * merged_chunk_target_size:
+                # Write the merged chunks before the last one, the chunks left are planned again with the chunks that follow them
+                groups = self.plan_merged_chunks([chunk_data[0] for chunk_data in chunk_window], merged_chunk_target_size, False, content_counts)
+                yield from write_merged_chunks(chunk_window, groups)
+                if groups:
+                    chunk_window = chunk_window[groups[-1][1]:]
+                    content_counts = content_counts[groups[-1][1]:]
+                    window_size = sum(content_counts)
+
+        # Write out what is left once the last chunk has been merged
+        if chunk_window:
+            yield from write_merged_chunks(chunk_window, self.plan_merged_chunks([chunk_data[0] for chunk_data in chunk_window], merged_chunk_target_size,
+                                                                                 True, content_counts))
+
+    def get_merged_chunk_labels(self, granular_chunk_output, previous_chunk_output = None):
+        """ Function to return the title, subtitle and section labels put before a chunk's content in a merged chunk,
+        the ones that changed since the previous chunk in the merged chunk or all of them for the first """
+        labels = []
+        # Optimise title / subtitle duplication, don't add if it is unchanged
+        for label, key in (("TITLE", "title"), ("SUBTITLE", "subtitle"), ("SECTION", "section")):
+            if previous_chunk_output is None or previous_chunk_output[key] == "" or previous_chunk_output[key] != granular_chunk_output[key]:
+                labels.append(f" {label}: {granular_chunk_output[key]}")
+        return "".join(labels)
+
+    def get_merged_chunk_content(self, granular_chunk_output):
+        """ Function to return a chunk's content as it is put in a merged chunk, after its labels """
+        return " CONTENT: " + granular_chunk_output["content"]
+
+    def plan_merged_chunks(self, granular_chunk_outputs, merged_chunk_target_size, complete = True, content_counts = None):
+        """ Function to group a list of chunks into merged chunks no larger than merged_chunk_target_size tokens, counted
+        exactly on the merged content with its labels. Plans the fewest merged chunks, then the most even sizes, preferring
+        to start a merged chunk at a new title, subtitle or section. A chunk larger than the target is merged on its own.
+        When complete is False, more chunks follow the list. The last merged chunk is then left out, along with the chunks
+        up to where packing each merged chunk full would have started it, so planning window by window makes as many
+        merged chunks as packing each one full would.
+        content_counts, the token counts of get_merged_chunk_content for each chunk, are counted here when not given.
+        Returns the start and end index, merged content and token count of each merged chunk """
+        chunk_count = len(granular_chunk_outputs)
+        contents = [self.get_merged_chunk_content(chunk_output) for chunk_output in granular_chunk_outputs]
+        if content_counts is None:
+            content_counts = [self.token_count(content) for content in contents]
+        label_counts = {}
+        first_labels = [self.get_merged_chunk_labels(chunk_output) for chunk_output in granular_chunk_outputs]
+        next_labels = [None] + [self.get_merged_chunk_labels(granular_chunk_outputs[i], granular_chunk_outputs[i - 1]) for i in range(1, chunk_count)]
+
+        def count_piece(labels, i):
+            # Token counts add up across a point after text that does not end in whitespace, see TokenCounter
+            if labels == "":
+                return content_counts[i]
+            if labels[-1].isspace():
+                return self.token_count(labels + contents[i])
+            if labels not in label_counts:
+                label_counts[labels] = self.token_count(labels)
+            return label_counts[labels] + content_counts[i]
+
+        def join_pieces(start, end):
+            return "".join([first_labels[start], contents[start]] + [next_labels[i] + contents[i] for i in range(start + 1, end)])
+
+        first_counts = [count_piece(first_labels[i], i) for i in range(chunk_count)]
+        next_counts = [None] + [count_piece(next_labels[i], i) for i in range(1, chunk_count)]
+
+        # best[end] is the (merged chunk count, cost) of the best plan for the chunks before end, reached by a merged chunk from start_of[end]
+        best = [(0, 0.0)] + [None] * chunk_count
+        start_of = [0] * (chunk_count + 1)
+        size_of = [0] * (chunk_count + 1)
+        for start in range(chunk_count):
+            split_cost = 0.0
+            if start > 0 and all(granular_chunk_outputs[start][key] == granular_chunk_outputs[start - 1][key] for key in ("title", "subtitle", "section")):
+                split_cost = MID_SECTION_SPLIT_COST
+            size = first_counts[start]
+            # Only counted as a whole once a chunk ending in whitespace stops the counts adding up
+            merged_chunk = None
+            end = start + 1
+            while True:
+                if end > start + 1 and size > merged_chunk_target_size:
+                    break
+                fill = size / merged_chunk_target_size
+                plan = (best[start][0] + 1, best[start][1] + fill * fill + split_cost)
+                if best[end] is None or plan < best[end]:
+                    best[end] = plan
+                    start_of[end] = start
+                    size_of[end] = size
+                if end == chunk_count:
+                    break
+                if merged_chunk is None and contents[end - 1][-1].isspace():
+                    merged_chunk = TokenCounter(join_pieces(start, end))
+                if merged_chunk is not None:
+                    merged_chunk.append(next_labels[end] + contents[end])
+                    size = merged_chunk.count
+                else:
+                    size += next_counts[end]
+                end += 1
+
+        groups = []
+        end = chunk_count
+        if not complete:
+            # The furthest end the fewest merged chunks but one reach, which is where packing each one full would end them
+            end = max(end for end in range(chunk_count + 1) if best[end][0] == best[chunk_count][0] - 1)
+        while end > 0:
+            start = start_of[end]
+            merged_content = join_pieces(start, end)
+            groups.append((start, end, merged_content, size_of[end]))
+            end = start
+        groups.reverse()
+        return groups
 
     # New
-    def write_merged_chunk(self, myblob_name, myblob_uri, file_number, chunk_size, chunk_text, page_list, file_name_list, file_uri_list, file_class, merge_content_dir = 'merged'):
-        """ Function to write a json merged_chunk to blob"""
+    def write_merged_chunk(self, myblob_name, myblob_uri, file_number, chunk_size, chunk_text, page_list, file_name_list, file_uri_list, file_class, merge_content_dir = 'merged', uploader = None, offset_list = None):
+        """ Function to write a json merged_chunk to blob, in the background when a BlobUploader is given.
+        The merged file names and uris are left out when the chunks were not persisted, the offsets then identify them """
         chunk_output = {
             'file_name': myblob_name,
             'file_uri': myblob_uri,
@@ -733,26 +956,32 @@ class Utilities:
             # 'subtitle': subtitle_name,
             # 'section': section_name,
             'pages': page_list,
+            'offsets': offset_list,
             'token_count': chunk_size,
             'merged_content': chunk_text                       
         }
+        if not file_name_list:
+            del chunk_output['merged_file_names']
+            del chunk_output['merged_file_uris']
         # Get path and file name minus the root container
         file_name, file_extension, file_directory = self.get_filename_and_extension(myblob_name)
-        blob_service_client = BlobServiceClient(
-            self.azure_blob_storage_endpoint,
-            self.azure_blob_storage_key)
-        json_str = json.dumps(chunk_output, indent=2, ensure_ascii=False)
+        blob_service_client = self.get_blob_service_client()
+        json_str, content_settings = self.encode_output(chunk_output)
         blob_child_path=self.build_chunk_filepath(file_directory, file_name, file_extension + "/" + merge_content_dir, file_number) # New
         # print(f'blob_child_path:{blob_child_path}')
-        block_blob_client = blob_service_client.get_blob_client(
-            container=self.azure_blob_content_storage_container,
-            # blob=self.build_chunk_filepath(file_directory, file_name, file_extension, file_number)
-            blob = blob_child_path            
-            )
-        block_blob_client.upload_blob(json_str, 
-                                      overwrite=True,
-                                    #   metadata = {"prompt_id": "default"}
-                                      )
+        if uploader is not None:
+            uploader.submit(blob_child_path, json_str, content_settings=content_settings)
+        else:
+            block_blob_client = blob_service_client.get_blob_client(
+                container=self.azure_blob_content_storage_container,
+                # blob=self.build_chunk_filepath(file_directory, file_name, file_extension, file_number)
+                blob = blob_child_path            
+                )
+            block_blob_client.upload_blob(json_str, 
+                                          overwrite=True,
+                                          content_settings=content_settings
+                                        #   metadata = {"prompt_id": "default"}
+                                          )
 
         # New
         return [self.azure_blob_content_storage_container + '/' + blob_child_path, 
@@ -765,9 +994,7 @@ class Utilities:
 
         # Get path and file name minus the root container
         file_name, file_extension, file_directory = self.get_filename_and_extension(myblob_name)
-        blob_service_client = BlobServiceClient(
-            self.azure_blob_storage_endpoint,
-            self.azure_blob_storage_key)      
+        blob_service_client = self.get_blob_service_client()
 
         # file_name:WhatIsAOAI, file_extension:.pdf, file_directory:usermk/202403111240/
         # print(f"file_name:{file_name}, file_extension:{file_extension}, file_directory:{file_directory}")  
@@ -784,6 +1011,45 @@ class Utilities:
 
         return blob_metadata
     
+    def get_blob_content_md5(self, myblob_name, myblob_uri, content=None):
+        """ Function to return the hex MD5 of an uploaded blob, from its properties when the service recorded one, otherwise computed from its content """
+        file_name, file_extension, file_directory = self.get_filename_and_extension(myblob_name)
+        block_blob_client = self.get_blob_service_client().get_blob_client(
+            container=self.azure_blob_drop_storage_container,
+            blob = file_directory + file_name + file_extension
+            )
+
+        content_md5 = block_blob_client.get_blob_properties().content_settings.content_md5
+        if content_md5:
+            return bytes(content_md5).hex()
+        if content is None:
+            content = block_blob_client.download_blob().readall()
+        return hashlib.md5(content).hexdigest()
+
+    def get_doc_intel_result_path(self, content_md5, model, api_version):
+        """ Function to return the blob path a Document Intelligence result is stored at, keyed by the document content hash and the model / API version that analyzed it """
+        return f'doc_intel_results/{model}/{api_version}/{content_md5}.json'
+
+    def find_doc_intel_result(self, content_md5, model, api_version):
+        """ Function to return the stored Document Intelligence result of a document with the same content, None when there is none """
+        blob_child_path = self.get_doc_intel_result_path(content_md5, model, api_version)
+        block_blob_client = self.get_blob_service_client().get_blob_client(
+            container=self.azure_blob_content_storage_container,
+            blob = blob_child_path
+            )
+        if not block_blob_client.exists():
+            return None
+        return self.azure_blob_content_storage_container + '/' + blob_child_path
+
+    def store_doc_intel_result(self, content_md5, model, api_version, response_json):
+        """ Function to store a Document Intelligence result by content hash, so documents uploaded later with the same content reuse it """
+        json_str, content_settings = self.encode_output(response_json)
+        block_blob_client = self.get_blob_service_client().get_blob_client(
+            container=self.azure_blob_content_storage_container,
+            blob = self.get_doc_intel_result_path(content_md5, model, api_version)
+            )
+        block_blob_client.upload_blob(json_str, overwrite=True, content_settings=content_settings)
+
     # New
     def read_blob_content(self, myblob_name, myblob_uri):
         """Function to read blob data"""
@@ -792,9 +1058,7 @@ class Utilities:
         file_name, file_extension, file_directory = self.get_filename_and_extension(myblob_name)
         # file_name, file_extension, file_directory = self.get_filename_and_extension(myblob_uri)
         
-        blob_service_client = BlobServiceClient(
-            self.azure_blob_storage_endpoint,
-            self.azure_blob_storage_key)      
+        blob_service_client = self.get_blob_service_client()
 
         # file_name:WhatIsAOAI, file_extension:.pdf, file_directory:usermk/202403111240/
         # print(f"file_name:{file_name}, file_extension:{file_extension}, file_directory:{file_directory}")
@@ -807,13 +1071,14 @@ class Utilities:
             )
         
         # Read the content
-        blob_content = block_blob_client.download_blob().readall()
+        blob_content = self.decode_output(block_blob_client.download_blob().readall())
 
         return blob_content
 
     # New
-    def write_llm_output(self, myblob_name, myblob_uri, token_count, merged_content, page_list, file_name_list, file_uri_list, file_class, chunk_name, chunk_blob_uri, prompt_id, completions_response, output_content_dir = 'llm'):
-        """ Function to write a json containing the output of LLM prompt applied to a merged_chunk to blob storage"""
+    def write_llm_output(self, myblob_name, myblob_uri, token_count, merged_content, page_list, file_name_list, file_uri_list, file_class, chunk_name, chunk_blob_uri, prompt_id, completions_response, output_content_dir = 'llm', cached = False):
+        """ Function to write a json containing the output of LLM prompt applied to a merged_chunk to blob storage.
+        cached marks outputs whose completion was taken from the LLM response cache rather than requested """
         llm_output = {
             'file_name': myblob_name,
             'file_uri': myblob_uri,
@@ -830,18 +1095,27 @@ class Utilities:
             'chunk_name': chunk_name,
             'chunk_blob_uri': chunk_blob_uri,
             'prompt_id': prompt_id,
-            'completions_response': completions_response                      
+            'completions_response': completions_response,
+            'cached': cached
         }        
 
+        # The merged content can be read from chunk_blob_uri, so a compact output keeps only the completion itself
+        if self.compact_llm_output:
+            del llm_output['merged_content']
+            llm_output['completions_response'] = {
+                'id': completions_response.get('id'),
+                'model': completions_response.get('model'),
+                'choices': [{'finish_reason': choice.get('finish_reason'), 'message': choice.get('message')} for choice in completions_response.get('choices', [])],
+                'usage': completions_response.get('usage')
+            }
+
         # Get path and file name minus the root container
         file_name, file_extension, file_directory = self.get_filename_and_extension(chunk_name)
         # print(f"file_name:{file_name}, file_extension:{file_extension}, file_directory:{file_directory}")
 
-        blob_service_client = BlobServiceClient(
-            self.azure_blob_storage_endpoint,
-            self.azure_blob_storage_key)
+        blob_service_client = self.get_blob_service_client()
         
-        json_str = json.dumps(llm_output, indent=2, ensure_ascii=False)        
+        json_str, content_settings = self.encode_output(llm_output)
         # print(f'json_str:{json_str}')
 
         blob_child_path= file_directory + output_content_dir + '/' + file_name + file_extension  # New
@@ -853,6 +1127,7 @@ class Utilities:
         
         block_blob_client.upload_blob(json_str, 
                                       overwrite=True,
+                                      content_settings=content_settings
                                     #   metadata = {"prompt_id": "default"}
                                       )
         
@@ -868,11 +1143,9 @@ class Utilities:
         file_name, file_extension, file_directory = self.get_filename_and_extension(myblob_name)        
         # print(f"file_name:{file_name}, file_extension:{file_extension}, file_directory:{file_directory}")
 
-        blob_service_client = BlobServiceClient(
-            self.azure_blob_storage_endpoint,
-            self.azure_blob_storage_key)
+        blob_service_client = self.get_blob_service_client()
         
-        json_str = json.dumps(response_json, indent=2, ensure_ascii=False)        
+        json_str, content_settings = self.encode_output(response_json)
         # print(f'json_str:{json_str}')
 
         blob_child_path= file_directory + file_name + file_extension + '/' + output_content_dir + '/' + file_name + '_doc_intel.json'  # New
@@ -885,6 +1158,7 @@ class Utilities:
         
         block_blob_client.upload_blob(json_str, 
                                       overwrite=True,
+                                      content_settings=content_settings
                                     #   metadata = {"prompt_id": "default"}
                                       )
         
@@ -893,11 +1167,14 @@ class Utilities:
 
     # New
     # For both chat completion and embedding enpoint use
-    def get_aoai_endpoint(self, endpoint, key, deployment_id):
+    def get_aoai_endpoint(self, endpoint, key, deployment_id, quota_scheduler=None, estimated_tokens=0):
         '''Simple distribution of calls to given list of endpoints.
         When single endpoint given, always returns same endpoint / key / deployment id combination.
         When given delimited list (pipe | separated), returns randomly picked combination of endpoint / key / deployment id.
 
+        When given a quota_scheduler (see create_quota_scheduler), the request is charged estimated_tokens and the
+        combination with the most TPM / RPM headroom is returned instead. Raises QuotaExhausted when none can admit it.
+
         Can be given chat completion or embedding model endpoints.
         '''
 
@@ -908,6 +1185,11 @@ class Utilities:
         
         assert len(endpoint_list) == len(key_list) and  len(key_list) == len(deployment_id_list)    
         
+        if quota_scheduler is not None:
+            endpoint_names = [self.get_aoai_endpoint_name(e, d) for e, d in zip(endpoint_list, deployment_id_list)]
+            index = endpoint_names.index(quota_scheduler.acquire(estimated_tokens))
+            return endpoint_list[index], key_list[index], deployment_id_list[index]
+
         # Get the current time  
         now = datetime.now()  
 
@@ -919,12 +1201,30 @@ class Utilities:
 
         return endpoint_list[index], key_list[index], deployment_id_list[index]
 
+    def get_aoai_endpoint_name(self, endpoint, deployment_id):
+        """ Function to return the name an endpoint / deployment id combination is budgeted under """
+        return f"{endpoint.rstrip('/')}/{deployment_id}"
+
+    def create_quota_scheduler(self, endpoint, deployment_id, tpm_limit, rpm_limit, store, sync_interval=DEFAULT_QUOTA_SYNC_SECONDS):
+        """ Function to return a QuotaScheduler for the given endpoints, None when no TPM or RPM limit is set.
+        Limits are given as pipe separated lists in the same order as the endpoints, or as one value for all.
+        The charges made in the process are synced with the budget in store every sync_interval seconds. """
+        endpoint_list = [e for e in endpoint.split('|') if e != '']
+        deployment_id_list = [d for d in deployment_id.split('|') if d != '']
+        tpm_limits = parse_limits(tpm_limit, len(endpoint_list))
+        rpm_limits = parse_limits(rpm_limit, len(endpoint_list))
+        if not any(tpm_limits) and not any(rpm_limits):
+            return None
+        endpoint_names = [self.get_aoai_endpoint_name(e, d) for e, d in zip(endpoint_list, deployment_id_list)]
+        return QuotaScheduler(endpoint_names, tpm_limits, rpm_limits, store, sync_interval=sync_interval)
+
     # New
-    def get_document_intel_endpoint(self, endpoint, key):
+    def get_document_intel_endpoint(self, endpoint, key, router=None):
         '''Simple distribution of calls to given list of endpoints.
         When single endpoint given, always returns same endpoint / key combination.
         When given delimited list (pipe | separated), returns randomly picked combination of endpoint / key.
-        
+
+        When given an EndpointRouter, the index it selects is returned instead, favouring healthy and fast endpoints.
         '''
 
         # Convert delimted values to lists
@@ -933,6 +1233,9 @@ class Utilities:
         
         assert len(endpoint_list) == len(key_list)
         
+        if router is not None:
+            return router.select(), endpoint_list, key_list
+
         # Get the current time  
         now = datetime.now()  
 
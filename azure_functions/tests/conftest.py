@@ -0,0 +1,77 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Fixtures shared by the tests of the function app. Run from the repository root with python -m pytest azure_functions/tests """
+import os
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FUNCTIONS_DIR)
+
+# Blob properties the service returns as response headers, keyed by the request header they are set with on upload
+BLOB_PROPERTY_HEADERS = {
+    "x-ms-blob-content-type": "Content-Type",
+    "x-ms-blob-content-encoding": "Content-Encoding",
+}
+
+
+class BlobStorageHandler(BaseHTTPRequestHandler):
+    """ Serves Put Blob and Get Blob from memory the way the storage service does, so the real BlobClient is exercised """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        headers = {header: self.headers[request_header] for request_header, header in BLOB_PROPERTY_HEADERS.items()
+                   if self.headers.get(request_header)}
+        self.server.blobs[urllib.parse.urlparse(self.path).path] = (body, headers)
+        self.send_response(201)
+        self.send_header("ETag", '"0x1"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        blob = self.server.blobs.get(urllib.parse.urlparse(self.path).path)
+        if blob is None:
+            self.send_response(404)
+            self.send_header("x-ms-error-code", "BlobNotFound")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body, headers = blob
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Range", f"bytes 0-{len(body) - 1}/{len(body)}")
+        self.send_header("x-ms-blob-type", "BlockBlob")
+        self.send_header("ETag", '"0x1"')
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def blob_server():
+    """ Returns a local blob service keeping blobs in memory, blobs maps each blob's path to its body and headers """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BlobStorageHandler)
+    server.blobs = {}
+    server.endpoint = f"http://127.0.0.1:{server.server_port}/devstoreaccount1/"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def blob_endpoint(blob_server):
+    """ Returns the endpoint of a local blob service keeping blobs in memory """
+    return blob_server.endpoint
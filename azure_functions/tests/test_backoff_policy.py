@@ -0,0 +1,22 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Requeue delays of a message counted by several attempt counters """
+from shared_code.backoff_policy import BackoffPolicy, get_backoff_key
+
+
+def test_schedule_keeps_a_delay_per_counter():
+    poll_backoff_policy = BackoffPolicy(5, 600)
+    resubmit_backoff_policy = BackoffPolicy(60, 600)
+    message_json = {"polling_queue_count": 1, "submit_queued_count": 1}
+
+    # Throttled polls carrying a long Retry-After must not lengthen the next resubmission
+    for _ in range(3):
+        poll_backoff_policy.schedule(message_json, "polling_queue_count", {"retry-after": "500"})
+    delay = resubmit_backoff_policy.schedule(message_json, "submit_queued_count")
+
+    assert message_json["polling_queue_count"] == 4
+    assert message_json["submit_queued_count"] == 2
+    assert message_json[get_backoff_key("polling_queue_count")] >= 500
+    assert 60 <= delay <= 180
+    assert message_json[get_backoff_key("submit_queued_count")] == delay
@@ -0,0 +1,126 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Parity of build_document_map_pdf with the per-character implementation it replaced.
+
+fixtures/document_map_baseline.json holds the structure the previous build_document_map_pdf built for the layout of
+each seed below, before spans were labelled with slices. Regenerate it, by writing build_structures() to it as json,
+only for a deliberate change of the document map.
+"""
+import base64
+import json
+import os
+import random
+
+import pytest
+
+from shared_code.utilities import Utilities
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "document_map_baseline.json")
+SEEDS = range(150)
+WORDS = ("the of and to in is that for it as with was on be by this are or from at an which revenue contract "
+         "party agreement section clause shall herein thereof & < > \" ' Dr. 12,345.67").split()
+
+
+def sentence(rng, word_count):
+    text = " ".join(rng.choice(WORDS) for _ in range(word_count))
+    return text[0].upper() + text[1:] + rng.choice([".", "?", "!"])
+
+
+def layout(seed):
+    """ Function to return a random prebuilt-layout analyzeResult: titles, section headings, page headers and numbers,
+    paragraphs and tables, some tables split over two spans, plus overlapping and zero length paragraphs """
+    rng = random.Random(seed)
+    content = []
+    position = 0
+    paragraphs, tables = [], []
+
+    def add(text):
+        nonlocal position
+        offset = position
+        content.append(text + "\n")
+        position += len(text) + 1
+        return offset
+
+    def add_paragraph(text, page_number, role=None):
+        paragraph = {"content": text, "spans": [{"offset": add(text), "length": len(text)}], "boundingRegions": [{"pageNumber": page_number}]}
+        if role is not None:
+            paragraph["role"] = role
+        paragraphs.append(paragraph)
+
+    add_paragraph(sentence(rng, 4), 1, rng.choice([None, "title"]))
+    page_count = rng.randint(1, 3)
+    for page_number in range(1, page_count + 1):
+        if rng.random() < 0.5:
+            add_paragraph(f"Page header {page_number}", page_number, "pageHeader")
+        for _ in range(rng.randint(2, 6)):
+            draw = rng.random()
+            if draw < 0.1:
+                add_paragraph(sentence(rng, 3), page_number, "title")
+            elif draw < 0.25:
+                add_paragraph(sentence(rng, 4), page_number, "sectionHeading")
+            elif draw < 0.45:
+                row_count, column_count = rng.randint(1, 5), rng.randint(1, 4)
+                header_rows = rng.randint(0, 2)
+                start = position
+                cells = []
+                for row_index in range(row_count):
+                    for column_index in range(column_count):
+                        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+                        cell = {"rowIndex": row_index, "columnIndex": column_index, "content": text, "spans": [{"offset": add(text), "length": len(text)}]}
+                        if row_index < header_rows:
+                            cell["kind"] = "columnHeader"
+                        if rng.random() < 0.05:
+                            cell["columnSpan"] = 2
+                        cells.append(cell)
+                        paragraphs.append({"content": text, "spans": cell["spans"], "boundingRegions": [{"pageNumber": page_number}]})
+                rng.shuffle(cells)
+                length = position - start - 1
+                if rng.random() < 0.3 and length > 10:
+                    cut = rng.randint(2, length - 2)
+                    spans = [{"offset": start, "length": cut}, {"offset": start + cut, "length": length - cut}]
+                else:
+                    spans = [{"offset": start, "length": length}]
+                tables.append({"rowCount": row_count, "columnCount": column_count, "cells": cells, "spans": spans,
+                               "boundingRegions": [{"pageNumber": page_number}]})
+            else:
+                add_paragraph(" ".join(sentence(rng, rng.randint(3, 12)) for _ in range(rng.randint(1, 3))), page_number)
+        if rng.random() < 0.5:
+            add_paragraph(str(page_number), page_number, "pageNumber")
+
+    # Paragraphs overlapping others, some of zero length, as Document Intelligence occasionally reports
+    content_length = position
+    for _ in range(rng.randint(0, 4)):
+        offset = rng.randint(0, content_length - 2)
+        paragraph = {"spans": [{"offset": offset, "length": rng.randint(0, min(30, content_length - offset - 1))}],
+                     "boundingRegions": [{"pageNumber": rng.randint(1, page_count)}]}
+        if rng.random() < 0.5:
+            paragraph["role"] = rng.choice(["title", "sectionHeading", "footnote"])
+        paragraphs.insert(rng.randint(0, len(paragraphs)), paragraph)
+
+    return {"content": "".join(content), "paragraphs": paragraphs, "tables": tables,
+            "pages": [{"pageNumber": page_number} for page_number in range(1, page_count + 1)]}
+
+
+def build_structures():
+    utilities = Utilities("devstoreaccount1", "http://127.0.0.1:9/devstoreaccount1/", "upload", "content", base64.b64encode(b"key").decode())
+    structures = {}
+    for seed in SEEDS:
+        result = layout(seed)
+        document_map = utilities.build_document_map_pdf("upload/user/document.pdf", "uri", result, "logs", False)
+        assert document_map["content"] == result["content"]
+        structures[str(seed)] = document_map["structure"]
+    return structures
+
+
+@pytest.fixture(scope="module")
+def baseline():
+    with open(FIXTURE_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_document_map_matches_baseline(baseline):
+    structures = build_structures()
+    mismatched = [seed for seed in structures if structures[seed] != baseline[seed]]
+    assert not mismatched, f"document map differs from the baseline for seeds {mismatched}"
+
@@ -0,0 +1,47 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Round trip of the chunk and output files through a BlobClient in each OutputFormat """
+import base64
+import json
+
+import pytest
+
+from shared_code.utilities import OutputFormat, Utilities
+
+OUTPUT = {"content": "Bonjour, « chunk » 1", "pages": [1, 2], "token_count": 7}
+
+
+def create_utilities(blob_endpoint, output_format):
+    return Utilities("devstoreaccount1", blob_endpoint, "upload", "content",
+                     base64.b64encode(b"key").decode(), output_format=output_format)
+
+
+@pytest.mark.parametrize("output_format", [OutputFormat.PRETTY_JSON, OutputFormat.JSON, OutputFormat.GZIP_JSON])
+def test_read_blob_content_round_trip(blob_endpoint, output_format):
+    utilities = create_utilities(blob_endpoint, output_format)
+    payload, content_settings = utilities.encode_output(OUTPUT)
+    blob_client = utilities.get_blob_service_client().get_blob_client(container="content", blob="chunks/document/chunk.json")
+    blob_client.upload_blob(payload, overwrite=True, content_settings=content_settings)
+
+    blob_content = utilities.read_blob_content("upload/chunks/document/chunk.json", "")
+
+    assert json.loads(blob_content.decode('utf-8')) == OUTPUT
+
+
+def test_gzip_blob_stored_with_content_encoding(blob_endpoint):
+    utilities = create_utilities(blob_endpoint, OutputFormat.GZIP_JSON)
+    payload, content_settings = utilities.encode_output(OUTPUT)
+    blob_client = utilities.get_blob_service_client().get_blob_client(container="content", blob="chunk.json")
+    blob_client.upload_blob(payload, overwrite=True, content_settings=content_settings)
+
+    properties = blob_client.download_blob().properties
+    assert properties.content_settings.content_encoding == "gzip"
+
+
+def test_decode_output_decompresses_undecoded_gzip():
+    utilities = create_utilities("http://127.0.0.1:9/devstoreaccount1/", OutputFormat.GZIP_JSON)
+    payload, _ = utilities.encode_output(OUTPUT)
+
+    assert json.loads(utilities.decode_output(payload)) == OUTPUT
+    assert utilities.decode_output(b'{"a":1}') == b'{"a":1}'
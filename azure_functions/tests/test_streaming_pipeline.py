@@ -0,0 +1,123 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" The streaming chunk pipeline (STREAMING_CHUNK_PIPELINE) writes the same chunk and merged chunk files as the batch one """
+import base64
+import random
+from datetime import datetime
+
+import pytest
+
+import shared_code.utilities
+from shared_code.utilities import Utilities
+
+BLOB_NAME = "upload/user/document.pdf"
+BLOB_URI = "https://devstoreaccount1.blob.core.windows.net/upload/user/document.pdf"
+CHUNK_TARGET_SIZE = 64
+MERGED_CHUNK_TARGET_SIZE = 160
+WORDS = ("the of and to in is that for it as with was on be by this are or from at an which revenue contract "
+         "party agreement section clause shall herein thereof & < > Dr. 12,345.67").split()
+
+
+class FrozenDatetime(datetime):
+    """ Stands in for datetime so processed_datetime is the same in every file written """
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2024, 1, 1, 12, 0, 0)
+
+
+def sentence(rng):
+    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 16)))
+    return text[0].upper() + text[1:] + "."
+
+
+def long_layout(seed, page_count):
+    """ Function to return a prebuilt-layout analyzeResult of page_count pages, with paragraphs and tables longer
+    than a chunk so both are split, and enough pages for the merged chunks to be planned over several windows """
+    rng = random.Random(seed)
+    content = []
+    position = 0
+    paragraphs, tables = [], []
+
+    def add(text):
+        nonlocal position
+        offset = position
+        content.append(text + "\n")
+        position += len(text) + 1
+        return offset
+
+    def add_paragraph(text, page_number, role=None):
+        paragraph = {"content": text, "spans": [{"offset": add(text), "length": len(text)}], "boundingRegions": [{"pageNumber": page_number}]}
+        if role is not None:
+            paragraph["role"] = role
+        paragraphs.append(paragraph)
+
+    add_paragraph("Introduction", 1, "title")
+    for page_number in range(1, page_count + 1):
+        for _ in range(rng.randint(2, 5)):
+            draw = rng.random()
+            if draw < 0.15:
+                add_paragraph(sentence(rng), page_number, "sectionHeading")
+            elif draw < 0.35:
+                row_count, column_count = rng.randint(2, 20), rng.randint(2, 4)
+                start = position
+                cells = []
+                for row_index in range(row_count):
+                    for column_index in range(column_count):
+                        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 5)))
+                        cell = {"rowIndex": row_index, "columnIndex": column_index, "content": text, "spans": [{"offset": add(text), "length": len(text)}]}
+                        if row_index == 0:
+                            cell["kind"] = "columnHeader"
+                        cells.append(cell)
+                        paragraphs.append({"content": text, "spans": cell["spans"], "boundingRegions": [{"pageNumber": page_number}]})
+                tables.append({"rowCount": row_count, "columnCount": column_count, "cells": cells,
+                               "spans": [{"offset": start, "length": position - start - 1}], "boundingRegions": [{"pageNumber": page_number}]})
+            else:
+                sentence_count = rng.randint(10, 30) if rng.random() < 0.3 else rng.randint(1, 4)
+                add_paragraph(" ".join(sentence(rng) for _ in range(sentence_count)), page_number)
+
+    return {"content": "".join(content), "paragraphs": paragraphs, "tables": tables,
+            "pages": [{"pageNumber": page_number} for page_number in range(1, page_count + 1)]}
+
+
+def create_utilities(blob_server):
+    return Utilities("devstoreaccount1", blob_server.endpoint, "upload", "content", base64.b64encode(b"key").decode())
+
+
+def write_batch(blob_server, result):
+    """ Function to chunk and merge a result as PollDocumentIntelChunk does by default, returns the blobs written """
+    utilities = create_utilities(blob_server)
+    document_map = utilities.build_document_map_pdf(BLOB_NAME, BLOB_URI, result, "logs", False)
+    with utilities.create_blob_uploader(4) as uploader:
+        _, chunk_outputs = utilities.build_chunks(document_map, BLOB_NAME, BLOB_URI, CHUNK_TARGET_SIZE, uploader)
+        utilities.build_merged_chunks(chunk_outputs, BLOB_NAME, BLOB_URI, MERGED_CHUNK_TARGET_SIZE, uploader)
+    blobs = dict(blob_server.blobs)
+    blob_server.blobs.clear()
+    return blobs
+
+
+def write_streaming(blob_server, result):
+    """ Function to chunk and merge a result as PollDocumentIntelChunk does with STREAMING_CHUNK_PIPELINE, returns the blobs written """
+    utilities = create_utilities(blob_server)
+    with utilities.create_blob_uploader(4) as uploader:
+        granular_chunks = utilities.iter_chunks(utilities.iter_document_structure(result), BLOB_NAME, BLOB_URI, CHUNK_TARGET_SIZE, uploader)
+        for _ in utilities.iter_merged_chunks(granular_chunks, BLOB_NAME, BLOB_URI, MERGED_CHUNK_TARGET_SIZE):
+            pass
+    blobs = dict(blob_server.blobs)
+    blob_server.blobs.clear()
+    return blobs
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_streaming_writes_the_batch_payloads(blob_server, monkeypatch, seed):
+    monkeypatch.setattr(shared_code.utilities, "datetime", FrozenDatetime)
+    result = long_layout(seed, 15)
+
+    batch_blobs = write_batch(blob_server, result)
+    streaming_blobs = write_streaming(blob_server, result)
+
+    assert any("/merged/" in path for path in batch_blobs)
+    assert sorted(streaming_blobs) == sorted(batch_blobs)
+    for path, (body, _) in batch_blobs.items():
+        assert streaming_blobs[path][0] == body, f"{path} differs"
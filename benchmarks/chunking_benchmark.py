@@ -0,0 +1,241 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Micro-benchmarks of the chunking done in-process by PollDocumentIntelChunk for every document.
+
+Times build_document_map_pdf, table_to_html, chunk_table_with_headers, build_chunks and build_merged_chunks on
+synthetic Document Intelligence results of several sizes, and measures the peak memory of each stage. Blob writes
+go to a stub, nothing is sent to Azure. Run from the repository root, e.g.
+
+    python benchmarks/chunking_benchmark.py --pages 10,100,500
+
+and compare against the baseline in benchmarks/baselines/chunking.json. Save a new baseline with --save-baseline
+in the same change as a deliberate performance change, so the difference shows up in review.
+"""
+import argparse
+import base64
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "azure_functions")
+sys.path.insert(0, FUNCTIONS_DIR)
+
+from synthetic import analyze_result
+from pipeline_harness import load_settings
+
+from shared_code.utilities import Utilities
+
+STAGES = ["table_to_html", "build_document_map_pdf", "chunk_table_with_headers", "build_chunks", "build_merged_chunks"]
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baselines", "chunking.json")
+BLOB_NAME = "upload/benchmark/document.pdf"
+BLOB_URI = f"https://benchmark.blob.core.windows.net/{BLOB_NAME}"
+
+
+class NullUploader:
+    """ Stands in for a BlobUploader, counting the chunks and bytes that would have been written """
+
+    def __init__(self):
+        self.blob_count = 0
+        self.byte_count = 0
+
+    def submit(self, blob_path, payload, **kwargs):
+        self.blob_count += 1
+        self.byte_count += len(payload)
+
+
+def create_utilities(output_format):
+    return Utilities("benchmark", "https://benchmark.blob.core.windows.net/", "upload", "content",
+                     base64.b64encode(b"benchmark").decode(), output_format=output_format)
+
+
+def run_stages(utilities, result, chunk_target_size, merged_chunk_target_size, persist_chunks, measure):
+    """ Function to run each stage once on a result, returns the value measure(fn) returned for each stage
+    and the counts of what the stages produced """
+    measurements = {}
+    outputs = {}
+
+    def stage(name, fn):
+        measurements[name], outputs[name] = measure(fn)
+
+    def tables_to_html():
+        return [utilities.table_to_html(table) for table in result["tables"]]
+
+    def chunk_tables():
+        # Tables longer than a chunk, the ones iter_chunks splits with their header rows repeated
+        utilities.previous_table_header = ""
+        return [utilities.chunk_table_with_headers("", table_html, chunk_target_size, False)
+                for table_html in large_tables]
+
+    uploader = NullUploader()
+    stage("table_to_html", tables_to_html)
+    stage("build_document_map_pdf", lambda: utilities.build_document_map_pdf(BLOB_NAME, BLOB_URI, result, "logs", False))
+    document_map = outputs["build_document_map_pdf"]
+    large_tables = [paragraph["text"] for paragraph in document_map["structure"]
+                    if paragraph["type"] == "table" and utilities.token_count(paragraph["text"]) > chunk_target_size]
+    stage("chunk_table_with_headers", chunk_tables)
+    stage("build_chunks", lambda: utilities.build_chunks(document_map, BLOB_NAME, BLOB_URI, chunk_target_size, uploader, persist_chunks))
+    chunk_count, chunk_outputs = outputs["build_chunks"]
+    stage("build_merged_chunks", lambda: utilities.build_merged_chunks(chunk_outputs, BLOB_NAME, BLOB_URI, merged_chunk_target_size, uploader))
+    merged_chunk_count, _ = outputs["build_merged_chunks"]
+
+    counts = {
+        "tables": len(result["tables"]),
+        "large_tables": len(large_tables),
+        "paragraphs": len(document_map["structure"]),
+        "chunks": chunk_count,
+        "merged_chunks": merged_chunk_count,
+        "blobs_written": uploader.blob_count,
+        "mib_written": uploader.byte_count / 2**20
+    }
+    return measurements, counts
+
+
+def timed(fn):
+    start = time.perf_counter()
+    value = fn()
+    return time.perf_counter() - start, value
+
+
+def traced(fn):
+    """ Returns the peak memory allocated while fn runs, above what was allocated before it, in MiB """
+    gc.collect()
+    tracemalloc.reset_peak()
+    current, _ = tracemalloc.get_traced_memory()
+    value = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    return (peak - current) / 2**20, value
+
+
+def benchmark(utilities, page_count, args):
+    """ Function to return the median and minimum time and the peak memory of each stage for a document of page_count pages """
+    result = analyze_result(page_count, page_count, table_probability=args.table_probability,
+                            long_paragraph_probability=args.long_paragraph_probability,
+                            long_paragraph_sentences=args.long_paragraph_sentences,
+                            multi_page_table_probability=args.multi_page_table_probability)
+    run = lambda measure: run_stages(utilities, result, args.chunk_target_size, args.merged_chunk_target_size,
+                                     args.persist_chunks, measure)
+    # Warm up, the first run loads the tokenizer and fills its caches
+    _, counts = run(timed)
+    durations = {stage: [] for stage in STAGES}
+    for _ in range(args.repeat):
+        measurements, _ = run(timed)
+        for stage in STAGES:
+            durations[stage].append(measurements[stage])
+    # Memory is measured in a separate run, as tracing slows every allocation down
+    tracemalloc.start()
+    try:
+        peaks, _ = run(traced)
+    finally:
+        tracemalloc.stop()
+
+    stages = {stage: {"median_seconds": statistics.median(durations[stage]), "min_seconds": min(durations[stage]),
+                      "peak_mib": peaks[stage]} for stage in STAGES}
+    return {"counts": counts, "stages": stages}
+
+
+def compare(results, baseline, tolerance):
+    """ Function to return the stages slower or using more memory than the baseline by more than tolerance """
+    regressions = []
+    for page_count, result in results.items():
+        baseline_stages = baseline["results"].get(page_count, {}).get("stages", {})
+        for stage, measured in result["stages"].items():
+            if stage not in baseline_stages:
+                continue
+            for metric in ["median_seconds", "peak_mib"]:
+                before, after = baseline_stages[stage][metric], measured[metric]
+                if before > 0 and after > before * (1 + tolerance):
+                    regressions.append(f"{page_count} pages {stage} {metric} {before:.4g} -> {after:.4g} (+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+def print_report(results, baseline):
+    def change(page_count, stage, metric, value):
+        if baseline is None:
+            return ""
+        before = baseline["results"].get(page_count, {}).get("stages", {}).get(stage, {}).get(metric)
+        return f"{(value / before - 1) * 100:+.0f}%" if before else "n/a"
+
+    print(f"{'pages':>6} {'stage':<26} {'median ms':>10} {'min ms':>10} {'vs base':>8} {'peak MiB':>9} {'vs base':>8}")
+    for page_count, result in results.items():
+        for stage, measured in result["stages"].items():
+            print(f"{page_count:>6} {stage:<26} {measured['median_seconds'] * 1000:>10.1f} {measured['min_seconds'] * 1000:>10.1f} "
+                  f"{change(page_count, stage, 'median_seconds', measured['median_seconds']):>8} {measured['peak_mib']:>9.2f} "
+                  f"{change(page_count, stage, 'peak_mib', measured['peak_mib']):>8}")
+        counts = result["counts"]
+        print(f"{'':>6} {counts['paragraphs']} paragraphs, {counts['tables']} tables ({counts['large_tables']} longer than a chunk), "
+              f"{counts['chunks']} chunks, {counts['merged_chunks']} merged chunks, {counts['blobs_written']} blobs / {counts['mib_written']:.1f} MiB written")
+
+
+def parse_args(argv=None):
+    settings = load_settings(os.path.join(FUNCTIONS_DIR, "template_local.settings.json"))
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the chunking done by PollDocumentIntelChunk")
+    parser.add_argument("--pages", default="10,100,500", help="Comma separated page counts of the documents to benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs of each stage, the median and minimum are reported")
+    parser.add_argument("--chunk-target-size", type=int, default=int(settings["CHUNK_TARGET_SIZE"]))
+    parser.add_argument("--merged-chunk-target-size", type=int, default=int(settings["MERGED_CHUNK_TARGET_SIZE"]))
+    parser.add_argument("--output-format", default=settings["OUTPUT_FORMAT"], help="OUTPUT_FORMAT of the chunks written")
+    parser.add_argument("--no-persist-chunks", dest="persist_chunks", action="store_false",
+                        help="Build the granular chunks in memory only, as with PERSIST_GRANULAR_CHUNKS false")
+    parser.add_argument("--table-probability", type=float, default=0.15, help="Probability of each paragraph being a table")
+    parser.add_argument("--multi-page-table-probability", type=float, default=0.05,
+                        help="Probability of a page starting a table that continues over the following pages")
+    parser.add_argument("--long-paragraph-probability", type=float, default=0.05)
+    parser.add_argument("--long-paragraph-sentences", type=int, default=400, help="Most sentences in a long paragraph")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Fraction slower or larger than the baseline reported as a regression")
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 when a stage regressed")
+    parser.add_argument("--json", help="Also write the results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {name: getattr(args, name) for name in ["chunk_target_size", "merged_chunk_target_size", "output_format", "persist_chunks",
+                                                      "table_probability", "multi_page_table_probability",
+                                                      "long_paragraph_probability", "long_paragraph_sentences"]}
+    utilities = create_utilities(args.output_format)
+    results = {}
+    for page_count in [int(pages) for pages in args.pages.split(",")]:
+        results[str(page_count)] = benchmark(utilities, page_count, args)
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["options"] != options:
+            print(f"Not comparing with {args.baseline}, it was measured with other options: {baseline['options']}")
+            baseline = None
+    print_report(results, baseline)
+
+    output = {"python": platform.python_version(), "machine": platform.machine(), "options": options, "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(output, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+    elif baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions against {args.baseline}, tolerance {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            if args.check:
+                sys.exit(1)
+        else:
+            print(f"No regressions against {args.baseline}, tolerance {args.tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
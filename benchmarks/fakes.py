@@ -0,0 +1,555 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" In-memory stand-ins for Blob Storage, Queue Storage and Cosmos DB, and local HTTP servers mocking Document Intelligence and Azure OpenAI.
+
+Time in the stand-ins is simulated: a SimClock running time_scale times faster than real time stretches queue visibility
+timeouts and service latencies, so a pipeline run that takes an hour of simulated time finishes in minutes.
+"""
+import copy
+import gzip
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.cosmos import exceptions
+from azure.storage.blob import ContentSettings
+
+
+class SimClock:
+    """ Simulated seconds since the clock was created, running time_scale times faster than real time """
+
+    def __init__(self, time_scale=1.0):
+        self.time_scale = time_scale
+        self._start = time.monotonic()
+
+    def now(self):
+        return (time.monotonic() - self._start) * self.time_scale
+
+    def real_seconds(self, seconds):
+        return max(0.0, seconds) / self.time_scale
+
+    def sleep(self, seconds):
+        time.sleep(self.real_seconds(seconds))
+
+
+class ScaledTime:
+    """ Stands in for the time module of a function, so the delays it sleeps for pass in simulated time """
+
+    def __init__(self, clock):
+        self._clock = clock
+
+    def sleep(self, seconds):
+        self._clock.sleep(seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+# Blob Storage
+
+class FakeBlobServiceClient:
+    """ Blob service keeping every container in memory """
+
+    def __init__(self):
+        self.blobs = {}
+        self._lock = threading.Lock()
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self, container, blob)
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self, container)
+
+
+class FakeContainerClient:
+
+    def __init__(self, service, container):
+        self.service = service
+        self.container = container
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self.service, self.container, blob)
+
+    def list_blobs(self, name_starts_with=None):
+        with self.service._lock:
+            names = sorted(name for container, name in self.service.blobs if container == self.container and name.startswith(name_starts_with or ""))
+        return [SimpleNamespace(name=name) for name in names]
+
+    def delete_blob(self, blob):
+        self.get_blob_client(blob).delete_blob()
+
+
+class FakeBlobClient:
+
+    def __init__(self, service, container, blob):
+        self.service = service
+        self.key = (container, blob)
+
+    def upload_blob(self, data, overwrite=False, content_settings=None, metadata=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif not isinstance(data, bytes):
+            data = data.read() if hasattr(data, "read") else b"".join(data)
+        content_settings = copy.copy(content_settings) or ContentSettings()
+        # The service records the MD5 of blobs uploaded in a single request
+        content_settings.content_md5 = bytearray(hashlib.md5(data).digest())
+        with self.service._lock:
+            if not overwrite and self.key in self.service.blobs:
+                raise ResourceExistsError(f"Blob {self.key} already exists")
+            self.service.blobs[self.key] = SimpleNamespace(data=data, properties=SimpleNamespace(
+                name=self.key[1], size=len(data), content_settings=content_settings, metadata=dict(metadata or {}),
+                last_modified=datetime.now(timezone.utc)))
+
+    def _get(self):
+        with self.service._lock:
+            blob = self.service.blobs.get(self.key)
+        if blob is None:
+            raise ResourceNotFoundError(f"Blob {self.key} not found")
+        return blob
+
+    def download_blob(self, decompress=True, **kwargs):
+        blob = self._get()
+        data = blob.data
+        # As the SDK does, the transport decodes the Content-Encoding the blob is served with
+        if decompress and blob.properties.content_settings.content_encoding == "gzip":
+            data = gzip.decompress(data)
+        return SimpleNamespace(readall=lambda: data, properties=blob.properties)
+
+    def get_blob_properties(self, **kwargs):
+        return self._get().properties
+
+    def exists(self, **kwargs):
+        with self.service._lock:
+            return self.key in self.service.blobs
+
+    def delete_blob(self, **kwargs):
+        with self.service._lock:
+            if self.service.blobs.pop(self.key, None) is None:
+                raise ResourceNotFoundError(f"Blob {self.key} not found")
+
+
+# Queue Storage
+
+class FakeQueueMessage:
+
+    def __init__(self, content):
+        self.id = str(uuid.uuid4())
+        self.content = content
+        self.dequeue_count = 0
+        self.pop_receipt = None
+        self.visible_at = 0.0
+
+
+class FakeQueueService:
+    """ Queue service keeping every queue in memory, with visibility timeouts in simulated time.
+    send_listener, when set, is called with the queue name of every message sent. """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.queues = {}
+        self.send_listener = None
+        self._lock = threading.Lock()
+
+    def get_queue_client(self, queue_name):
+        return FakeQueueClient(self, queue_name)
+
+    def queue_client_class(self):
+        """ Returns a class standing in for azure.storage.queue.QueueClient, whose clients use this service """
+        service = self
+
+        class QueueClient:
+            @staticmethod
+            def from_connection_string(conn_str, queue_name, **kwargs):
+                return service.get_queue_client(queue_name)
+        return QueueClient
+
+    def _queue(self, queue_name):
+        return self.queues.setdefault(queue_name, [])
+
+    def send(self, queue_name, content, visibility_timeout=None):
+        message = FakeQueueMessage(content)
+        message.visible_at = self.clock.now() + (visibility_timeout or 0)
+        with self._lock:
+            self._queue(queue_name).append(message)
+        if self.send_listener is not None:
+            self.send_listener(queue_name)
+        return message
+
+    def receive(self, queue_name, max_messages, visibility_timeout):
+        """ Hides up to max_messages visible messages for visibility_timeout seconds and returns them """
+        now = self.clock.now()
+        received = []
+        with self._lock:
+            for message in self._queue(queue_name):
+                if len(received) >= max_messages:
+                    break
+                if message.visible_at <= now:
+                    message.visible_at = now + visibility_timeout
+                    message.dequeue_count += 1
+                    message.pop_receipt = str(uuid.uuid4())
+                    received.append(message)
+        return received
+
+    def delete(self, queue_name, message):
+        with self._lock:
+            queue = self._queue(queue_name)
+            if message in queue:
+                queue.remove(message)
+
+    def release(self, queue_name, message):
+        """ Makes a received message visible again straight away, as the Functions host does when an invocation fails """
+        with self._lock:
+            message.visible_at = self.clock.now()
+
+    def length(self, queue_name=None):
+        with self._lock:
+            if queue_name is not None:
+                return len(self._queue(queue_name))
+            return sum(len(queue) for queue in self.queues.values())
+
+
+class FakeQueueClient:
+
+    def __init__(self, service, queue_name):
+        self.service = service
+        self.queue_name = queue_name
+
+    def send_message(self, content, visibility_timeout=None, **kwargs):
+        message = self.service.send(self.queue_name, content, visibility_timeout)
+        return {"id": message.id}
+
+    def receive_messages(self, messages_per_page=None, visibility_timeout=30, max_messages=None, **kwargs):
+        return self.service.receive(self.queue_name, max_messages or messages_per_page or 1, visibility_timeout)
+
+    def delete_message(self, message, pop_receipt=None, **kwargs):
+        self.service.delete(self.queue_name, message)
+
+    def create_queue(self, **kwargs):
+        with self.service._lock:
+            self.service._queue(self.queue_name)
+
+
+# Cosmos DB
+
+class FakeCosmosClient:
+    """ Cosmos DB account keeping every container in memory. Containers do not exist until they are created. """
+
+    def __init__(self):
+        self.containers = {}
+        self.created = set()
+        self._lock = threading.Lock()
+
+    def get_database_client(self, database_name):
+        return FakeDatabase(self, database_name)
+
+    def create_database_if_not_exists(self, database_name, **kwargs):
+        return FakeDatabase(self, database_name)
+
+    def container(self, database_name, container_name):
+        with self._lock:
+            return self.containers.setdefault((database_name, container_name), FakeCosmosContainer(self, database_name, container_name))
+
+
+class FakeDatabase:
+
+    def __init__(self, client, database_name):
+        self.client = client
+        self.database_name = database_name
+
+    def get_container_client(self, container_name):
+        return self.client.container(self.database_name, container_name)
+
+    def create_container(self, id, partition_key=None, **kwargs):
+        with self.client._lock:
+            if (self.database_name, id) in self.client.created:
+                raise exceptions.CosmosResourceExistsError(status_code=409, message="Container already exists")
+            self.client.created.add((self.database_name, id))
+        return self.client.container(self.database_name, id)
+
+
+class FakeCosmosContainer:
+    """ Container supporting the point operations, patches and queries the pipeline uses """
+
+    def __init__(self, client, database_name, container_name):
+        self.client = client
+        self.key = (database_name, container_name)
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def read(self, **kwargs):
+        if self.key not in self.client.created:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Container not found")
+        return {"id": self.key[1]}
+
+    def _not_found(self, item):
+        return exceptions.CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+
+    def _store(self, body):
+        body = copy.deepcopy(body)
+        body["_etag"] = f'"{uuid.uuid4()}"'
+        body["_ts"] = int(time.time())
+        self.items[body["id"]] = body
+        return copy.deepcopy(body)
+
+    def read_item(self, item, partition_key, etag=None, match_condition=None, **kwargs):
+        with self._lock:
+            if item not in self.items:
+                raise self._not_found(item)
+            json_document = self.items[item]
+            if etag is not None and json_document["_etag"] == etag:
+                # Not modified, the service sends no body
+                return {}
+            return copy.deepcopy(json_document)
+
+    def create_item(self, body, **kwargs):
+        with self._lock:
+            if body["id"] in self.items:
+                raise exceptions.CosmosResourceExistsError(status_code=409, message=f"Item {body['id']} already exists")
+            return self._store(body)
+
+    def upsert_item(self, body, **kwargs):
+        with self._lock:
+            return self._store(body)
+
+    def replace_item(self, item, body, etag=None, match_condition=None, **kwargs):
+        with self._lock:
+            if item not in self.items:
+                raise self._not_found(item)
+            if etag is not None and self.items[item]["_etag"] != etag:
+                raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+            return self._store(body)
+
+    def delete_item(self, item, partition_key, **kwargs):
+        with self._lock:
+            if self.items.pop(item, None) is None:
+                raise self._not_found(item)
+
+    def patch_item(self, item, partition_key, patch_operations, filter_predicate=None, **kwargs):
+        with self._lock:
+            if item not in self.items:
+                raise self._not_found(item)
+            json_document = copy.deepcopy(self.items[item])
+            if filter_predicate is not None and not self._matches(json_document, filter_predicate):
+                raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+            for operation in patch_operations:
+                field = operation["path"].strip("/").split("/")[0]
+                if operation["op"] == "set":
+                    json_document[field] = operation["value"]
+                elif operation["op"] == "add" and operation["path"].endswith("/-"):
+                    json_document.setdefault(field, []).append(operation["value"])
+                elif operation["op"] == "incr":
+                    json_document[field] = json_document.get(field, 0) + operation["value"]
+                else:
+                    raise ValueError(f"Unsupported patch operation {operation}")
+            return self._store(json_document)
+
+    def _matches(self, json_document, filter_predicate):
+        for field, operator, value in re.findall(r"c\.(\w+)\s*(!=|=)\s*'([^']*)'", filter_predicate):
+            if (json_document.get(field) == value) != (operator == "="):
+                return False
+        return True
+
+    def query_items(self, query, parameters=None, **kwargs):
+        parameters = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+        with self._lock:
+            items = [copy.deepcopy(json_document) for json_document in self.items.values()]
+        if "VALUE c.doc_intel" in query:
+            history = [json_document["doc_intel"] for json_document in items if json_document.get("doc_type") == "file_log" and "doc_intel" in json_document]
+            history.sort(key=lambda doc_intel: doc_intel["completed_timestamp"], reverse=True)
+            return history[:parameters.get("@limit", len(history))]
+        if "ARRAY_CONTAINS(c.prompts" in query:
+            return [json_document for json_document in items
+                    if any(prompt["prompt_id"] == parameters["@prompt_id"] for prompt in json_document.get("prompts", []))]
+        match = re.search(r"c\.id = '([^']*)'", query)
+        if match:
+            return [json_document for json_document in items if json_document["id"] == match.group(1)]
+        raise NotImplementedError(f"Query not supported by the fake container: {query}")
+
+
+# Document Intelligence and Azure OpenAI
+
+class MockService(ThreadingHTTPServer):
+    """ Local HTTP server answering on 127.0.0.1, throttling a share of its requests with a Retry-After """
+    daemon_threads = True
+
+    def __init__(self, clock, throttle_rate=0.0, retry_after=None, seed=0):
+        super().__init__(("127.0.0.1", 0), MockRequestHandler)
+        self.clock = clock
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.counts = {}
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def throttled(self):
+        with self.lock:
+            return self.random.random() < self.throttle_rate
+
+    def throttle_headers(self, retry_after=None):
+        retry_after = self.retry_after if retry_after is None else retry_after
+        return {} if retry_after is None else {"Retry-After": str(int(retry_after))}
+
+    def respond(self, method, path, query, body):
+        """ Returns the status code, headers and json body answering a request """
+        raise NotImplementedError
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _dispatch(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        status, headers, payload = self.server.respond(method, url.path, urllib.parse.parse_qs(url.query), body)
+        data = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockDocumentIntelligence(MockService):
+    """ Document Intelligence endpoint analyzing documents with prebuilt-layout.
+
+    Analysis takes base_seconds plus page_seconds for each page of simulated time. documents is called with the
+    blob path (container/name) of a submitted document and returns its analyzeResult. """
+
+    def __init__(self, clock, documents, base_seconds=5.0, page_seconds=0.5, throttle_rate=0.0, retry_after=None, seed=0):
+        super().__init__(clock, throttle_rate, retry_after, seed)
+        self.documents = documents
+        self.base_seconds = base_seconds
+        self.page_seconds = page_seconds
+        self.operations = {}
+
+    def respond(self, method, path, query, body):
+        if method == "POST" and path.endswith(":analyze"):
+            self.count("submit")
+            if self.throttled():
+                self.count("submit_throttled")
+                return 429, self.throttle_headers(), {"error": {"code": "429", "message": "Too many requests"}}
+            blob_path = urllib.parse.unquote(urllib.parse.urlsplit(body["urlSource"]).path).lstrip("/")
+            result = self.documents(blob_path)
+            result_id = str(uuid.uuid4())
+            turnaround = self.base_seconds + self.page_seconds * len(result["pages"])
+            with self.lock:
+                self.operations[result_id] = (self.clock.now(), turnaround * self.random.uniform(0.8, 1.2), result)
+            return 202, {"apim-request-id": result_id, "Operation-Location": f"{self.endpoint}{path.lstrip('/')}".replace(":analyze", f"/analyzeResults/{result_id}")}, None
+
+        if method == "GET" and "/analyzeResults/" in path:
+            self.count("poll")
+            if self.throttled():
+                self.count("poll_throttled")
+                return 429, self.throttle_headers(), {"error": {"code": "429", "message": "Too many requests"}}
+            with self.lock:
+                operation = self.operations.get(path.rsplit("/", 1)[1])
+            if operation is None:
+                return 404, {}, {"error": {"code": "NotFound", "message": "Analyze result not found"}}
+            submitted, turnaround, result = operation
+            elapsed = self.clock.now() - submitted
+            # Timestamps are shifted so the elapsed real time seen by the caller is the elapsed simulated time
+            created = datetime.now(timezone.utc) - timedelta(seconds=elapsed)
+            created_text = created.isoformat().replace("+00:00", "Z")
+            if elapsed < turnaround:
+                self.count("poll_running")
+                return 200, {"Retry-After": "2"}, {"status": "running", "createdDateTime": created_text, "lastUpdatedDateTime": created_text}
+            return 200, {}, {"status": "succeeded", "createdDateTime": created_text,
+                             "lastUpdatedDateTime": (created + timedelta(seconds=turnaround)).isoformat().replace("+00:00", "Z"),
+                             "analyzeResult": result}
+
+        return 404, {}, {"error": {"code": "NotFound", "message": path}}
+
+
+class MockAzureOpenAI(MockService):
+    """ Azure OpenAI chat completions endpoint.
+
+    Completions take base_seconds plus token_seconds for each completion token of simulated time. When tpm_limit
+    is set, requests beyond that many tokens in the last simulated minute are throttled until enough have aged out. """
+
+    def __init__(self, clock, base_seconds=1.0, token_seconds=0.02, tpm_limit=None, completion_tokens=100,
+                 throttle_rate=0.0, retry_after=None, seed=0):
+        super().__init__(clock, throttle_rate, retry_after, seed)
+        self.base_seconds = base_seconds
+        self.token_seconds = token_seconds
+        self.tpm_limit = tpm_limit
+        self.completion_tokens = completion_tokens
+        self._window = deque()
+        self._request_ids = itertools.count(1)
+
+    def _admit(self, tokens):
+        """ Returns None when the request fits in the tokens per minute limit, otherwise the seconds until it would """
+        if not self.tpm_limit:
+            return None
+        now = self.clock.now()
+        with self.lock:
+            while self._window and self._window[0][0] <= now - 60:
+                self._window.popleft()
+            used = sum(window_tokens for _, window_tokens in self._window)
+            if used + tokens <= self.tpm_limit or not self._window:
+                self._window.append((now, tokens))
+                return None
+            return max(1, int(self._window[0][0] + 60 - now) + 1)
+
+    def respond(self, method, path, query, body):
+        if method != "POST" or not path.endswith("/chat/completions"):
+            return 404, {}, {"error": {"code": "NotFound", "message": path}}
+        self.count("completion")
+        prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+        completion_tokens = min(self.completion_tokens, int(body.get("max_tokens", self.completion_tokens)))
+        if self.throttled():
+            self.count("completion_throttled")
+            return 429, self.throttle_headers(), {"error": {"code": "429", "message": "Rate limit is exceeded"}}
+        wait = self._admit(prompt_tokens + completion_tokens)
+        if wait is not None:
+            self.count("completion_throttled")
+            return 429, self.throttle_headers(wait), {"error": {"code": "429", "message": "Rate limit is exceeded"}}
+        self.clock.sleep(self.base_seconds + self.token_seconds * completion_tokens)
+        return 200, {}, {
+            "id": f"chatcmpl-{next(self._request_ids)}",
+            "object": "chat.completion",
+            "model": path.split("/")[-3],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": " ".join(["summary"] * completion_tokens)}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }
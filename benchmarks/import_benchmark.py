@@ -0,0 +1,119 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Measures the cold start of the functions: the time to import each function module in a new interpreter, the time
+the first chunk takes to load the tokenizers, and the network connections attempted on the way. Run from the repository
+root, e.g.
+
+    python benchmarks/import_benchmark.py --repeat 10
+
+Run azure_functions/scripts/download_models.py first to measure the start with the models deployed with the app.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "azure_functions")
+
+from pipeline_harness import load_settings, local_settings
+
+HEAVY_MODULES = ["tiktoken", "nltk", "bs4"]
+
+# Runs in the new interpreter, records the host lookups and connections made and the modules imported
+PROBE = """
+import json, sys, time
+connections = []
+def audit(event, args):
+    if event == "socket.getaddrinfo":
+        connections.append(f"{{args[0]}}:{{args[1]}}")
+    elif event == "socket.connect":
+        connections.append(str(args[1]))
+sys.addaudithook(audit)
+start = time.perf_counter()
+{import_code}
+import_seconds = time.perf_counter() - start
+start = time.perf_counter()
+error = None
+try:
+{first_use_code}
+except Exception as err:
+    error = repr(err)
+first_use_seconds = time.perf_counter() - start
+print(json.dumps({{"import_seconds": import_seconds, "first_use_seconds": first_use_seconds, "error": error, "connections": connections,
+                  "heavy_modules": sorted(name for name in {heavy_modules!r} if name in sys.modules)}}))
+"""
+
+FIRST_CHUNK = """
+    from shared_code.utilities import TokenCounter, sent_tokenize
+    TokenCounter("First chunk of the process.")
+    sent_tokenize("First sentence. Second sentence.")
+"""
+
+NO_USE = "    pass"
+
+CASES = [
+    ("shared_code.utilities", "import shared_code.utilities", NO_USE),
+    ("AddToQueue", "import AddToQueue", NO_USE),
+    ("SubmitToDocumentIntel", "import SubmitToDocumentIntel", NO_USE),
+    ("PollDocumentIntelChunk", "import PollDocumentIntelChunk", FIRST_CHUNK),
+    ("RunLLMPrompt", "import RunLLMPrompt", FIRST_CHUNK),
+]
+
+
+def run_case(import_code, first_use_code, env):
+    probe = PROBE.format(import_code=import_code, first_use_code=first_use_code, heavy_modules=HEAVY_MODULES)
+    completed = subprocess.run([sys.executable, "-c", probe], cwd=FUNCTIONS_DIR, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise Exception(f"{import_code} failed: {completed.stderr.strip()}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time of the function modules")
+    parser.add_argument("--repeat", type=int, default=5, help="New interpreters started for each function, the median is reported")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update(load_settings(os.path.join(FUNCTIONS_DIR, "template_local.settings.json")))
+    # Endpoints that refuse connections, nothing is called while importing
+    env.update(local_settings(["http://127.0.0.1:9/"], ["http://127.0.0.1:9/"], "benchmark"))
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+
+    models_dir = os.path.join(FUNCTIONS_DIR, "models")
+    print(f"models folder {models_dir} {'present' if os.path.isdir(models_dir) else 'missing, models are downloaded on first use'}")
+    # Compile once, so the first case does not pay for it
+    run_case("import AddToQueue, SubmitToDocumentIntel, PollDocumentIntelChunk, RunLLMPrompt", NO_USE, env)
+
+    results = {}
+    print(f"{'module':<24} {'import ms':>10} {'first chunk ms':>15} {'connections':>12}  heavy modules imported")
+    for name, import_code, first_use_code in CASES:
+        runs = [run_case(import_code, first_use_code, env) for _ in range(args.repeat)]
+        results[name] = {
+            "import_seconds": statistics.median(run["import_seconds"] for run in runs),
+            "first_use_seconds": statistics.median(run["first_use_seconds"] for run in runs),
+            "errors": sorted(set(run["error"] for run in runs if run["error"])),
+            "connections": sorted(set(connection for run in runs for connection in run["connections"])),
+            "heavy_modules": runs[-1]["heavy_modules"]
+        }
+        result = results[name]
+        first_use = f"{result['first_use_seconds'] * 1000:.1f}" if first_use_code != NO_USE else ""
+        first_use = "failed" if result["errors"] else first_use
+        print(f"{name:<24} {result['import_seconds'] * 1000:>10.1f} {first_use:>15} {len(result['connections']):>12}  "
+              f"{', '.join(result['heavy_modules']) or '-'}")
+        for connection in result["connections"]:
+            print(f"{'':<24} connects to {connection}")
+        for error in result["errors"]:
+            print(f"{'':<24} first chunk failed: {error}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
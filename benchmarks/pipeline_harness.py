@@ -0,0 +1,418 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Offline end-to-end harness measuring the throughput of the pipeline.
+
+Runs AddToQueue, SubmitToDocumentIntel, PollDocumentIntelChunk and RunLLMPrompt in-process, the way the Functions host
+triggers them, against in-memory Blob Storage, Queue Storage and Cosmos DB and local mock Document Intelligence and
+Azure OpenAI servers. Nothing is sent to Azure. Run from the repository root, e.g.
+
+    python benchmarks/pipeline_harness.py --documents 50 --aoai-tpm 60000
+
+Time is simulated, see --time-scale. Clocks kept inside shared_code (endpoint circuit cooldowns, quota refill, prompt
+cache expiry) run in real time, so use --time-scale 1 when measuring changes to those.
+"""
+import argparse
+import base64
+import importlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "azure_functions")
+sys.path.insert(0, FUNCTIONS_DIR)
+
+from fakes import (SimClock, ScaledTime, FakeBlobServiceClient, FakeQueueService, FakeCosmosClient,
+                   MockDocumentIntelligence, MockAzureOpenAI)
+from synthetic import pdf_document, analyze_result
+
+FUNCTION_NAMES = ["AddToQueue", "SubmitToDocumentIntel", "PollDocumentIntelChunk", "RunLLMPrompt"]
+TERMINAL_STATES = ("Complete", "Error", "Skipped")
+
+_invocation = threading.local()
+
+
+def load_settings(settings_path):
+    """ Function to return the string settings of a local.settings.json file, read leniently as the template is not strict json """
+    with open(settings_path) as f:
+        text = f.read()
+    return {name: value for name, value in re.findall(r'"([\w.]+)"\s*:\s*"([^"]*)"', text)}
+
+
+def local_settings(doc_intel_endpoints, aoai_endpoints, aoai_deployment_id):
+    """ Function to return the settings pointing the functions at the stand-ins """
+    key = base64.b64encode(b"benchmark").decode()
+    return {
+        "BLOB_STORAGE_ACCOUNT": "benchmark",
+        "BLOB_STORAGE_ACCOUNT_ENDPOINT": "https://benchmark.blob.core.windows.net/",
+        "AZURE_BLOB_STORAGE_KEY": key,
+        "BLOB_CONNECTION_STRING": f"DefaultEndpointsProtocol=https;AccountName=benchmark;AccountKey={key};EndpointSuffix=core.windows.net",
+        "COSMOSDB_URL": "https://benchmark.documents.azure.com:443/",
+        "COSMOSDB_KEY": key,
+        "COSMOSDB_PROVISIONED": "false",
+        "AZURE_FORM_RECOGNIZER_ENDPOINT": "|".join(doc_intel_endpoints),
+        "AZURE_FORM_RECOGNIZER_KEY": "|".join("benchmark" for _ in doc_intel_endpoints),
+        "AZURE_OPENAI_ENDPOINT": "|".join(endpoint.rstrip("/") for endpoint in aoai_endpoints),
+        "AZURE_OPENAI_KEY": "|".join("benchmark" for _ in aoai_endpoints),
+        "AZURE_OPENAI_DEPLOYMENT_ID": "|".join(aoai_deployment_id for _ in aoai_endpoints),
+        "ENABLE_DEV_CODE": "false",
+        "NO_PROXY": "127.0.0.1,localhost",
+        "no_proxy": "127.0.0.1,localhost",
+    }
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+class InvocationStats:
+    """ Invocation count, duration and outcomes of one function """
+
+    def __init__(self):
+        self.durations = []
+        self.failed = 0
+        self.requeued = 0
+        self.poisoned = 0
+        self._lock = threading.Lock()
+
+    def record(self, duration, failed):
+        with self._lock:
+            self.durations.append(duration)
+            self.failed += failed
+
+    def wasted(self):
+        """ Invocations (or chunk messages of a RunLLMPrompt batch) that ended by requeuing their work or failing """
+        return self.requeued + self.failed
+
+
+class AttributedThreadPoolExecutor(ThreadPoolExecutor):
+    """ Thread pool whose tasks are attributed to the invocation that submitted them """
+
+    def submit(self, fn, *args, **kwargs):
+        invocation = getattr(_invocation, "current", None)
+
+        def attributed():
+            _invocation.current = invocation
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _invocation.current = None
+        return super().submit(attributed)
+
+
+class PipelineHost:
+    """ Triggers the functions the way the Functions host does: a queue message is hidden while its function runs,
+    deleted once it returns, made visible again when it raises, and moved to the poison queue once it has been
+    delivered more than max_dequeue_count times. At most concurrency functions run at once. """
+
+    def __init__(self, clock, queue_service, triggers, requeue_queues, concurrency=16, max_dequeue_count=3, visibility_timeout=600):
+        self.clock = clock
+        self.queue_service = queue_service
+        self.triggers = triggers
+        self.requeue_queues = requeue_queues
+        self.concurrency = concurrency
+        self.max_dequeue_count = max_dequeue_count
+        self.visibility_timeout = visibility_timeout
+        self.stats = {function_name: InvocationStats() for function_name in FUNCTION_NAMES}
+        self._running = 0
+        self._lock = threading.Lock()
+        queue_service.send_listener = self._on_send
+
+    def _on_send(self, queue_name):
+        function_name = getattr(_invocation, "current", None)
+        if function_name is not None and queue_name in self.requeue_queues.get(function_name, ()):
+            with self._lock:
+                self.stats[function_name].requeued += 1
+
+    def _invoke(self, function_name, call, queue_name=None, message=None):
+        _invocation.current = function_name
+        start = time.perf_counter()
+        failed = False
+        try:
+            call()
+        except Exception as error:
+            failed = True
+            logging.warning(f"{function_name} raised {error!r}")
+        finally:
+            _invocation.current = None
+        self.stats[function_name].record(time.perf_counter() - start, failed)
+        if message is not None:
+            if failed:
+                self.queue_service.release(queue_name, message)
+            else:
+                self.queue_service.delete(queue_name, message)
+        with self._lock:
+            self._running -= 1
+
+    def _start(self, executor, function_name, call, queue_name=None, message=None):
+        with self._lock:
+            self._running += 1
+        executor.submit(self._invoke, function_name, call, queue_name, message)
+
+    def free_slots(self):
+        with self._lock:
+            return self.concurrency - self._running
+
+    def idle(self):
+        with self._lock:
+            return self._running == 0
+
+    def run(self, uploads, is_finished, max_seconds, poll_interval=0.002, check_interval=0.02):
+        """ Triggers AddToQueue for each (simulated time, blob) upload once its time comes, then the queue
+        triggered functions for their messages, until is_finished() or max_seconds of simulated time """
+        import azure.functions as func
+        uploads = sorted(uploads, key=lambda upload: upload[0])
+        next_check = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="function") as executor:
+            while self.clock.now() < max_seconds:
+                while uploads and uploads[0][0] <= self.clock.now() and self.free_slots() > 0:
+                    _, blob = uploads.pop(0)
+                    self._start(executor, "AddToQueue", lambda blob=blob: self.triggers["AddToQueue"](blob))
+
+                for queue_name, (function_name, main) in self.triggers["queues"].items():
+                    free_slots = self.free_slots()
+                    if free_slots <= 0:
+                        break
+                    for message in self.queue_service.receive(queue_name, free_slots, self.visibility_timeout):
+                        if message.dequeue_count > self.max_dequeue_count:
+                            self.queue_service.delete(queue_name, message)
+                            self.queue_service.send(f"{queue_name}-poison", message.content)
+                            self.stats[function_name].poisoned += 1
+                            continue
+                        queue_message = func.QueueMessage(id=message.id, body=message.content.encode("utf-8"))
+                        self._start(executor, function_name, lambda main=main, queue_message=queue_message: main(queue_message),
+                                    queue_name, message)
+
+                # is_finished also records when documents finish, so it is checked throughout the run
+                if time.perf_counter() >= next_check:
+                    next_check = time.perf_counter() + check_interval
+                    if is_finished() and not uploads and self.idle():
+                        break
+                time.sleep(poll_interval)
+
+
+def install_stand_ins(settings, clock, blob_service, queue_service, cosmos_client):
+    """ Registers the stand-ins in the process wide client registries of shared_code and loads the functions using them """
+    from shared_code import utilities, cosmos_registry, queue_fanout
+
+    utilities._blob_service_clients[(settings["BLOB_STORAGE_ACCOUNT_ENDPOINT"], settings["AZURE_BLOB_STORAGE_KEY"])] = blob_service
+    cosmos_registry._cosmos_clients[(settings["COSMOSDB_URL"], settings["COSMOSDB_KEY"])] = cosmos_client
+    for queue_name in (settings["CHUNKS_QUEUE"], f'{settings["CHUNKS_QUEUE"]}-poison'):
+        queue_fanout._queue_clients[(settings["BLOB_CONNECTION_STRING"], queue_name)] = queue_service.get_queue_client(queue_name)
+
+    modules = {}
+    for function_name in FUNCTION_NAMES:
+        module = importlib.import_module(function_name)
+        module.QueueClient = queue_service.queue_client_class()
+        if hasattr(module, "time"):
+            module.time = ScaledTime(clock)
+        if hasattr(module, "ThreadPoolExecutor"):
+            module.ThreadPoolExecutor = AttributedThreadPoolExecutor
+        modules[function_name] = module
+    return modules
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    clock = SimClock(args.time_scale)
+
+    # Each document is a synthetic PDF, some of them copies of an earlier one
+    documents = {}
+    for index in range(args.documents):
+        if documents and rng.random() < args.duplicate_rate:
+            seed, page_count = rng.choice(list(documents.values()))
+        else:
+            seed, page_count = args.seed * 1000003 + index, rng.randint(args.min_pages, args.max_pages)
+        documents[f"upload/benchmark/document-{index:05d}.pdf"] = (seed, page_count)
+
+    def analyze(blob_path):
+        seed, page_count = documents[blob_path]
+        return analyze_result(seed, page_count)
+
+    doc_intel_servers = [MockDocumentIntelligence(clock, analyze, args.doc_intel_seconds, args.doc_intel_page_seconds,
+                                                  args.doc_intel_429_rate, args.doc_intel_retry_after, args.seed + index).start()
+                         for index in range(args.doc_intel_endpoints)]
+    aoai_servers = [MockAzureOpenAI(clock, args.aoai_seconds, args.aoai_token_seconds, args.aoai_tpm, args.aoai_completion_tokens,
+                                    args.aoai_429_rate, args.aoai_retry_after, args.seed + index).start()
+                    for index in range(args.aoai_endpoints)]
+
+    settings = load_settings(args.settings)
+    settings.update(local_settings([server.endpoint for server in doc_intel_servers], [server.endpoint for server in aoai_servers],
+                                   settings.get("AZURE_OPENAI_DEPLOYMENT_ID", "gpt-35-turbo")))
+    for setting in args.set:
+        name, value = setting.split("=", 1)
+        settings[name] = value
+    os.environ.update(settings)
+
+    blob_service = FakeBlobServiceClient()
+    queue_service = FakeQueueService(clock)
+    cosmos_client = FakeCosmosClient()
+    modules = install_stand_ins(settings, clock, blob_service, queue_service, cosmos_client)
+
+    import azure.functions as func
+    drop_container = settings["BLOB_STORAGE_ACCOUNT_UPLOAD_CONTAINER_NAME"]
+    uploaded_at = {}
+
+    def upload(blob_name):
+        seed, page_count = documents[blob_name]
+        content = pdf_document(seed, page_count)
+        blob_service.get_blob_client(drop_container, blob_name.split("/", 1)[1]).upload_blob(content, overwrite=True)
+        uploaded_at[blob_name] = clock.now()
+        modules["AddToQueue"].main(func.blob.InputStream(data=content, name=blob_name, length=len(content),
+                                                         uri=f'{settings["BLOB_STORAGE_ACCOUNT_ENDPOINT"]}{blob_name}'))
+
+    interval = 60 / args.arrival_rate if args.arrival_rate else 0
+    uploads = [(index * interval, blob_name) for index, blob_name in enumerate(documents)]
+
+    status_container = cosmos_client.container(settings["COSMOSDB_LOG_DATABASE_NAME"], settings["COSMOSDB_LOG_CONTAINER_NAME"])
+    finished_at = {}
+
+    def is_finished():
+        with status_container._lock:
+            file_logs = [item for item in status_container.items.values() if item.get("doc_type") == "file_log"]
+        for item in file_logs:
+            if item["state"] in TERMINAL_STATES and item["file_path"] not in finished_at:
+                finished_at[item["file_path"]] = (clock.now(), item["state"], item.get("merged_chunk_count", -1))
+        return len(finished_at) == len(documents) or all(queue_service.length(queue_name) == 0 for queue_name in triggers["queues"])
+
+    triggers = {
+        "AddToQueue": upload,
+        "queues": {
+            settings["PDF_SUBMIT_QUEUE"]: ("SubmitToDocumentIntel", modules["SubmitToDocumentIntel"].main),
+            settings["PDF_POLLING_QUEUE"]: ("PollDocumentIntelChunk", modules["PollDocumentIntelChunk"].main),
+            settings["CHUNKS_QUEUE"]: ("RunLLMPrompt", modules["RunLLMPrompt"].main),
+        }
+    }
+    # A function sending to one of these queues is putting its work back rather than passing it on
+    requeue_queues = {
+        "SubmitToDocumentIntel": {settings["PDF_SUBMIT_QUEUE"]},
+        "PollDocumentIntelChunk": {settings["PDF_POLLING_QUEUE"], settings["PDF_SUBMIT_QUEUE"]},
+        "RunLLMPrompt": {settings["CHUNKS_QUEUE"]},
+    }
+    host = PipelineHost(clock, queue_service, triggers, requeue_queues, args.concurrency, int(settings.get("MAX_DEQUEUE_COUNT", "3")))
+
+    real_start = time.perf_counter()
+    try:
+        host.run(uploads, is_finished, args.max_minutes * 60)
+    finally:
+        for server in doc_intel_servers + aoai_servers:
+            server.stop()
+    is_finished()
+    return build_report(args, clock, time.perf_counter() - real_start, documents, uploaded_at, finished_at, host,
+                        doc_intel_servers, aoai_servers)
+
+
+def build_report(args, clock, real_seconds, documents, uploaded_at, finished_at, host, doc_intel_servers, aoai_servers):
+    def total(servers, name):
+        return sum(server.counts.get(name, 0) for server in servers)
+
+    completed = {path: finished for path, finished in finished_at.items() if finished[1] == "Complete"}
+    # A run with unfinished documents is measured up to when it was stopped
+    simulated_seconds = clock.now() if len(finished_at) < len(documents) else max(finished[0] for finished in finished_at.values())
+    latencies = [finished[0] - uploaded_at[path] for path, finished in completed.items() if path in uploaded_at]
+    merged_chunks = sum(max(0, int(finished[2])) for finished in completed.values())
+    completions = total(aoai_servers, "completion")
+
+    return {
+        "documents": len(documents),
+        "pages": sum(page_count for _, page_count in documents.values()),
+        "completed": len(completed),
+        "failed": len(finished_at) - len(completed),
+        "unfinished": len(documents) - len(finished_at),
+        "simulated_minutes": round(simulated_seconds / 60, 2),
+        "real_seconds": round(real_seconds, 1),
+        "documents_per_minute": round(len(completed) / (simulated_seconds / 60), 2) if simulated_seconds else None,
+        "document_latency_seconds": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99)},
+        "merged_chunks": merged_chunks,
+        "llm_calls": completions,
+        "llm_calls_throttled": total(aoai_servers, "completion_throttled"),
+        "llm_calls_per_document": round(completions / len(completed), 2) if completed else None,
+        "llm_calls_per_merged_chunk": round(completions / merged_chunks, 2) if merged_chunks else None,
+        "doc_intel_submits": total(doc_intel_servers, "submit"),
+        "doc_intel_submits_throttled": total(doc_intel_servers, "submit_throttled"),
+        "doc_intel_polls": total(doc_intel_servers, "poll"),
+        "doc_intel_polls_running": total(doc_intel_servers, "poll_running"),
+        "doc_intel_polls_throttled": total(doc_intel_servers, "poll_throttled"),
+        "functions": {
+            function_name: {
+                "invocations": len(stats.durations),
+                "wasted": stats.wasted(),
+                "failed": stats.failed,
+                "poisoned": stats.poisoned,
+                "p50_ms": round(percentile(stats.durations, 50) * 1000, 1) if stats.durations else None,
+                "p99_ms": round(percentile(stats.durations, 99) * 1000, 1) if stats.durations else None,
+            }
+            for function_name, stats in host.stats.items()
+        }
+    }
+
+
+def print_report(report):
+    print(f"Documents: {report['documents']} ({report['pages']} pages), {report['completed']} complete, "
+          f"{report['failed']} failed, {report['unfinished']} unfinished")
+    print(f"Simulated time: {report['simulated_minutes']} minutes, real time: {report['real_seconds']} seconds")
+    print(f"Throughput: {report['documents_per_minute']} documents/minute")
+    latency = report["document_latency_seconds"]
+    print(f"Document latency (simulated seconds): p50 {latency['p50'] and round(latency['p50'], 1)}, p99 {latency['p99'] and round(latency['p99'], 1)}")
+    print(f"Azure OpenAI: {report['llm_calls']} calls ({report['llm_calls_throttled']} throttled), "
+          f"{report['llm_calls_per_document']} per document, {report['llm_calls_per_merged_chunk']} per merged chunk")
+    print(f"Document Intelligence: {report['doc_intel_submits']} submits ({report['doc_intel_submits_throttled']} throttled), "
+          f"{report['doc_intel_polls']} polls ({report['doc_intel_polls_running']} still running, {report['doc_intel_polls_throttled']} throttled)")
+    print(f"{'Function':<24}{'Invocations':>12}{'Wasted':>8}{'Failed':>8}{'Poisoned':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for function_name, stats in report["functions"].items():
+        print(f"{function_name:<24}{stats['invocations']:>12}{stats['wasted']:>8}{stats['failed']:>8}{stats['poisoned']:>10}"
+              f"{str(stats['p50_ms']):>10}{str(stats['p99_ms']):>10}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the throughput of the pipeline offline, against local stand-ins for the Azure services")
+    parser.add_argument("--documents", type=int, default=20, help="Number of PDFs uploaded")
+    parser.add_argument("--min-pages", type=int, default=1)
+    parser.add_argument("--max-pages", type=int, default=20)
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="Share of uploads that are copies of an earlier upload")
+    parser.add_argument("--arrival-rate", type=float, default=0, help="Uploads per simulated minute, all at once when 0")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=16, help="Function invocations running at once")
+    parser.add_argument("--time-scale", type=float, default=20, help="Simulated seconds passing per real second")
+    parser.add_argument("--max-minutes", type=float, default=240, help="Simulated minutes after which the run is stopped")
+    parser.add_argument("--doc-intel-endpoints", type=int, default=1)
+    parser.add_argument("--doc-intel-seconds", type=float, default=5, help="Seconds Document Intelligence takes to analyze a document, plus --doc-intel-page-seconds per page")
+    parser.add_argument("--doc-intel-page-seconds", type=float, default=0.5)
+    parser.add_argument("--doc-intel-429-rate", type=float, default=0.0, help="Share of Document Intelligence requests throttled")
+    parser.add_argument("--doc-intel-retry-after", type=int, help="Retry-After seconds of a throttled Document Intelligence request, none sent when omitted")
+    parser.add_argument("--aoai-endpoints", type=int, default=1)
+    parser.add_argument("--aoai-seconds", type=float, default=1, help="Seconds a completion takes, plus --aoai-token-seconds per completion token")
+    parser.add_argument("--aoai-token-seconds", type=float, default=0.02)
+    parser.add_argument("--aoai-completion-tokens", type=int, default=100)
+    parser.add_argument("--aoai-tpm", type=int, help="Tokens per minute each Azure OpenAI endpoint allows, unlimited when omitted")
+    parser.add_argument("--aoai-429-rate", type=float, default=0.0, help="Share of Azure OpenAI requests throttled regardless of the tokens per minute")
+    parser.add_argument("--aoai-retry-after", type=int, help="Retry-After seconds of a randomly throttled Azure OpenAI request, none sent when omitted")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="Overrides a function app setting, may be repeated")
+    parser.add_argument("--settings", default=os.path.join(FUNCTIONS_DIR, "template_local.settings.json"), help="Settings file the function app settings are read from")
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the logs of the functions")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR, format="%(asctime)s %(levelname)s %(message)s")
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+""" Synthetic PDF uploads and Document Intelligence layout results, generated from a seed so runs are repeatable """
+import random
+
+WORDS = ("the of and to in is that for it as with was on be by this are or from at an which "
+         "revenue contract party agreement section clause shall herein thereof & < > \" ' Dr. 12,345.67").split()
+
+
+def sentence(rng, word_count=None):
+    word_count = word_count or rng.randint(3, 25)
+    text = " ".join(rng.choice(WORDS) for _ in range(word_count))
+    return text[0].upper() + text[1:] + rng.choice([".", ".", "?", "!"])
+
+
+def pdf_document(seed, page_count, page_size=20000):
+    """ Function to return the bytes of a PDF-like upload with page_count pages of roughly page_size bytes each.
+    Only the page markers AddToQueue counts are real, the content is padding unique to the seed. """
+    rng = random.Random(seed)
+    parts = [b"%PDF-1.7\n", f"1 0 obj << /Type /Pages /Count {page_count} >> endobj\n".encode()]
+    for page in range(page_count):
+        parts.append(f"{page + 2} 0 obj << /Type /Page /Parent 1 0 R >> endobj\n".encode())
+        parts.append(b"stream\n" + rng.randbytes(page_size) + b"\nendstream\n")
+    parts.append(b"%%EOF\n")
+    return b"".join(parts)
+
+
+def analyze_result(seed, page_count, table_probability=0.15, long_paragraph_probability=0.05, long_paragraph_sentences=40,
+                   multi_page_table_probability=0.0, multi_page_table_pages=6):
+    """ Function to return a prebuilt-layout analyzeResult with titles, section headings, paragraphs, tables,
+    page headers and page numbers spread over page_count pages.
+    A multi-page table is reported the way Document Intelligence reports it, as one table per page with the header
+    rows only on its first page. """
+    rng = random.Random(seed)
+    content = []
+    position = 0
+    paragraphs, tables = [], []
+
+    def add(text):
+        nonlocal position
+        offset = position
+        content.append(text + "\n")
+        position += len(text) + 1
+        return offset
+
+    def add_paragraph(text, page_number, role=None):
+        paragraph = {"content": text, "spans": [{"offset": add(text), "length": len(text)}], "boundingRegions": [{"pageNumber": page_number}]}
+        if role is not None:
+            paragraph["role"] = role
+        paragraphs.append(paragraph)
+
+    add_paragraph("Introduction " + sentence(rng, 5), 1, "title")
+    continued_table = None
+    for page_number in range(1, page_count + 1):
+        if rng.random() < 0.7:
+            add_paragraph(f"Page header {page_number}", page_number, "pageHeader")
+        if continued_table is not None:
+            column_count, remaining_pages = continued_table
+            tables.append(_table(rng, page_number, add, paragraphs, rng.randint(30, 50), column_count, 0))
+            continued_table = (column_count, remaining_pages - 1) if remaining_pages > 1 else None
+            continue
+        if multi_page_table_probability and rng.random() < multi_page_table_probability:
+            column_count = rng.randint(3, 8)
+            tables.append(_table(rng, page_number, add, paragraphs, rng.randint(30, 50), column_count, 1))
+            continued_table = (column_count, rng.randint(1, multi_page_table_pages - 1))
+            continue
+        for _ in range(rng.randint(3, 12)):
+            draw = rng.random()
+            if draw < 0.08:
+                add_paragraph("Title " + sentence(rng, 3), page_number, "title")
+            elif draw < 0.2:
+                add_paragraph("Section " + sentence(rng, 4), page_number, "sectionHeading")
+            elif draw < 0.2 + table_probability:
+                tables.append(_table(rng, page_number, add, paragraphs))
+            else:
+                sentence_count = rng.randint(1, long_paragraph_sentences) if rng.random() < long_paragraph_probability else rng.randint(1, 4)
+                add_paragraph(" ".join(sentence(rng) for _ in range(sentence_count)), page_number)
+        if rng.random() < 0.7:
+            add_paragraph(str(page_number), page_number, "pageNumber")
+
+    return {
+        "apiVersion": "2023-07-31",
+        "modelId": "prebuilt-layout",
+        "content": "".join(content),
+        "pages": [{"pageNumber": page_number} for page_number in range(1, page_count + 1)],
+        "paragraphs": paragraphs,
+        "tables": tables
+    }
+
+
+def _table(rng, page_number, add, paragraphs, row_count=None, column_count=None, header_row_count=None):
+    row_count = row_count or rng.randint(2, 40)
+    column_count = column_count or rng.randint(1, 6)
+    if header_row_count is None:
+        header_row_count = rng.randint(1, 2) if rng.random() < 0.7 else 0
+    cells = []
+    start = None
+    for row_index in range(row_count):
+        for column_index in range(column_count):
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6)))
+            offset = add(text)
+            start = offset if start is None else start
+            cell = {"rowIndex": row_index, "columnIndex": column_index, "content": text, "spans": [{"offset": offset, "length": len(text)}]}
+            if row_index < header_row_count:
+                cell["kind"] = "columnHeader"
+            elif column_index == 0 and rng.random() < 0.2:
+                cell["kind"] = "rowHeader"
+            if rng.random() < 0.05:
+                cell["columnSpan"] = 2
+            cells.append(cell)
+            # Layout also reports the text of each cell as a paragraph
+            paragraphs.append({"content": text, "spans": [{"offset": offset, "length": len(text)}], "boundingRegions": [{"pageNumber": page_number}]})
+    end = offset + len(text)
+    return {"rowCount": row_count, "columnCount": column_count, "cells": cells,
+            "spans": [{"offset": start, "length": end - start}], "boundingRegions": [{"pageNumber": page_number}]}